@@ -0,0 +1,64 @@
+"""Compare IPPortPatternGlobal and IPPortTokenizer on synthetic pages.
+
+Usage: python benchmarks/bench_extract.py [size ...]
+"""
+
+import sys
+import time
+
+from proxybroker.utils import IPPortPatternGlobal, IPPortTokenizer
+
+
+def table(size):
+    row = '<tr><td>10.0.%d.%d</td><td>%d</td><td>HTTP</td><td>Anonymous</td></tr>'
+    return ''.join(row % (i >> 8 & 255, i & 255, 8000 + i % 1000) for i in range(size))
+
+
+def plain(size):
+    return '\n'.join(
+        '10.0.%d.%d:%d' % (i >> 8 & 255, i & 255, 3128) for i in range(size)
+    )
+
+
+def sparse(size):
+    # Long gaps without digits between the addresses
+    return ('10.0.0.1' + ' <span class="x">' * 20) * size
+
+
+def digits(size):
+    # Runs of short numbers after the addresses
+    return ('10.0.0.1 ' + '1.2.' * 20) * size
+
+
+PAGES = {'table': table, 'plain': plain, 'sparse': sparse, 'digits': digits}
+
+
+def timeit(func, page, number=5):
+    stime = time.perf_counter()
+    for _ in range(number):
+        func(page)
+    return (time.perf_counter() - stime) / number
+
+
+def main():
+    sizes = [int(s) for s in sys.argv[1:]] or [1000, 10000, 100000]
+    tokenizer = IPPortTokenizer()
+    for size in sizes:
+        for name, make in PAGES.items():
+            page = make(size)
+            regex = timeit(IPPortPatternGlobal.findall, page)
+            tokens = timeit(tokenizer.findall, page)
+            print(
+                '{name:>8} {size:>7} {kb:>8} KB: regex {regex:8.2f} ms, '
+                'tokenizer {tokens:8.2f} ms'.format(
+                    name=name,
+                    size=size,
+                    kb=len(page) // 1024,
+                    regex=regex * 1e3,
+                    tokens=tokens * 1e3,
+                )
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""Measure the delay of the event loop while providers parse large pages.
+
+Usage: python benchmarks/bench_parse.py [size ...]
+"""
+
+import asyncio
+import sys
+import time
+
+from proxybroker import providers
+from proxybroker.providers import Nntime_com, Provider
+
+
+def make_page(size):
+    row = '<tr><td>10.0.%d.%d</td><td>%d</td><td>HTTP</td><td>Anonymous</td></tr>'
+    return ''.join(row % (i >> 8 & 255, i & 255, 8000 + i % 1000) for i in range(size))
+
+
+def make_js_page(size):
+    # The ports are written by scripts from the digits of the page variables
+    chars = 'abcdefghij'
+    head = '<script>%s</script>' % ''.join(
+        '%s=%d;' % (c, i) for i, c in enumerate(chars)
+    )
+    row = (
+        '<tr><td>10.0.%d.%d<script>document.write(":"+%s)</script></td>'
+        '<td>HTTP</td><td>Anonymous</td></tr>'
+    )
+    return head + ''.join(
+        row
+        % (i >> 8 & 255, i & 255, '+'.join(chars[int(d)] for d in str(8000 + i % 1000)))
+        for i in range(size)
+    )
+
+
+async def monitor(lags, interval=0.001):
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - started - interval)
+
+
+async def bench(cls, page, threshold):
+    providers.PARSE_IN_THREAD_SIZE = threshold
+    provider = cls()
+    lags = []
+    task = asyncio.ensure_future(monitor(lags))
+    await asyncio.sleep(0.01)
+    stime = time.perf_counter()
+    await provider._parse(page)
+    runtime = time.perf_counter() - stime
+    await asyncio.sleep(0.01)
+    task.cancel()
+    return runtime, max(lags)
+
+
+def main():
+    sizes = [int(s) for s in sys.argv[1:]] or [10000, 100000]
+    loop = asyncio.get_event_loop()
+    # Nntime_com parses with whole page regexes, in a process
+    cases = ((Provider, make_page, 'thread'), (Nntime_com, make_js_page, 'process'))
+    for size in sizes:
+        for cls, make, offloaded in cases:
+            page = make(size)
+            for name, threshold in (('loop', len(page) + 1), (offloaded, 0)):
+                runtime, lag = loop.run_until_complete(bench(cls, page, threshold))
+                print(
+                    '{cls:>10} {name:>7} {kb:>7} KB: parsed in {runtime:8.2f} ms, '
+                    'max loop delay {lag:8.2f} ms'.format(
+                        cls=cls.__name__,
+                        name=name,
+                        kb=len(page) // 1024,
+                        runtime=runtime * 1e3,
+                        lag=lag * 1e3,
+                    )
+                )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""Measure the cost of ProxyPool.get/put/remove on large pools.
+
+Usage: python benchmarks/bench_pool.py [size ...]
+"""
+
+import asyncio
+import random
+import sys
+import time
+
+from proxybroker import Proxy
+from proxybroker.server import ProxyPool
+from proxybroker.strategies import STRATEGIES
+
+
+def make_proxies(size):
+    proxies = []
+    for i in range(size):
+        proxy = Proxy('10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255), 8080)
+        tps = random.choice([('HTTP',), ('HTTPS',), ('HTTP', 'HTTPS')])
+        proxy.types.update({tp: None for tp in tps})
+        proxy.stat['requests'] = 10
+        proxy._runtimes = [random.uniform(0.1, 5)]
+        proxies.append(proxy)
+    return proxies
+
+
+def report(name, strategy, size, runtime, number):
+    print(
+        '{strategy:>12} {name:>8} {size:>7}: {us:8.2f} us/op'.format(
+            strategy=strategy, name=name, size=size, us=runtime / number * 1e6
+        )
+    )
+
+
+def timeit(name, strategy, size, func, number):
+    stime = time.perf_counter()
+    func()
+    report(name, strategy, size, time.perf_counter() - stime, number)
+
+
+async def bench(size, strategy, proxies):
+    pool = ProxyPool(asyncio.Queue(), min_queue=0, strategy=strategy)
+    number = min(size, 10000)
+
+    timeit('put', strategy, size, lambda: [pool.put(p) for p in proxies], size)
+
+    async def get_put():
+        for _ in range(number):
+            proxy = await pool.get(random.choice(('HTTP', 'HTTPS')))
+            pool.put(proxy)
+
+    stime = time.perf_counter()
+    await get_put()
+    report('get+put', strategy, size, time.perf_counter() - stime, number)
+
+    victims = random.sample(proxies, number)
+    timeit(
+        'remove',
+        strategy,
+        size,
+        lambda: [pool.remove(p.host, p.port) for p in victims],
+        number,
+    )
+
+
+def main():
+    sizes = [int(s) for s in sys.argv[1:]] or [10000, 50000, 100000]
+    loop = asyncio.get_event_loop()
+    for size in sizes:
+        proxies = make_proxies(size)
+        for strategy in STRATEGIES:
+            loop.run_until_complete(bench(size, strategy, proxies))
+
+
+if __name__ == '__main__':
+    main()
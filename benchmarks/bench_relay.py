@@ -0,0 +1,92 @@
+"""Measure the throughput of relaying a tunnel through the local server.
+
+A child process sends the data to the relay and receives it back, so the CPU
+time of this process is spent on relaying only.
+
+Usage: python benchmarks/bench_relay.py [megabytes]
+"""
+
+import asyncio
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import time
+
+from proxybroker.relay import relay
+
+CHUNK = b'\x00' * (1 << 20)
+
+
+def source(sock, size):
+    conn, _ = sock.accept()
+    for _ in range(size):
+        conn.sendall(CHUNK)
+    conn.close()
+
+
+def client(source_sock, relay_port, size):
+    threading.Thread(target=source, args=(source_sock, size), daemon=True).start()
+    with socket.create_connection(('127.0.0.1', relay_port)) as conn:
+        while conn.recv(1 << 20):
+            pass
+
+
+async def stream(reader, writer, timeout=8):
+    # The way Server._stream copies data
+    while not reader.at_eof():
+        data = await asyncio.wait_for(reader.read(65536), timeout)
+        if not data:
+            break
+        writer.write(data)
+        await writer.drain()
+    writer.close()
+
+
+async def bench(mode, size):
+    source_sock = socket.socket()
+    source_sock.bind(('127.0.0.1', 0))
+    source_sock.listen(1)
+    done = asyncio.get_event_loop().create_future()
+
+    async def handle(reader, writer):
+        up_reader, up_writer = await asyncio.open_connection(*source_sock.getsockname())
+        if mode == 'stream':
+            await asyncio.gather(stream(reader, up_writer), stream(up_reader, writer))
+        else:
+            await relay(
+                (reader, writer), (up_reader, up_writer), splice=mode == 'splice'
+            )
+        writer.close()
+        done.set_result(None)
+
+    server = await asyncio.start_server(handle, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    proc = multiprocessing.Process(target=client, args=(source_sock, port, size))
+    wall, cpu = time.perf_counter(), time.process_time()
+    proc.start()
+    await done
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    proc.join()
+    server.close()
+    source_sock.close()
+    print(
+        '{mode:>8}: {mbs:8.1f} MB/s, {cpu:8.1f} MB per CPU second'.format(
+            mode=mode, mbs=size / wall, cpu=size / cpu
+        )
+    )
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 1024
+    modes = ['stream', 'protocol']
+    if hasattr(os, 'splice'):
+        modes.append('splice')
+    loop = asyncio.get_event_loop()
+    for mode in modes:
+        loop.run_until_complete(bench(mode, size))
+
+
+if __name__ == '__main__':
+    main()
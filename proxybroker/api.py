@@ -6,20 +6,38 @@ from collections import Counter, defaultdict
 from functools import partial
 from pprint import pprint
 
+import aiohttp
+from cachetools import TTLCache
+
 from .checker import Checker
 from .errors import ResolveError
+from .pagecache import PageCache
 from .providers import PROVIDERS, Provider
 from .proxy import Proxy
 from .resolver import Resolver
 from .server import Server
-from .utils import IPPortPatternLine, log
+from .utils import IPPortPatternLine, ScalableBloomFilter, log
+from .workers import Workers
 
 # Pause between grabbing cycles; in seconds.
 GRAB_PAUSE = 180
+# Pause between grabbing cycles while requests to the server wait for proxies
+MIN_GRAB_PAUSE = 30
 
 # The maximum number of providers that are parsed concurrently
 MAX_CONCURRENT_PROVIDERS = 3
 
+# The maximum number of concurrent connections to a host of providers
+MAX_CONN_PER_HOST = 4
+
+# In seconds
+PROVIDERS_DNS_TTL = 600
+PROVIDERS_KEEPALIVE = 60
+# Time the found (host, port) pairs are remembered for skipping duplicates
+SEEN_TTL = 6 * 3600
+# The maximum number of the found proxies kept in serve mode
+MAX_UNIQUE_PROXIES = 100000
+
 
 class Broker:
     """The Broker.
@@ -45,6 +63,14 @@ class Broker:
     :param loop: (optional) asyncio compatible event loop
     :param stop_broker_on_sigint: (optional) whether set SIGINT signal on broker object. 
         Useful for a thread other than main thread.
+    :param str page_cache:
+        (optional) Directory to store the pages of providers to,
+        and to receive them from while they're fresh
+    :param int page_cache_ttl:
+        (optional) Seconds the pages of providers are fresh in the cache
+    :param bool replay:
+        (optional) Receive the pages of providers only from ``page_cache``,
+        regardless of their age, e.g. to repeat a grab offline
 
     .. deprecated:: 0.2.0
         Use :attr:`max_conn` and :attr:`max_tries` instead of
@@ -62,6 +88,9 @@ class Broker:
         verify_ssl=False,
         loop=None,
         stop_broker_on_sigint=True,
+        page_cache=None,
+        page_cache_ttl=3600,
+        replay=False,
         **kwargs,
     ):
         self._loop = loop or asyncio.get_event_loop()
@@ -69,12 +98,23 @@ class Broker:
         self._resolver = Resolver(loop=self._loop)
         self._timeout = timeout
         self._verify_ssl = verify_ssl
+        # Session shared by the providers
+        self._session = None
+        self._pages = None
+        if page_cache:
+            self._pages = PageCache(page_cache, ttl=page_cache_ttl, replay=replay)
+        elif replay:
+            raise ValueError('`replay` requires `page_cache`')
 
         self.unique_proxies = {}
+        # (host, port) pairs received from providers, before creating proxies
+        self._seen = ScalableBloomFilter(ttl=SEEN_TTL)
         self._all_tasks = []
         self._checker = None
         self._server = None
         self._limit = 0  # not limited
+        # (low, high) numbers of proxies available to the server
+        self._watermarks = None
         self._countries = None
 
         max_concurrent_conn = kwargs.get('max_concurrent_conn')
@@ -222,18 +262,79 @@ class Broker:
         :param int limit:
             (optional) When will be found a requested number of working
             proxies, checking of new proxies will be lazily paused.
-            Checking will be resumed if all the found proxies will be discarded
+            Checking will be resumed when the available proxies fall to
+            :attr:`low_watermark`, e.g. when they are in use or discarded
             in the process of working with them (see :attr:`max_error_rate`,
-            :attr:`max_resp_time`). And will continue until it finds one
-            working proxy and paused again. The default value is 100
+            :attr:`max_resp_time`). The default value is 100
+        :param int high_watermark:
+            (optional) Checking is paused when this number of working proxies
+            is available to the pool (not in use, or waiting to be imported).
+            The default value is :attr:`limit`
+        :param int low_watermark:
+            (optional) Checking is resumed when the number of the available
+            proxies falls to this one, before the pool runs out of them.
+            The default value is half of :attr:`high_watermark`
         :param int max_tries:
             (optional) The maximum number of attempts to handle an incoming
             request. If not specified, it will use the value specified during
             the creation of the :class:`Broker` object. Attempts can be made
             with different proxies. The default value is 3
-        :param int strategy:
-            (optional) The strategy used for picking proxy from pool.
+        :param str strategy:
+            (optional) The strategy used for picking proxy from pool:
+            ``best`` - the lowest error rate and average response time;
+            ``random`` - random, weighted by error rate and response time;
+            ``round-robin`` - in turn;
+            ``least-conn`` - the fewest requests in flight;
+            ``p2c`` - the better of two random proxies (power of two choices);
+            ``ewma`` - the lowest moving average response time, scaled by
+            the requests in flight (of two random proxies);
+            ``transfer`` - the same as ``ewma``, but by the expected time of
+            receiving :attr:`payload_size` bytes, given the measured
+            throughput of the proxies.
             The default value is 'best'
+        :param int payload_size:
+            (optional) The size of the responses in bytes the ``transfer``
+            strategy ranks the proxies for. The default value is 1048576
+        :param int max_concurrency:
+            (optional) The maximum number of requests that are passed through
+            one proxy at a time. A proxy processing fewer requests can still
+            be chosen for a new one. The default value is 1
+        :param int max_idle_conns:
+            (optional) The maximum number of idle keep-alive connections per
+            proxy, which are reused for HTTP requests. Zero disables reuse.
+            The default value is 0
+        :param int idle_timeout:
+            (optional) Seconds after which an idle connection is closed.
+            The default value is 30
+        :param int prewarm:
+            (optional) The number of the best proxies with which connections
+            are established ahead of demand (requires :attr:`max_idle_conns`).
+            The default value is 0
+        :param int keepalive_timeout:
+            (optional) Seconds a client connection is kept open waiting for
+            the next request. Subsequent and pipelined requests are passed
+            through a proxy each. Zero closes the connection after
+            the first request. The default value is 0
+        :param int max_keepalive_requests:
+            (optional) The maximum number of requests served through one
+            client connection. The default value is 100
+        :param int max_header_size:
+            (optional) The maximum size of the head of a request in bytes.
+            Larger requests are answered with 431. Request bodies are not
+            limited and are streamed to the proxy as they arrive.
+            The default value is 65536
+        :param int hedge_percentile:
+            (optional) Hedging of slow connections: if connecting to a proxy
+            takes longer than this percentile of the recent connection times,
+            another proxy is connected in parallel and the first established
+            connection is used. The slower proxy is counted as failed.
+            Zero disables hedging. The default value is 0
+        :param int session_ttl:
+            (optional) Sticky sessions: the requests with the same
+            ``X-Proxy-Session`` header (or, without it, from the same client
+            IP) are passed through the same proxy while it stays in the pool.
+            A session is forgotten after this number of seconds without
+            requests. Zero disables sticky sessions. The default value is 0
         :param int min_queue:
             (optional) The minimum number of proxies to choose from
                 before deciding which is the most suitable to use.
@@ -251,6 +352,25 @@ class Broker:
             (optional) The maximum response time in seconds.
             If proxy.avg_resp_time exceeds this value, proxy will be removed
             from the pool. The default value is 8
+        :param int quarantine_time:
+            (optional) Seconds after which a proxy removed from the pool is
+            probed by a request through it and returned to it with scaled down
+            stats if the probe passes. The time is doubled on each next failure
+            of the proxy, until it serves :attr:`min_req_proxy` requests again.
+            Zero removes the proxies for good. The default value is 30
+        :param int max_quarantine_time:
+            (optional) A proxy is removed for good when its quarantine would
+            exceed this number of seconds. The default value is 1800
+        :param str probe_url:
+            (optional) The HTTP URL requested through the quarantined proxies
+            to probe them. By default, one of the working judges
+        :param float rate_limit:
+            (optional) The maximum number of requests per second through
+            a proxy. The proxies exceeding it are passed over while others
+            are available. Zero disables the limit. The default value is 0
+        :param float domain_rate_limit:
+            (optional) The same as :attr:`rate_limit`, but for the requests
+            through a proxy to one host. The default value is 0
         :param bool prefer_connect:
             (optional) Flag that indicates whether to use the CONNECT method
             if possible. For example: If is set to True and a proxy supports
@@ -268,6 +388,38 @@ class Broker:
         :param int backlog:
             (optional) The maximum number of queued connections passed to
             listen. The default value is 100
+        :param int max_clients:
+            (optional) The maximum number of client connections at a time;
+            the excess ones are answered by ``503 Service Unavailable`` at
+            once. Zero disables the limit. The default value is 0
+        :param int max_waiting:
+            (optional) The maximum number of requests waiting for a proxy
+            when none is available; the excess ones are answered by 503.
+            Zero disables the limit. The default value is 0
+        :param int wait_timeout:
+            (optional) Seconds a request waits for a proxy before it's
+            answered by 503. Zero waits without a deadline.
+            The default value is 30
+        :param int workers:
+            (optional) The number of processes accepting the connections on
+            the same port (requires ``SO_REUSEPORT``, e.g. Linux or BSD).
+            The proxies are found and checked in this process and passed to
+            the workers with the fewest proxies, up to :attr:`max_concurrency`
+            of them, which share the limits and the stats of the proxies.
+            The default value is 1
+        :param int cache_size:
+            (optional) The maximum size of the cache of responses to HTTP GET
+            requests, in bytes. The responses are cached according to their
+            ``Cache-Control``, ``Expires`` and ``Vary`` headers, and
+            concurrent requests of an URL are passed to a proxy once.
+            HTTPS is not cached. Zero disables the cache. The default value is 0
+        :param str snapshot_path:
+            (optional) The file to which the proxies of the pool and their stats
+            are saved periodically and on stopping. On starting, the proxies are
+            restored from it, so they are ranked without new requests. Not
+            supported with several :attr:`workers`
+        :param int snapshot_interval:
+            (optional) Seconds between the snapshots. The default value is 60
 
         :raises ValueError:
             If :attr:`limit` is less than or equal to zero.
@@ -283,7 +435,18 @@ class Broker:
                 'endless'
             )
 
-        self._server = Server(
+        high = kwargs.pop('high_watermark', None) or limit
+        low = kwargs.pop('low_watermark', None)
+        low = high // 2 if low is None else low
+        if low >= high:
+            raise ValueError('`low_watermark` should be less than `high_watermark`')
+        self._watermarks = (low, high)
+        # The server keeps the proxies in use, the others are forgotten in time
+        self.unique_proxies = TTLCache(maxsize=MAX_UNIQUE_PROXIES, ttl=SEEN_TTL)
+
+        workers = kwargs.pop('workers', 1)
+        server = partial(Workers, workers=workers) if workers > 1 else Server
+        self._server = server(
             host=host,
             port=port,
             proxies=self._proxies,
@@ -292,6 +455,10 @@ class Broker:
             loop=self._loop,
             **kwargs,
         )
+        if isinstance(self._server, Server):
+            self._server.metrics.gauge(
+                'proxybroker_checks', 'Proxies being checked', self._on_check.qsize
+            )
         self._server.start()
 
         task = asyncio.ensure_future(self.find(limit=limit, **kwargs))
@@ -315,39 +482,100 @@ class Broker:
         self._done()
 
     async def _grab(self, types=None, check=False):
-        def _get_tasks(by=MAX_CONCURRENT_PROVIDERS):
+        def _get_tasks(found, by=MAX_CONCURRENT_PROVIDERS):
             providers = [
                 pr
                 for pr in self._providers
                 if not types or not pr.proto or bool(pr.proto & types.keys())
             ]
+            session = self._get_session()
             while providers:
                 tasks = [
-                    asyncio.ensure_future(pr.get_proxies()) for pr in providers[:by]
+                    asyncio.ensure_future(
+                        pr.get_proxies(session, found.put_nowait, self._pages)
+                    )
+                    for pr in providers[:by]
                 ]
                 del providers[:by]
                 self._all_tasks.extend(tasks)
                 yield tasks
 
         log.debug('Start grabbing proxies')
+        # Proxies are handled as soon as they're found, while providers
+        # are still receiving their pages
+        found = asyncio.Queue()
         while True:
-            for tasks in _get_tasks():
-                for task in asyncio.as_completed(tasks):
-                    proxies = await task
-                    for proxy in proxies:
-                        await self._handle(proxy, check=check)
+            for tasks in _get_tasks(found):
+                received = asyncio.gather(*tasks)
+                received.add_done_callback(lambda f: found.put_nowait(None))
+                proxy = await found.get()
+                while proxy is not None:
+                    await self._handle(proxy, check=check)
+                    proxy = await found.get()
+                await received
             log.info('Grab cycle is complete')
+            self._get_session().cookie_jar.clear()
             if self._server:
                 log.debug('fall asleep for %d seconds' % GRAB_PAUSE)
-                await asyncio.sleep(GRAB_PAUSE)
+                await self._pause(GRAB_PAUSE)
                 log.debug('awaked')
             else:
                 break
         await self._on_check.join()
         self._done()
 
+    def _get_session(self):
+        """Return the session of the providers, opening it if needed.
+
+        The providers share its connections, limited by host, and its DNS
+        cache, so the pages of a host are received on kept-alive connections.
+        """
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit_per_host=MAX_CONN_PER_HOST,
+                ttl_dns_cache=PROVIDERS_DNS_TTL,
+                keepalive_timeout=PROVIDERS_KEEPALIVE,
+                loop=self._loop,
+            )
+            self._session = aiohttp.ClientSession(connector=connector, loop=self._loop)
+        return self._session
+
+    def _close_session(self):
+        session, self._session = self._session, None
+        if session is None or session.closed:
+            return
+        if self._loop.is_running():
+            asyncio.ensure_future(session.close(), loop=self._loop)
+        elif not self._loop.is_closed():
+            self._loop.run_until_complete(session.close())
+
+    async def _pause(self, timeout):
+        """Sleep, or less if requests to the server wait for proxies.
+
+        It's at least ``MIN_GRAB_PAUSE`` seconds anyway, not to grab the
+        providers again and again while the demand lasts.
+        """
+        if self._server is None:
+            await asyncio.sleep(timeout)
+            return
+        await asyncio.sleep(min(MIN_GRAB_PAUSE, timeout))
+        try:
+            await asyncio.wait_for(
+                self._server.demand.wait(), max(timeout - MIN_GRAB_PAUSE, 0)
+            )
+        except asyncio.TimeoutError:
+            pass
+
     async def _handle(self, proxy, check=False):
+        # A duplicate is skipped before resolving it and creating a Proxy
+        host, port = proxy[:2]
+        key = '%s:%s' % (host, port)
+        if key in self._seen:
+            return
         try:
+            if (host, int(port)) in self.unique_proxies:
+                # Found again after the filter has forgotten it
+                return
             proxy = await Proxy.create(
                 *proxy,
                 timeout=self._timeout,
@@ -357,6 +585,8 @@ class Broker:
             )
         except (ResolveError, ValueError):
             return
+        # Added once created, a host failing to resolve is tried again
+        self._seen.add(key)
 
         if not self._is_unique(proxy) or not self._geo_passed(proxy):
             return
@@ -392,18 +622,41 @@ class Broker:
             except asyncio.CancelledError:
                 pass
 
-        if self._server and not self._proxies.empty() and self._limit <= 0:
-            log.debug(
-                'pause. proxies: %s; limit: %s' % (self._proxies.qsize(), self._limit)
-            )
-            await self._proxies.join()
-            log.debug('unpause. proxies: %s' % self._proxies.qsize())
+        if self._server:
+            await self._replenish()
 
         await self._on_check.put(None)
         task = asyncio.ensure_future(self._checker.check(proxy))
         task.add_done_callback(partial(_task_done, proxy))
         self._all_tasks.append(task)
 
+    async def _replenish(self):
+        """Pause checking while the pool of the server has enough proxies.
+
+        It's paused at the high watermark and resumed at the low one, so
+        the pool is refilled before it runs out of proxies. It's also resumed
+        when requests wait for proxies: the supply may be of other schemes.
+        """
+        low, high = self._watermarks
+        server = self._server
+        if server.supply < high or server.demand.is_set():
+            return
+        log.debug('pause. supply: %d; watermarks: %d, %d' % (server.supply, low, high))
+        while server.supply > low and not server.demand.is_set():
+            server.drained.clear()
+            waiters = [
+                asyncio.ensure_future(event.wait())
+                for event in (server.drained, server.demand)
+            ]
+            try:
+                await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                for waiter in waiters:
+                    waiter.cancel()
+        log.debug(
+            'unpause. supply: %d; demand: %s' % (server.supply, server.demand.is_set())
+        )
+
     def _push_to_result(self, proxy):
         log.debug('push to result: %r' % proxy)
         self._proxies.put_nowait(proxy)
@@ -428,6 +681,7 @@ class Broker:
             task = self._all_tasks.pop()
             if not task.done():
                 task.cancel()
+        self._close_session()
         self._push_to_result(None)
         log.info('Done! Total found proxies: %d' % len(self.unique_proxies))
 
@@ -0,0 +1,228 @@
+"""Cache of the HTTP responses passed through the server."""
+
+import asyncio
+import time
+from collections import OrderedDict, namedtuple
+from email.utils import parsedate_to_datetime
+
+__all__ = ['ResponseCache', 'Recorder']
+
+CACHEABLE_STATUSES = {200, 203, 300, 301, 308, 404, 410}
+
+_Entry = namedtuple('_Entry', 'head body vary proxy stored expires age size')
+
+
+def _directives(value):
+    """Parse the Cache-Control header to a dict of directives and their values."""
+    directives = {}
+    for part in value.lower().split(','):
+        name, _, arg = part.strip().partition('=')
+        if name:
+            directives[name] = arg.strip('"') or True
+    return directives
+
+
+def _http_date(value):
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def _seconds(value):
+    try:
+        return max(int(value), 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def _freshness(headers, now):
+    """Return the number of seconds the response is fresh for a shared cache."""
+    directives = _directives(headers.get('Cache-Control', ''))
+    if directives.keys() & {'no-store', 'no-cache', 'private'}:
+        return 0
+    for name in ('s-maxage', 'max-age'):
+        if name in directives:
+            return _seconds(directives[name])
+    if 'Expires' in headers:
+        expires = _http_date(headers['Expires'])
+        date = _http_date(headers.get('Date', '')) or now
+        return max(expires - date, 0) if expires else 0
+    return 0
+
+
+class ResponseCache:
+    """LRU cache of the responses to GET requests, bounded by their total size.
+
+    Only the responses that are fresh by ``Cache-Control`` (``s-maxage``,
+    ``max-age``) or ``Expires`` are stored. They are served while fresh to
+    the requests with the same values of the headers listed in ``Vary``.
+
+    The concurrent requests of an URL wait for the response to the first one
+    (request coalescing), instead of being passed to proxies as well. They
+    are released as soon as its head shows it won't be stored.
+    """
+
+    def __init__(self, max_size, max_item_size=None):
+        self.max_size = max_size
+        self.max_item_size = max_item_size or max_size // 16
+        self.size = 0
+        # url -> responses differing by the headers listed in Vary
+        self._entries = OrderedDict()
+        # url -> future done when the response to the first request is received
+        self._pending = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def key(headers):
+        """Return the key of a request, or None if it can't be served from cache."""
+        if (
+            headers['Method'] != 'GET'
+            or headers.keys() & {'Authorization', 'Range', 'Transfer-Encoding'}
+            or _seconds(headers.get('Content-Length'))
+        ):
+            return None
+        directives = _directives(headers.get('Cache-Control', ''))
+        if directives.keys() & {'no-store', 'no-cache'}:
+            return None
+        if 'no-cache' in headers.get('Pragma', '').lower():
+            return None
+        path = headers['Path']
+        if not path.startswith('/'):
+            # Absolute-form, the URL includes the host
+            return path
+        if not headers.get('Host'):
+            return None
+        port = headers.get('Port')
+        host = '%s:%s' % (headers['Host'], port) if port else headers['Host']
+        return 'http://%s%s' % (host, path)
+
+    async def get(self, key, headers, timeout):
+        """Return a fresh response to the request, or None.
+
+        If the response to the same URL is being received, wait for it up to
+        ``timeout`` seconds first.
+        """
+        pending = self._pending.get(key)
+        if pending is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(pending), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self._lookup(key, headers)
+
+    def lock(self, key):
+        """Make the next requests of the URL wait for the response.
+
+        :return: False if it's already locked by another request
+        """
+        if key in self._pending:
+            return False
+        self._pending[key] = asyncio.get_event_loop().create_future()
+        return True
+
+    def release(self, key):
+        """Let the requests waiting for the response of the URL go.
+
+        The next requests don't wait either, until it's unlocked.
+        """
+        pending = self._pending.get(key)
+        if pending is not None and not pending.done():
+            pending.set_result(None)
+
+    def unlock(self, key):
+        self.release(key)
+        self._pending.pop(key, None)
+
+    @staticmethod
+    def cacheable(headers):
+        """Return True if the response can be stored, by its parsed head."""
+        if (
+            headers['Status'] not in CACHEABLE_STATUSES
+            or 'Set-Cookie' in headers
+            or '*' in headers.get('Vary', '')
+            or not ('Content-Length' in headers or 'Transfer-Encoding' in headers)
+        ):
+            return False
+        return _freshness(headers, time.time()) > _seconds(headers.get('Age'))
+
+    def store(self, key, request_headers, head, headers, body, proxy):
+        """Store the response if it can be cached.
+
+        :param bytes head: The head of the response
+        :param dict headers: The parsed head of the response
+        :param bytes body: The body of the response as it's received
+        :param str proxy: The proxy through which the response is received
+        :return: True if the response is stored
+        """
+        if not self.cacheable(headers):
+            return False
+        vary = headers.get('Vary', '')
+        now = time.time()
+        age = _seconds(headers.get('Age'))
+        lifetime = _freshness(headers, now) - age
+        size = len(head) + len(body)
+        if size > self.max_item_size:
+            return False
+        names = [name.strip().title() for name in vary.split(',') if name.strip()]
+        vary = {name: request_headers.get(name) for name in names}
+        entry = _Entry(head, body, vary, proxy, now, now + lifetime, age, size)
+
+        # The previous response with the same Vary values is replaced
+        previous = self._entries.pop(key, [])
+        variants = [e for e in previous if e.vary != vary]
+        self.size -= sum(e.size for e in previous) - sum(e.size for e in variants)
+        self._entries[key] = variants + [entry]
+        self.size += size
+        while self.size > self.max_size:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= sum(e.size for e in evicted)
+        return True
+
+    @staticmethod
+    def age(entry):
+        """Return the current age of a response in seconds."""
+        return int(entry.age + time.time() - entry.stored)
+
+    def _lookup(self, key, headers):
+        variants = self._entries.get(key)
+        if not variants:
+            return None
+        for entry in variants:
+            if all(headers.get(name) == value for name, value in entry.vary.items()):
+                break
+        else:
+            return None
+        if entry.expires <= time.time():
+            variants.remove(entry)
+            self.size -= entry.size
+            if not variants:
+                del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+
+class Recorder:
+    """Writer passing the data to another one and keeping a copy of it.
+
+    The copy is dropped (:attr:`data` is None) if it exceeds ``limit`` bytes.
+    """
+
+    def __init__(self, writer, limit):
+        self._writer = writer
+        self._limit = limit
+        self.data = bytearray()
+
+    def __getattr__(self, name):
+        return getattr(self._writer, name)
+
+    def write(self, data):
+        self._writer.write(data)
+        if self.data is not None:
+            if len(self.data) + len(data) > self._limit:
+                self.data = None
+            else:
+                self.data += data
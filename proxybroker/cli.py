@@ -9,6 +9,7 @@ from contextlib import contextmanager
 
 from . import __version__ as version
 from .api import Broker
+from .strategies import STRATEGIES
 from .utils import update_geoip_db
 
 
@@ -143,6 +144,26 @@ def add_broker_args(group):
         action='store_true',
         help='Flag indicating whether to check the SSL certificates',
     )
+    group.add_argument(
+        '--page-cache',
+        dest='page_cache',
+        metavar='DIR',
+        help='Directory to store the pages of providers to and reuse them from',
+    )
+    group.add_argument(
+        '--page-cache-ttl',
+        type=int,
+        default=3600,
+        dest='page_cache_ttl',
+        metavar='SECONDS',
+        help='''Seconds the pages of providers are reused for.
+                The default value is 3600''',
+    )
+    group.add_argument(
+        '--replay',
+        action='store_true',
+        help='Receive the pages of providers only from the page cache',
+    )
     group.add_argument(
         '--log',
         nargs='?',
@@ -228,7 +249,133 @@ def add_serve_args(group):
         type=str,
         default='best',
         dest='strategy',
-        help='''The strategy used for picking proxy from pool''',
+        choices=list(STRATEGIES),
+        help='''The strategy used for picking proxy from pool.
+                The default value is best''',
+    )
+    group.add_argument(
+        '--payload-size',
+        type=int,
+        default=1048576,
+        dest='payload_size',
+        metavar='BYTES',
+        help='''The size of the responses the transfer strategy ranks
+                the proxies for. The default value is 1048576''',
+    )
+    group.add_argument(
+        '--max-concurrency',
+        type=int,
+        default=1,
+        dest='max_concurrency',
+        help='''The maximum number of requests passed through one proxy
+                at a time. The default value is 1''',
+    )
+    group.add_argument(
+        '--max-idle-conns',
+        type=int,
+        default=0,
+        dest='max_idle_conns',
+        help='''The maximum number of idle keep-alive connections per proxy,
+                which are reused for HTTP requests. The default value is 0''',
+    )
+    group.add_argument(
+        '--idle-timeout',
+        type=int,
+        default=30,
+        dest='idle_timeout',
+        metavar='SECONDS',
+        help='''Seconds after which an idle connection is closed.
+                The default value is 30 seconds''',
+    )
+    group.add_argument(
+        '--prewarm',
+        type=int,
+        default=0,
+        help='''The number of the best proxies with which connections are
+                established ahead of demand. The default value is 0''',
+    )
+    group.add_argument(
+        '--keepalive-timeout',
+        type=int,
+        default=0,
+        dest='keepalive_timeout',
+        metavar='SECONDS',
+        help='''Seconds a client connection is kept open waiting for
+                the next request. The default value is 0 (the connection
+                is closed after the first request)''',
+    )
+    group.add_argument(
+        '--max-keepalive-requests',
+        type=int,
+        default=100,
+        dest='max_keepalive_requests',
+        help='''The maximum number of requests served through one client
+                connection. The default value is 100''',
+    )
+    group.add_argument(
+        '--max-header-size',
+        type=int,
+        default=65536,
+        dest='max_header_size',
+        help='''The maximum size of the head of a request in bytes.
+                The default value is 65536''',
+    )
+    group.add_argument(
+        '--hedge-percentile',
+        type=int,
+        default=0,
+        dest='hedge_percentile',
+        help='''Connect to another proxy in parallel if connecting takes
+                longer than this percentile of the recent connections.
+                The default value is 0 (disabled)''',
+    )
+    group.add_argument(
+        '--session-ttl',
+        type=int,
+        default=0,
+        dest='session_ttl',
+        metavar='SECONDS',
+        help='''Pass the requests with the same X-Proxy-Session header
+                (or from the same client IP) through the same proxy;
+                a session expires after this number of seconds.
+                The default value is 0 (disabled)''',
+    )
+    group.add_argument(
+        '--cache-size',
+        type=int,
+        default=0,
+        dest='cache_size',
+        metavar='BYTES',
+        help='''The maximum size of the cache of responses to HTTP GET requests;
+                concurrent requests of an URL are passed to a proxy once.
+                The default value is 0 (disabled)''',
+    )
+    group.add_argument(
+        '--snapshot',
+        type=str,
+        default=None,
+        dest='snapshot_path',
+        metavar='PATH',
+        help='''Save the proxies of the pool and their stats to the file and
+                restore them from it on the next start''',
+    )
+    group.add_argument(
+        '--snapshot-interval',
+        type=int,
+        default=60,
+        dest='snapshot_interval',
+        metavar='SECONDS',
+        help='Seconds between the snapshots. The default value is 60',
+    )
+    group.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        dest='workers',
+        metavar='N',
+        help='''The number of processes accepting the connections on the same
+                port (SO_REUSEPORT); proxies are found in the main process and
+                their stats are shared by the workers. The default value is 1''',
     )
     group.add_argument(
         '--min-queue',
@@ -264,6 +411,51 @@ def add_serve_args(group):
                 this value, proxy will be rejected.
                 The default value is 8 seconds''',
     )
+    group.add_argument(
+        '--quarantine-time',
+        type=int,
+        default=30,
+        dest='quarantine_time',
+        metavar='SECONDS',
+        help='''Seconds before a rejected proxy is probed to return to the pool,
+                doubled on each next failure. The default value is 30;
+                0 removes the rejected proxies at once''',
+    )
+    group.add_argument(
+        '--max-quarantine-time',
+        type=int,
+        default=1800,
+        dest='max_quarantine_time',
+        metavar='SECONDS',
+        help='''A proxy is removed when its quarantine would exceed this number
+                of seconds. The default value is 1800''',
+    )
+    group.add_argument(
+        '--probe-url',
+        dest='probe_url',
+        metavar='URL',
+        help='''The HTTP URL requested through a quarantined proxy to probe it.
+                By default, one of the working judges''',
+    )
+    group.add_argument(
+        '--rate-limit',
+        type=float,
+        default=0,
+        dest='rate_limit',
+        metavar='RPS',
+        help='''The maximum number of requests per second through a proxy;
+                the proxies exceeding it are passed over while others are
+                available. The default value is 0 (no limit)''',
+    )
+    group.add_argument(
+        '--domain-rate-limit',
+        type=float,
+        default=0,
+        dest='domain_rate_limit',
+        metavar='RPS',
+        help='''The maximum number of requests per second through a proxy
+                to one host. The default value is 0 (no limit)''',
+    )
     group.add_argument(
         '--prefer-connect',
         action='store_true',
@@ -284,6 +476,47 @@ def add_serve_args(group):
         default=100,
         help='The maximum number of queued connections passed to listen',
     )
+    group.add_argument(
+        '--high-watermark',
+        type=int,
+        default=None,
+        dest='high_watermark',
+        help='''Pause checking when this number of working proxies is available
+                to the pool. The default value is the limit''',
+    )
+    group.add_argument(
+        '--low-watermark',
+        type=int,
+        default=None,
+        dest='low_watermark',
+        help='''Resume checking when the available proxies fall to this number.
+                The default value is half of the high watermark''',
+    )
+    group.add_argument(
+        '--max-clients',
+        type=int,
+        default=0,
+        dest='max_clients',
+        help='''The maximum number of client connections at a time; the excess
+                ones are answered by 503. The default value is 0 (no limit)''',
+    )
+    group.add_argument(
+        '--max-waiting',
+        type=int,
+        default=0,
+        dest='max_waiting',
+        help='''The maximum number of requests waiting for a proxy; the excess
+                ones are answered by 503. The default value is 0 (no limit)''',
+    )
+    group.add_argument(
+        '--wait-timeout',
+        type=int,
+        default=30,
+        dest='wait_timeout',
+        metavar='SECONDS',
+        help='''Seconds a request waits for a proxy before it's answered by 503.
+                The default value is 30; 0 waits without a deadline''',
+    )
 
 
 def add_limit_arg(group, _def=0, _help='The maximum number of working proxies'):
@@ -390,6 +623,9 @@ def cli(args=sys.argv[1:]):
         providers=ns.providers,
         verify_ssl=ns.verify_ssl,
         loop=loop,
+        page_cache=ns.page_cache,
+        page_cache_ttl=ns.page_cache_ttl,
+        replay=ns.replay,
     )
 
     if ns.command in ('find', 'grab'):
@@ -418,12 +654,36 @@ def cli(args=sys.argv[1:]):
             limit=ns.limit,
             min_queue=ns.min_queue,
             strategy=ns.strategy,
+            payload_size=ns.payload_size,
+            max_concurrency=ns.max_concurrency,
+            max_idle_conns=ns.max_idle_conns,
+            idle_timeout=ns.idle_timeout,
+            prewarm=ns.prewarm,
+            keepalive_timeout=ns.keepalive_timeout,
+            max_keepalive_requests=ns.max_keepalive_requests,
+            max_header_size=ns.max_header_size,
+            hedge_percentile=ns.hedge_percentile,
+            session_ttl=ns.session_ttl,
+            workers=ns.workers,
+            cache_size=ns.cache_size,
+            snapshot_path=ns.snapshot_path,
+            snapshot_interval=ns.snapshot_interval,
             min_req_proxy=ns.min_req_proxy,
             max_error_rate=ns.max_error_rate,
             max_resp_time=ns.max_resp_time,
+            quarantine_time=ns.quarantine_time,
+            max_quarantine_time=ns.max_quarantine_time,
+            probe_url=ns.probe_url,
+            rate_limit=ns.rate_limit,
+            domain_rate_limit=ns.domain_rate_limit,
             prefer_connect=ns.prefer_connect,
             http_allowed_codes=ns.http_allowed_codes,
             backlog=ns.backlog,
+            high_watermark=ns.high_watermark,
+            low_watermark=ns.low_watermark,
+            max_clients=ns.max_clients,
+            max_waiting=ns.max_waiting,
+            wait_timeout=ns.wait_timeout,
             data=ns.data,
             types=ns.types,
             countries=ns.countries,
@@ -0,0 +1,112 @@
+"""Metrics of the server in the Prometheus text format."""
+
+from bisect import bisect_left
+from collections import Counter
+
+__all__ = ['Histogram', 'Metrics']
+
+# In seconds
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+
+
+def _label(name, value):
+    value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+    return '{%s="%s"}' % (name, value)
+
+
+class Histogram:
+    """Counts of the observed values by buckets.
+
+    Only the bucket of a value is incremented, the cumulative counts are
+    summed up on rendering.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name):
+        lines, total = [], 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            lines.append('%s_bucket%s %d' % (name, _label('le', bound), total))
+        lines.append('%s_sum %s' % (name, self.sum))
+        lines.append('%s_count %d' % (name, self.count))
+        return lines
+
+
+class Metrics:
+    """Counters updated by the server while handling the requests.
+
+    Gauges are registered as functions returning the current value (or
+    a dict of values by label), e.g. the sizes of the pool.
+    """
+
+    def __init__(self):
+        # scheme -> number of requests
+        self.requests = Counter()
+        # scheme -> number of requests failed through all the attempts
+        self.failures = Counter()
+        # errmsg -> number of errors of proxies
+        self.errors = Counter()
+        # 'upstream' (to proxies) or 'downstream' (to clients) -> bytes
+        self.bytes = Counter()
+        # 'hit' or 'miss' -> number of requests to the response cache
+        self.cache = Counter()
+        # reason -> number of requests answered by 503 Service Unavailable
+        self.rejected = Counter()
+        self.request_time = Histogram()
+        self.connect_time = Histogram()
+        # Delays of the event loop waking up, i.e. time it's blocked
+        self.loop_lag = Histogram(LAG_BUCKETS)
+        self._gauges = []
+
+    def gauge(self, name, help, func, label=None):
+        self._gauges.append((name, help, func, label))
+
+    def render(self):
+        """Return the metrics in the Prometheus text format."""
+        lines = []
+        counters = (
+            ('requests', 'Requests received', self.requests, 'scheme'),
+            ('failed_requests', 'Requests failed', self.failures, 'scheme'),
+            ('proxy_errors', 'Errors of proxies', self.errors, 'error'),
+            ('relayed_bytes', 'Bytes relayed', self.bytes, 'direction'),
+            ('cache_requests', 'Requests to the cache', self.cache, 'result'),
+            ('rejected_requests', 'Requests rejected', self.rejected, 'reason'),
+        )
+        for name, help, values, label in counters:
+            name = 'proxybroker_%s_total' % name
+            self._header(lines, name, help, 'counter')
+            for value, count in sorted(values.items()):
+                lines.append('%s%s %d' % (name, _label(label, value), count))
+        histograms = (
+            ('request_duration', 'Time of handling a request', self.request_time),
+            ('connect_duration', 'Time of connecting to a proxy', self.connect_time),
+            ('loop_lag', 'Delay of the event loop', self.loop_lag),
+        )
+        for name, help, histogram in histograms:
+            name = 'proxybroker_%s_seconds' % name
+            self._header(lines, name, help, 'histogram')
+            lines.extend(histogram.render(name))
+        for name, help, func, label in self._gauges:
+            self._header(lines, name, help, 'gauge')
+            value = func()
+            if label is None:
+                lines.append('%s %s' % (name, value))
+                continue
+            for key, count in sorted(value.items()):
+                lines.append('%s%s %s' % (name, _label(label, key), count))
+        return '\n'.join(lines) + '\n'
+
+    def _header(self, lines, name, help, kind):
+        lines.append('# HELP %s %s.' % (name, help))
+        lines.append('# TYPE %s %s' % (name, kind))
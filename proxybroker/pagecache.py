@@ -0,0 +1,83 @@
+"""Cache of the pages received from providers, to replay them offline."""
+
+import hashlib
+import json
+import os
+import time
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from .utils import log, write_atomic
+
+__all__ = ['PageCache']
+
+# Query parameters only defeating caches (e.g. ts of Openproxy_space), which
+# would give the same request a new record each time
+VOLATILE_PARAMS = {'_', 'ts', 'timestamp'}
+
+
+def _digest(text):
+    return hashlib.sha256(text.encode('utf-8', 'surrogatepass')).hexdigest()
+
+
+def _stable_url(url):
+    parts = urlsplit(url)
+    query = parse_qsl(parts.query, keep_blank_values=True)
+    stable = [(k, v) for k, v in query if k not in VOLATILE_PARAMS]
+    if len(stable) == len(query):
+        return url
+    return urlunsplit(parts._replace(query=urlencode(stable)))
+
+
+class PageCache:
+    """Pages of providers on disk, stored by the hash of their content.
+
+    A request (method, url and data) is recorded with the hash of its page,
+    so the same page received from other URLs or later is stored once.
+    The cache-busting parameters of ``VOLATILE_PARAMS`` are left out of the
+    url of the record.
+
+    :param str path: Directory of the cache, created if missing
+    :param int ttl:
+        Seconds a page is served from the cache before it's received again
+    :param bool replay:
+        Serve the pages only from the cache, regardless of their age.
+        The requests that aren't recorded get an empty page
+    """
+
+    def __init__(self, path, ttl=3600, replay=False):
+        self.path = path
+        self.ttl = ttl
+        self.replay = replay
+        for name in ('pages', 'requests'):
+            os.makedirs(os.path.join(path, name), exist_ok=True)
+
+    def get(self, url, data=None, method='GET'):
+        """Return the recorded page, or None if it's missing or expired."""
+        try:
+            with open(self._record_path(url, data, method)) as f:
+                record = json.load(f)
+            if not self.replay and time.time() - record['time'] > self.ttl:
+                return None
+            with open(self._page_path(record['page'])) as f:
+                return f.read()
+        except (OSError, ValueError, KeyError) as e:
+            log.debug('%s is not in the page cache. Error: %r;' % (url, e))
+            return None
+
+    def put(self, url, page, data=None, method='GET'):
+        digest = _digest(page)
+        record = {'url': url, 'method': method, 'time': time.time(), 'page': digest}
+        try:
+            if not os.path.exists(self._page_path(digest)):
+                write_atomic(self._page_path(digest), page)
+            write_atomic(self._record_path(url, data, method), json.dumps(record))
+        except (OSError, UnicodeError) as e:
+            log.warning('Failed to store the page of %s: %r' % (url, e))
+
+    def _record_path(self, url, data, method):
+        request = [method, _stable_url(url), data]
+        request = json.dumps(request, sort_keys=True, default=str)
+        return os.path.join(self.path, 'requests', _digest(request) + '.json')
+
+    def _page_path(self, digest):
+        return os.path.join(self.path, 'pages', digest)
@@ -1,10 +1,12 @@
 import asyncio
+import multiprocessing
 import os
 import re
 import warnings
 import time
 import json
 from base64 import b64decode
+from concurrent.futures import ProcessPoolExecutor
 from html import unescape
 from math import sqrt
 from urllib.parse import unquote, urlparse
@@ -12,7 +14,25 @@ from urllib.parse import unquote, urlparse
 import aiohttp
 
 from .errors import BadStatusError
-from .utils import IPPattern, IPPortPatternGlobal, get_headers, log
+from .utils import IPPattern, IPPortTokenizer, get_headers, log
+
+# Pages of this length and longer are parsed in a thread, not to block the loop
+PARSE_IN_THREAD_SIZE = 65536
+
+_processes = None
+
+
+def _get_processes():
+    global _processes
+    if _processes is None:
+        _processes = ProcessPoolExecutor()
+    return _processes
+
+
+def _find_proxies(cls, page):
+    # Runs in a worker process. The providers parsing there keep no state
+    # out of the page, so an instance without a session will do
+    return cls.find_proxies(object.__new__(cls), page)
 
 
 class Provider:
@@ -25,17 +45,32 @@ class Provider:
         (optional) List of the types (protocols) that may be supported
         by proxies returned by the provider. Then used as :attr:`Proxy.types`
     :param int max_conn:
-        (optional) The maximum number of concurrent connections on the provider
+        (optional) The maximum number of concurrent connections on the provider,
+        also when it's called with a shared session
     :param int max_tries:
         (optional) The maximum number of attempts to receive response
     :param int timeout:
         (optional) Timeout of a request in seconds
+    :param bool stream:
+        (optional) Find proxies in the lines of pages while they're received,
+        for plain-text lists
     """
 
-    _pattern = IPPortPatternGlobal
+    _pattern = IPPortTokenizer()
+    # A regex holds the GIL until it ends, so the thread parsing a large page
+    # with whole page regexes blocks the loop as much as parsing on it does.
+    # These providers parse large pages in a process instead
+    _parse_in_process = False
 
     def __init__(
-        self, url=None, proto=(), max_conn=4, max_tries=3, timeout=20, loop=None
+        self,
+        url=None,
+        proto=(),
+        max_conn=4,
+        max_tries=3,
+        timeout=20,
+        loop=None,
+        stream=False,
     ):
         if url:
             self.domain = urlparse(url).netloc
@@ -43,11 +78,20 @@ class Provider:
         self.proto = proto
         self._max_tries = max_tries
         self._timeout = timeout
+        self._max_conn = max_conn
+        self._stream = stream
         self._session = None
+        self._pages = None
+        self._headers = {}
         self._cookies = {}
         self._proxies = set()
-        # concurrent connections on the current provider
-        self._sem_provider = asyncio.Semaphore(max_conn)
+        # Function called with the new proxies, and the proxies passed to it
+        self._found = None
+        self._reported = set()
+        # find_proxies of some providers keeps the state of a page in self
+        self._parsing = asyncio.Lock()
+        # The session may be shared, so its connection limit is not enough
+        self._requests = asyncio.Semaphore(max_conn)
         self._loop = loop or asyncio.get_event_loop()
 
     @property
@@ -69,18 +113,45 @@ class Provider:
     def proxies(self, new):
         new = [(host, port, self.proto) for host, port in new if port]
         self._proxies.update(new)
+        if self._found is None:
+            return
+        for proxy in new:
+            if proxy not in self._reported:
+                self._reported.add(proxy)
+                self._found(proxy)
 
-    async def get_proxies(self):
+    async def get_proxies(self, session=None, found=None, pages=None):
         """Receive proxies from the provider and return them.
 
+        :param session:
+            (optional) :class:`aiohttp.ClientSession` shared by the providers,
+            so their connections are kept alive between the grab cycles.
+            By default, a session is opened for the call
+        :param found:
+            (optional) Function called with each proxy as soon as it's found,
+            once per call
+        :param pages:
+            (optional) :class:`~proxybroker.pagecache.PageCache` to receive
+            the pages from and to store them to
         :return: :attr:`.proxies`
         """
         log.debug('Try to get proxies from %s' % self.domain)
 
-        async with aiohttp.ClientSession(
-            headers=get_headers(), cookies=self._cookies, loop=self._loop
-        ) as self._session:
+        self._headers = get_headers()
+        self._found = found
+        self._pages = pages
+        self._reported = set()
+        if session is not None:
+            self._session = session
             await self._pipe()
+        else:
+            connector = aiohttp.TCPConnector(
+                limit_per_host=self._max_conn, loop=self._loop
+            )
+            async with aiohttp.ClientSession(
+                connector=connector, loop=self._loop
+            ) as self._session:
+                await self._pipe()
 
         log.debug(
             '%d proxies received from %s: %s'
@@ -105,40 +176,70 @@ class Provider:
         await asyncio.gather(*tasks)
 
     async def _find_on_page(self, url, data=None, headers=None, method='GET'):
-        page = await self.get(url, data=data, headers=headers, method=method)
-        if not page:
-            return
         oldcount = len(self.proxies)
+        if self._stream and self._pages is None:
+            received = await self._find_on_stream(
+                url, data=data, headers=headers, method=method
+            )
+        else:
+            page = await self.get(url, data=data, headers=headers, method=method)
+            if not page:
+                return
+            received = len(await self._find(page))
+        if not received:
+            log.error(f'Got 0 proxies from {url}')
+            return
+        added = len(self.proxies) - oldcount
+        log.debug('%d(%d) proxies added(received) from %s' % (added, received, url))
+
+    async def _find_on_stream(self, url, data=None, headers=None, method='GET'):
+        for _ in range(self._max_tries):
+            received = await self._get_lines(
+                url, data=data, headers=headers, method=method
+            )
+            if received:
+                break
+        return received
+
+    async def _find(self, page):
         try:
-            received = self.find_proxies(page)
+            received = await self._parse(page)
         except Exception as e:
             received = []
             log.error(
                 'Error when executing find_proxies.'
                 'Domain: %s; Error: %r' % (self.domain, e)
             )
-        if not received:
-            log.error(f'Got 0 proxies from {url}')
-            return
         self.proxies = received
-        added = len(self.proxies) - oldcount
-        log.debug(
-            '%d(%d) proxies added(received) from %s' % (added, len(received), url)
-        )
+        return received
 
     async def get(self, url, data=None, headers=None, method='GET'):
+        if self._pages is not None:
+            page = self._pages.get(url, data=data, method=method)
+            if page is not None:
+                return page
+            if self._pages.replay:
+                log.debug('%s is not recorded' % url)
+                return ''
         for _ in range(self._max_tries):
             page = await self._get(url, data=data, headers=headers, method=method)
             if page:
                 break
+        if page and self._pages is not None:
+            self._pages.put(url, page, data=data, method=method)
         return page
 
     async def _get(self, url, data=None, headers=None, method='GET'):
         page = ''
         try:
             timeout = aiohttp.ClientTimeout(total=self._timeout)
-            async with self._sem_provider, self._session.request(
-                method, url, data=data, headers=headers, timeout=timeout
+            async with self._requests, self._session.request(
+                method,
+                url,
+                data=data,
+                headers=dict(self._headers, **(headers or {})),
+                cookies=self._cookies,
+                timeout=timeout,
             ) as resp:
                 page = await resp.text()
                 if resp.status != 200:
@@ -159,6 +260,57 @@ class Provider:
             log.debug('%s is failed. Error: %r;' % (url, e))
         return page
 
+    async def _get_lines(self, url, data=None, headers=None, method='GET'):
+        """Find proxies in the lines of a page while it's being received.
+
+        :return: The number of proxies received
+        """
+        received = 0
+        buffer = bytearray()
+        try:
+            timeout = aiohttp.ClientTimeout(total=self._timeout)
+            async with self._requests, self._session.request(
+                method,
+                url,
+                data=data,
+                headers=dict(self._headers, **(headers or {})),
+                cookies=self._cookies,
+                timeout=timeout,
+            ) as resp:
+                if resp.status != 200:
+                    raise BadStatusError('Status: %s' % resp.status)
+                async for chunk in resp.content.iter_any():
+                    buffer += chunk
+                    # The last line may be incomplete until the next chunk
+                    end = buffer.rfind(b'\n') + 1
+                    if end:
+                        lines = buffer[:end].decode(errors='replace')
+                        del buffer[:end]
+                        received += len(await self._find(lines))
+                received += len(await self._find(buffer.decode(errors='replace')))
+        except (
+            BadStatusError,
+            asyncio.TimeoutError,
+            aiohttp.ClientOSError,
+            aiohttp.ClientPayloadError,
+            aiohttp.ClientResponseError,
+            aiohttp.ServerDisconnectedError,
+        ) as e:
+            log.debug('%s is failed. Error: %r;' % (url, e))
+        return received
+
+    async def _parse(self, page):
+        async with self._parsing:
+            if len(page) < PARSE_IN_THREAD_SIZE:
+                return self.find_proxies(page)
+            loop = asyncio.get_event_loop()
+            # Daemonic processes are not allowed to have children
+            if self._parse_in_process and not multiprocessing.current_process().daemon:
+                return await loop.run_in_executor(
+                    _get_processes(), _find_proxies, type(self), page
+                )
+            return await loop.run_in_executor(None, self.find_proxies, page)
+
     def find_proxies(self, page):
         return self._find_proxies(page)
 
@@ -211,6 +363,7 @@ class Checkerproxy_net(Provider):
 
 class Proxy_list_org(Provider):
     domain = 'proxy-list.org'
+    _parse_in_process = True
     _pattern = re.compile(r'''Proxy\('([\w=]+)'\)''')
 
     def find_proxies(self, page):
@@ -286,11 +439,8 @@ class Foxtools_ru(Provider):
 
 class Gatherproxy_com(Provider):
     domain = 'gatherproxy.com'
-    _pattern_h = re.compile(
-        r'''(?P<ip>(?:(?:25[0-5]|2[0-4]\d|[01]?\d\d?)\.){3}(?:25[0-5]|2[0-4]\d|[01]?\d\d?))'''  # noqa
-        r'''(?=.*?(?:(?:(?:(?:25[0-5]|2[0-4]\d|[01]?\d\d?)\.){3}(?:25[0-5]|2[0-4]\d|[01]?\d\d?))|'(?P<port>[\d\w]+)'))''',  # noqa
-        flags=re.DOTALL,
-    )
+    # The ports are quoted hex numbers
+    _pattern_h = IPPortTokenizer(port_pattern=re.compile(r"(?<=')\w+(?=')"))
 
     def find_proxies(self, page):
         # if 'gp.dep' in page:
@@ -345,6 +495,7 @@ class Gatherproxy_com_socks(Provider):
 
 class Xseo_in(Provider):
     domain = 'xseo.in'
+    _parse_in_process = True
     charEqNum = {}
 
     def char_js_port_to_num(self, matchobj):
@@ -367,14 +518,9 @@ class Xseo_in(Provider):
 
 class Nntime_com(Provider):
     domain = 'nntime.com'
+    _parse_in_process = True
     charEqNum = {}
-    _pattern = re.compile(
-        r'''\b(?P<ip>(?:(?:25[0-5]|2[0-4]\d|[01]?\d\d?)\.){3}'''
-        r'''(?:25[0-5]|2[0-4]\d|[01]?\d\d?))(?=.*?(?:(?:(?:(?:25'''
-        r'''[0-5]|2[0-4]\d|[01]?\d\d?)\.){3}(?:25[0-5]|2[0-4]\d|[01]?\d\d?)'''
-        r''')|(?P<port>\d{2,5})))''',
-        flags=re.DOTALL,
-    )
+    _pattern = IPPortTokenizer(re.compile(r'\b' + IPPattern.pattern))
 
     def char_js_port_to_num(self, matchobj):
         chars = matchobj.groups()[0]
@@ -413,6 +559,7 @@ class Proxynova_com(Provider):
 
 class Spys_ru(Provider):
     domain = 'spys.ru'
+    _parse_in_process = True
     charEqNum = {}
 
     def char_js_port_to_num(self, matchobj):
@@ -487,6 +634,7 @@ class My_proxy_com(Provider):
 
 class Free_proxy_cz(Provider):
     domain = 'free-proxy.cz'
+    _parse_in_process = True
     _pattern = re.compile(r'''decode\("([\w=]+)".*?\("([\d=]+)"\)''', flags=re.DOTALL)
 
     def find_proxies(self, page):
@@ -541,6 +689,7 @@ class DidsoftHttp(Provider):
 
 class Openproxy_space(Provider):
     domain = 'openproxy.space'
+    _parse_in_process = True
     _pattern = re.compile(r'\b(?P<ip>(?:(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.){3}(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?))'
                           r':(?:(?![7-9]\d{4})(?!6[6-9]\d{3})(?!65[6-9]\d{2})(?!655[4-9]\d)(?!6553[6-9])(?!0+)(?P<port>\d{1,5}))\b', flags=re.DOTALL)
 
@@ -623,14 +772,17 @@ PROVIDERS = [
     Provider(
         url='https://api.proxyscrape.com/?request=getproxies&proxytype=http',
         proto=('HTTP', 'CONNECT:80', 'HTTPS', 'CONNECT:25'),
+        stream=True,
     ),  # added by ZerGo0
     Provider(
         url='https://api.proxyscrape.com/?request=getproxies&proxytype=socks4',
         proto=('SOCKS4'),
+        stream=True,
     ),  # added by ZerGo0
     Provider(
         url='https://api.proxyscrape.com/?request=getproxies&proxytype=socks5',
         proto=('SOCKS5'),
+        stream=True,
     ),  # added by ZerGo0
     DidsoftHttp(
         proto=('HTTP', 'CONNECT:80', 'HTTPS', 'CONNECT:25'),
@@ -641,12 +793,15 @@ PROVIDERS = [
     ),  # 300   by Didsoft Ltd.
     Openproxy_space(
         proto=('HTTP', 'CONNECT:80', 'HTTPS', 'CONNECT:25'),
+        stream=True,
     ),
     Openproxy_space(
         proto=('SOCKS4'),
+        stream=True,
     ),
     Openproxy_space(
         proto=('SOCKS5'),
+        stream=True,
     ),
     XroxyHttp(
         proto=('HTTP', 'CONNECT:80', 'HTTPS', 'CONNECT:25'),
@@ -673,6 +828,7 @@ PROVIDERS = [
         url='http://pubproxy.com/api/proxy?limit=20&format=txt',
         proto=('HTTP', 'CONNECT:80', 'HTTPS', 'CONNECT:25'),
         max_conn=1,
+        stream=True,
     ),  # 20
     Proxy_list_org(proto=('HTTP', 'CONNECT:80', 'HTTPS', 'CONNECT:25')),  # noqa; 140
     Xseo_in(proto=('HTTP', 'CONNECT:80', 'HTTPS', 'CONNECT:25')),  # noqa; 240
@@ -681,7 +837,8 @@ PROVIDERS = [
     Proxylist_me(proto=('HTTP', 'CONNECT:80', 'HTTPS', 'CONNECT:25')),  # noqa; 2872
     Foxtools_ru(
         proto=('HTTP', 'CONNECT:80', 'HTTPS', 'CONNECT:25'),
-        max_conn=1
+        max_conn=1,
+        stream=True,
     ),  # noqa; 500
     Gatherproxy_com(proto=('HTTP', 'CONNECT:80', 'HTTPS', 'CONNECT:25')),  # noqa; 3212
     Nntime_com(proto=('HTTP', 'CONNECT:80', 'HTTPS', 'CONNECT:25')),  # noqa; 1050
@@ -692,14 +849,17 @@ PROVIDERS = [
     Webanetlabs_net(),  # noqa; 5000
     Proxylist_download(
         proto=('HTTP', 'CONNECT:80', 'HTTPS', 'CONNECT:25'),
+        stream=True,
     ),  # noqa; 35590
     Provider(
         url='https://www.proxy-list.download/api/v1/get?type=socks4',
         proto=('SOCKS4'),
+        stream=True,
     ),  # 53
     Provider(
         url='https://www.proxy-list.download/api/v1/get?type=socks5',
         proto=('SOCKS5'),
+        stream=True,
     ),  # 53
     Provider(
         url='http://www.proxylists.net/',
@@ -18,6 +18,8 @@ from .utils import log, parse_headers
 
 _HTTP_PROTOS = {'HTTP', 'CONNECT:80', 'SOCKS4', 'SOCKS5'}
 _HTTPS_PROTOS = {'HTTPS', 'SOCKS4', 'SOCKS5'}
+# The weight of the last sample in the moving averages of a proxy
+EWMA_ALPHA = 0.3
 
 
 class Proxy:
@@ -92,11 +94,13 @@ class Proxy:
         self._ssl_context = True if verify_ssl else _ssl._create_unverified_context()
         self._types = {}
         self._is_working = False
-        self.stat = {'requests': 0, 'errors': Counter()}
+        self.stat = {'requests': 0, 'errors': Counter(), 'bytes': Counter()}
         self._ngtr = None
         self._geo = Resolver.get_ip_info(self.host)
         self._log = []
         self._runtimes = []
+        self._ewma_resp_time = 0
+        self._ewma_throughput = 0
         self._schemes = ()
         self._closed = True
         self._reader = {'conn': None, 'ssl': None}
@@ -194,6 +198,31 @@ class Proxy:
             return 0
         return round(sum(self._runtimes) / len(self._runtimes), 2)
 
+    @property
+    def ewma_resp_time(self):
+        """The exponentially weighted moving average connection/response time.
+
+        Unlike :attr:`avg_resp_time`, recent requests weigh more.
+
+        :rtype: float
+
+        .. versionadded:: 0.4.0
+        """
+        return self._ewma_resp_time
+
+    @property
+    def throughput(self):
+        """The exponentially weighted moving average download speed.
+
+        In bytes per second, measured on the large responses only
+        (see :meth:`add_transfer`). Zero if it's not measured yet.
+
+        :rtype: float
+
+        .. versionadded:: 0.4.0
+        """
+        return self._ewma_throughput
+
     @property
     def avgRespTime(self):
         """
@@ -232,6 +261,59 @@ class Proxy:
     def ngtr(self, proto):
         self._ngtr = NGTRS[proto](self)
 
+    def get_state(self):
+        """Return the types and the stats of the proxy.
+
+        The state can be serialized to JSON and passed to :meth:`from_state`.
+
+        :rtype: dict
+
+        .. versionadded:: 0.4.0
+        """
+        return {
+            'host': self.host,
+            'port': self.port,
+            'types': dict(self.types),
+            'requests': self.stat['requests'],
+            'errors': dict(self.stat['errors']),
+            'runtimes': list(self._runtimes),
+            'ewma_resp_time': self._ewma_resp_time,
+            'bytes': dict(self.stat['bytes']),
+            'throughput': self._ewma_throughput,
+        }
+
+    @classmethod
+    def from_state(cls, state, **kwargs):
+        """Create a proxy with the state returned by :meth:`get_state`.
+
+        :param kwargs: (optional) Keyword arguments that :class:`Proxy` takes
+
+        .. versionadded:: 0.4.0
+        """
+        self = cls(state['host'], state['port'], **kwargs)
+        self.types.update(state['types'])
+        self.stat['requests'] = state['requests']
+        self.stat['errors'].update(state['errors'])
+        self._runtimes = list(state['runtimes'])
+        self._ewma_resp_time = state['ewma_resp_time']
+        self.stat['bytes'].update(state.get('bytes', {}))
+        self._ewma_throughput = state.get('throughput', 0)
+        return self
+
+    def decay(self, factor=0.5):
+        """Scale down the stats, so that new requests weigh more.
+
+        The numbers of requests and errors are multiplied by ``factor`` and
+        only that share of the latest runtimes is kept.
+
+        .. versionadded:: 0.4.0
+        """
+        self.stat['requests'] = int(self.stat['requests'] * factor)
+        errors = {e: int(n * factor) for e, n in self.stat['errors'].items()}
+        self.stat['errors'] = Counter({e: n for e, n in errors.items() if n})
+        keep = int(len(self._runtimes) * factor)
+        self._runtimes = self._runtimes[len(self._runtimes) - keep :]
+
     def as_json(self):
         """Return the proxy's properties in JSON format.
 
@@ -269,10 +351,29 @@ class Proxy:
         trunc = '...' if len(msg) > 58 else ''
         msg = '{msg:.60s}{trunc}'.format(msg=msg, trunc=trunc)
         self._log.append((ngtr, msg, runtime))
+        # Called on the proxy when logged by a ProxyConn
+        self._update_stat(msg, runtime, err)
+
+    def _update_stat(self, msg, runtime, err):
         if err:
             self.stat['errors'][err.errmsg] += 1
         if runtime and 'timeout' not in msg:
-            self._runtimes.append(runtime)
+            self._add_runtime(runtime)
+
+    def _add_runtime(self, runtime):
+        self._runtimes.append(runtime)
+        if self._ewma_resp_time:
+            self._ewma_resp_time += EWMA_ALPHA * (runtime - self._ewma_resp_time)
+        else:
+            self._ewma_resp_time = runtime
+
+    def add_transfer(self, size, duration):
+        """Count a response body of ``size`` bytes received in ``duration``."""
+        speed = size / max(duration, 0.001)
+        if self._ewma_throughput:
+            self._ewma_throughput += EWMA_ALPHA * (speed - self._ewma_throughput)
+        else:
+            self._ewma_throughput = speed
 
     def get_log(self):
         """Proxy log.
@@ -402,3 +503,39 @@ class Proxy:
                     if not body_size:
                         chunked = headers.get('Transfer-Encoding') == 'chunked'
         return resp
+
+
+class ProxyConn:
+    """Connection through a proxy.
+
+    Has its own streams and negotiator, while the stats, the log and
+    the other attributes are those of the proxy. So the server can open
+    several connections through one proxy at a time.
+
+    :param proxy: :class:`Proxy` object
+
+    .. versionadded:: 0.4.0
+    """
+
+    def __init__(self, proxy):
+        self.proxy = proxy
+        self._ngtr = None
+        self._closed = True
+        self._reader = {'conn': None, 'ssl': None}
+        self._writer = {'conn': None, 'ssl': None}
+
+    def __getattr__(self, name):
+        return getattr(self.proxy, name)
+
+    def __repr__(self):
+        return '<ProxyConn %r>' % self.proxy
+
+    writer = Proxy.writer
+    reader = Proxy.reader
+    ngtr = Proxy.ngtr
+    log = Proxy.log
+    connect = Proxy.connect
+    close = Proxy.close
+    send = Proxy.send
+    recv = Proxy.recv
+    _recv = Proxy._recv
@@ -0,0 +1,94 @@
+"""Rate limits of the requests passed through the proxies."""
+
+import time
+
+from cachetools import LRUCache
+
+__all__ = ['TokenBucket', 'RateLimiter']
+
+
+class TokenBucket:
+    """Allows ``rate`` events per second on average, up to ``burst`` at once.
+
+    A token is added every ``1 / rate`` seconds until there are ``burst``
+    of them. Taking a token from the empty bucket puts it in debt, which is
+    paid off by the next tokens.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+
+    @property
+    def tokens(self):
+        now = time.monotonic()
+        self._tokens = min(self._tokens + (now - self._updated) * self.rate, self.burst)
+        self._updated = now
+        return self._tokens
+
+    def ready(self):
+        """Whether there is a token to take."""
+        return self.tokens >= 1
+
+    def take(self):
+        self._tokens = self.tokens - 1
+
+
+class RateLimiter:
+    """Token buckets of the proxies and the (proxy, domain) pairs.
+
+    :param float rate:
+        Requests per second through a proxy. Zero disables the limit
+    :param float domain_rate:
+        Requests per second through a proxy to a domain.
+        Zero disables the limit
+    :param int max_buckets:
+        The maximum number of buckets of each kind; the least recently
+        used ones are forgotten, i.e. become full again
+    """
+
+    def __init__(self, rate=0, domain_rate=0, max_buckets=10000):
+        self._rate = rate
+        self._domain_rate = domain_rate
+        # (host, port) -> bucket
+        self._proxies = LRUCache(maxsize=max_buckets)
+        # (host, port, domain) -> bucket
+        self._domains = LRUCache(maxsize=max_buckets)
+
+    @property
+    def enabled(self):
+        return bool(self._rate or self._domain_rate)
+
+    @property
+    def interval(self):
+        """Seconds between the tokens of the fastest buckets, or None."""
+        rate = max(self._rate, self._domain_rate)
+        return 1 / rate if rate else None
+
+    def ready(self, proxy, domain=None):
+        """Whether a request can be passed through the proxy to the domain."""
+        return all(bucket.ready() for bucket in self._buckets(proxy, domain))
+
+    def take(self, proxy, domain=None):
+        """Count a request passed through the proxy to the domain."""
+        for bucket in self._buckets(proxy, domain):
+            bucket.take()
+
+    def _buckets(self, proxy, domain):
+        buckets = []
+        if self._rate:
+            buckets.append(
+                self._bucket(self._proxies, (proxy.host, proxy.port), self._rate)
+            )
+        if self._domain_rate and domain is not None:
+            key = (proxy.host, proxy.port, domain)
+            buckets.append(self._bucket(self._domains, key, self._domain_rate))
+        return buckets
+
+    def _bucket(self, buckets, key, rate):
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = TokenBucket(rate)
+        return bucket
@@ -0,0 +1,250 @@
+"""Relay of the data between two connections of a tunnel."""
+
+import asyncio
+import os
+
+from .utils import log
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+__all__ = ['relay', 'RelayProtocol']
+
+SPLICE_SIZE = 1 << 20
+# fcntl.F_SETPIPE_SZ is added in Python 3.10
+F_SETPIPE_SZ = 1031
+
+
+class RelayProtocol(asyncio.Protocol):
+    """Passes the data received from a transport straight to the peer one.
+
+    Reading is paused while the write buffer of the peer transport is full.
+    """
+
+    def __init__(self, tunnel, transport, index):
+        self._tunnel = tunnel
+        self._index = index
+        self.transport = transport
+        self.peer = None
+
+    def data_received(self, data):
+        self._tunnel.touch()
+        self._tunnel.received[self._index] += len(data)
+        self.peer.transport.write(data)
+
+    def eof_received(self):
+        self._tunnel.eof(self.peer.transport)
+        # Keep the transport open to write the data of the peer
+        return True
+
+    def pause_writing(self):
+        self.peer.transport.pause_reading()
+
+    def resume_writing(self):
+        self.peer.transport.resume_reading()
+
+    def connection_lost(self, exc):
+        self._tunnel.finish(exc)
+
+
+class _Splicer:
+    """Moves the data from a socket to another one through a pipe.
+
+    The data is not copied to the user space (Linux only).
+    """
+
+    flags = getattr(os, 'SPLICE_F_MOVE', 0) | getattr(os, 'SPLICE_F_NONBLOCK', 0)
+
+    def __init__(self, tunnel, src, dst, index, loop):
+        self._tunnel = tunnel
+        self._dst = dst
+        self._index = index
+        self._loop = loop
+        # The descriptors of the sockets are registered by their transports
+        self._fds = [os.dup(t.get_extra_info('socket').fileno()) for t in (src, dst)]
+        self._pipe = os.pipe()
+        for fd in self._pipe:
+            os.set_blocking(fd, False)
+        try:
+            self._size = fcntl.fcntl(self._pipe[1], F_SETPIPE_SZ, SPLICE_SIZE)
+        except OSError:
+            self._size = 65536
+        self._pending = 0
+        self._reading = self._writing = False
+
+    def start(self):
+        if not self._reading:
+            self._reading = True
+            self._loop.add_reader(self._fds[0], self._on_readable)
+
+    def pause(self):
+        if self._reading:
+            self._reading = False
+            self._loop.remove_reader(self._fds[0])
+
+    def stop(self):
+        self.pause()
+        if self._writing:
+            self._loop.remove_writer(self._fds[1])
+        for fd in self._fds + list(self._pipe):
+            os.close(fd)
+        self._fds, self._pipe = [], ()
+
+    def _on_readable(self):
+        try:
+            size = os.splice(self._fds[0], self._pipe[1], self._size, flags=self.flags)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            self._tunnel.finish(e)
+            return
+        self._tunnel.touch()
+        if not size:
+            self.pause()
+            self._tunnel.eof(self._dst)
+            return
+        self._tunnel.received[self._index] += size
+        self._pending += size
+        self._flush()
+
+    def _on_writable(self):
+        self._writing = False
+        self._loop.remove_writer(self._fds[1])
+        self._flush()
+
+    def _flush(self):
+        while self._pending:
+            try:
+                self._pending -= os.splice(
+                    self._pipe[0], self._fds[1], self._pending, flags=self.flags
+                )
+            except (BlockingIOError, InterruptedError):
+                # Don't read more until the peer is ready to receive
+                self.pause()
+                self._writing = True
+                self._loop.add_writer(self._fds[1], self._on_writable)
+                return
+            except OSError as e:
+                self._tunnel.finish(e)
+                return
+        self.start()
+
+
+class _Tunnel:
+    def __init__(self, transports, timeout, received, loop):
+        self.transports = transports
+        # The numbers of bytes received from each transport
+        self.received = received
+        self._timeout = timeout
+        self._loop = loop
+        self._done = loop.create_future()
+        self._last = loop.time()
+        self._eofs = set()
+        self._splicers = []
+        self._timer = loop.call_later(timeout, self._check_idle)
+
+    def touch(self):
+        self._last = self._loop.time()
+
+    def eof(self, peer):
+        """Pass EOF received from one side to the peer."""
+        self._eofs.add(peer)
+        if peer.can_write_eof() and len(self._eofs) < 2:
+            peer.write_eof()
+        else:
+            self.finish()
+
+    def finish(self, exc=None):
+        if self._done.done():
+            return
+        self._timer.cancel()
+        for splicer in self._splicers:
+            splicer.stop()
+        for transport in self.transports:
+            transport.close()
+        if exc is None:
+            self._done.set_result(None)
+        else:
+            self._done.set_exception(exc)
+
+    def _check_idle(self):
+        idle = self._loop.time() - self._last
+        if idle < self._timeout:
+            self._timer = self._loop.call_later(self._timeout - idle, self._check_idle)
+        elif self._eofs:
+            # One side has finished, the other one is not going to respond
+            self.finish()
+        else:
+            self.finish(asyncio.TimeoutError())
+
+    def start_protocols(self, readers):
+        protocols = [RelayProtocol(self, t, i) for i, t in enumerate(self.transports)]
+        protocols[0].peer, protocols[1].peer = protocols[1], protocols[0]
+        for protocol, reader in zip(protocols, readers):
+            protocol.transport.set_protocol(protocol)
+            if reader._paused:
+                protocol.transport.resume_reading()
+
+    def start_splicers(self):
+        first, second = self.transports
+        for transport in self.transports:
+            transport.pause_reading()
+        self._splicers = [
+            _Splicer(self, first, second, 0, self._loop),
+            _Splicer(self, second, first, 1, self._loop),
+        ]
+        for splicer in self._splicers:
+            splicer.start()
+
+
+def _can_splice(transports):
+    return hasattr(os, 'splice') and all(
+        t.get_extra_info('socket') is not None
+        and t.get_extra_info('sslcontext') is None
+        and t.get_write_buffer_size() == 0
+        for t in transports
+    )
+
+
+async def relay(first, second, timeout=8, splice=True, received=None, loop=None):
+    """Relay the data between two connections until both of them are closed.
+
+    The connections are switched from their streams to the protocols passing
+    the received data straight to the peer transport. If possible, the data
+    is moved between the sockets by the kernel instead (``os.splice``).
+
+    :param first: ``(reader, writer)`` of the first connection
+    :param second: ``(reader, writer)`` of the second connection
+    :param int timeout:
+        Seconds of inactivity after which the connections are closed
+    :param bool splice: Whether to use ``os.splice`` if it's available
+    :param list received:
+        (optional) Two counters of the bytes received from the first and
+        the second connection, increased while relaying
+    :raises asyncio.TimeoutError: If the connections are inactive for too long
+    """
+    loop = loop or asyncio.get_event_loop()
+    received = [0, 0] if received is None else received
+    readers = (first[0], second[0])
+    writers = (first[1], second[1])
+    # The data already read to the streams
+    for i, (reader, writer) in enumerate(zip(readers, reversed(writers))):
+        if reader._buffer:
+            received[i] += len(reader._buffer)
+            writer.write(bytes(reader._buffer))
+            reader._buffer.clear()
+    for writer in writers:
+        await writer.drain()
+
+    tunnel = _Tunnel([w.transport for w in writers], timeout, received, loop)
+    if splice and _can_splice(tunnel.transports):
+        log.debug('Relay by splicing')
+        tunnel.start_splicers()
+    else:
+        tunnel.start_protocols(readers)
+    for reader, writer in zip(readers, reversed(writers)):
+        if reader.at_eof():
+            tunnel.eof(writer.transport)
+    await tunnel._done
@@ -1,9 +1,12 @@
 import asyncio
-import heapq
+import json
 import time
+from collections import Counter, deque
+from urllib.parse import urlparse
 
 from cachetools import TTLCache
 
+from .cache import Recorder, ResponseCache
 from .errors import (
     BadResponseError,
     BadStatusError,
@@ -17,18 +20,134 @@ from .errors import (
     ProxyTimeoutError,
     ResolveError,
 )
+from .judge import Judge
+from .metrics import Metrics
+from .proxy import Proxy, ProxyConn
+from .ratelimit import RateLimiter
+from .relay import relay
 from .resolver import Resolver
-from .utils import log, parse_headers, parse_status_line
+from .strategies import STRATEGIES, HashRing, RoundRobinStrategy, TransferStrategy
+from .utils import (
+    get_status_code,
+    log,
+    parse_headers,
+    parse_status_line,
+    write_atomic,
+)
 
 # from pprint import pprint
 
 
 history = TTLCache(maxsize=10000, ttl=600)
 CONNECTED = b'HTTP/1.1 200 Connection established\r\n\r\n'
+# The smallest response body for which the throughput of a proxy is measured
+MIN_TRANSFER_SIZE = 65536
+# The protocols of the proxies without HTTP through which the probes are passed
+PROBE_PROTOS = ('CONNECT:80', 'SOCKS5', 'SOCKS4', 'HTTPS')
+SERVICE_UNAVAILABLE = (
+    b'HTTP/1.1 503 Service Unavailable\r\n'
+    b'Retry-After: 1\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+)
+
+
+def _is_keep_alive(headers):
+    conn = '%s %s' % (
+        headers.get('Connection', ''),
+        headers.get('Proxy-Connection', ''),
+    )
+    conn = conn.lower()
+    if headers['Version'] == 'HTTP/1.0':
+        return 'keep-alive' in conn
+    return 'close' not in conn
+
+
+def _is_chunked(headers):
+    return 'chunked' in headers.get('Transfer-Encoding', '').lower()
+
+
+def _has_no_body(headers, method):
+    status = headers['Status']
+    return method == 'HEAD' or status in (204, 304) or 100 <= status < 200
+
+
+def _has_length(headers, method):
+    """Whether the end of a response is known without closing the connection."""
+    return (
+        _has_no_body(headers, method)
+        or _is_chunked(headers)
+        or 'Content-Length' in headers
+    )
+
+
+def _remove_header(request, name):
+    """Remove a header from the head of a request."""
+    head, sep, body = request.partition(b'\r\n\r\n')
+    prefix = name.lower() + b':'
+    lines = [
+        line for line in head.split(b'\r\n') if not line.lower().startswith(prefix)
+    ]
+    return b'\r\n'.join(lines) + sep + body
+
+
+def _set_connection(head, value):
+    """Replace the Connection headers in the head of a message."""
+    lines = [
+        line
+        for line in head.split(b'\r\n')
+        if line and not line.lower().startswith((b'connection:', b'proxy-connection:'))
+    ]
+    lines.append(b'Connection: ' + value)
+    return b'\r\n'.join(lines) + b'\r\n\r\n'
 
 
 class ProxyPool:
-    """Imports and gives proxies from queue on demand."""
+    """Imports and gives proxies from queue on demand.
+
+    Proxies that have processed fewer than ``min_req_proxy`` requests are
+    given out first and in turn; the others are picked by the strategy.
+    See :data:`~proxybroker.strategies.STRATEGIES` for the available ones.
+
+    A proxy stays in the pool while it is in use, and can be given out again
+    until it processes ``max_concurrency`` requests at a time.
+
+    If ``session_ttl`` is set, the requests of a session are given the same
+    proxy while it stays in the pool. A new session, or one whose proxy has
+    been removed, is assigned a proxy by consistent hashing. While the proxy
+    of a session is busy with ``max_concurrency`` requests, the next proxy on
+    the ring is given instead.
+
+    The results of the requests are also counted per proxy and destination
+    domain (up to ``max_domain_stats`` pairs, each forgotten after
+    ``domain_stats_ttl`` seconds). A proxy whose error rate for a domain
+    exceeds ``max_error_rate`` is passed over for the requests to it while
+    other proxies are available, and given out for the other domains. A
+    session whose proxy fails for the domain is moved to another proxy.
+
+    A proxy exceeding ``max_error_rate`` or ``max_resp_time`` is moved to
+    quarantine for ``quarantine_time`` seconds, doubled on each next failure.
+    Then it's probed by a request to ``probe_url`` through it (see
+    :meth:`reprobe`); by default, to a working judge, or only by a connection
+    if there are none. A proxy that passes returns to the pool as a newcomer,
+    its stats scaled down to fewer than ``min_req_proxy`` requests, so that
+    it's ranked mostly by the new ones. Once it has served ``min_req_proxy``
+    requests without being rejected, its failures are forgotten, so its next
+    quarantine starts over. A proxy whose backoff would exceed
+    ``max_quarantine_time`` is removed. Zero ``quarantine_time`` removes
+    the failing proxies at once.
+
+    With ``rate_limit`` (requests per second through a proxy) or
+    ``domain_rate_limit`` (through a proxy to a domain), the proxies whose
+    token bucket is empty are passed over like the failing ones, so the load
+    is spread over the pool instead of waiting for the best proxies. Unlike
+    the failing ones, they aren't given out even if there are no others:
+    the requests wait for new tokens.
+
+    When no proxy is available, :meth:`get` waits for a new one from the
+    queue, and :attr:`demand` is set while it waits. Once the queue is over, it waits for a
+    proxy to be returned to the pool, and raises
+    :class:`~proxybroker.errors.NoProxyError` only if there are no proxies
+    of the scheme left.
+    """
 
     def __init__(
         self,
@@ -38,79 +157,604 @@ class ProxyPool:
         max_resp_time=8,
         min_queue=5,
         strategy='best',
+        max_concurrency=1,
+        session_ttl=0,
+        max_sessions=10000,
+        max_domain_stats=10000,
+        domain_stats_ttl=600,
+        quarantine_time=30,
+        max_quarantine_time=1800,
+        rate_limit=0,
+        domain_rate_limit=0,
+        payload_size=1048576,
+        probe_url=None,
     ):
+        if strategy not in STRATEGIES:
+            raise ValueError('`strategy` should be one of: %s' % ', '.join(STRATEGIES))
+        if max_concurrency < 1:
+            raise ValueError('`max_concurrency` should be greater than zero')
         self._proxies = proxies
-        self._pool = []
-        self._newcomers = []
+        # (host, port) -> proxy
+        self._pool = {}
+        # scheme -> number of proxies in the pool
+        self._schemes = Counter()
+        self._inflight = Counter()
+        self._newcomers = RoundRobinStrategy(self._inflight)
+        if STRATEGIES[strategy] is TransferStrategy:
+            self._ranked = TransferStrategy(self._inflight, payload_size)
+        else:
+            self._ranked = STRATEGIES[strategy](self._inflight)
         self._strategy = strategy
         self._min_req_proxy = min_req_proxy
         # if num of errors greater or equal 50% - proxy will be remove from pool
         self._max_error_rate = max_error_rate
         self._max_resp_time = max_resp_time
         self._min_queue = min_queue
+        self._max_concurrency = max_concurrency
+        if session_ttl:
+            # session -> (host, port)
+            self._sessions = TTLCache(maxsize=max_sessions, ttl=session_ttl)
+            self._ring = HashRing()
+        else:
+            self._sessions = self._ring = None
+        # (host, port, domain) -> [requests, errors]
+        self._domains = TTLCache(maxsize=max_domain_stats, ttl=domain_stats_ttl)
+        self._quarantine_time = quarantine_time
+        self._max_quarantine_time = max_quarantine_time
+        # (host, port) -> [proxy, time of the next probe]
+        self._quarantine = {}
+        # (host, port) -> number of times the proxy has failed
+        self._strikes = Counter()
+        # (host, port) -> requests of the proxy when it returned to the pool
+        self._probation = {}
+        self._probe_url = probe_url
+        self._resolver = None
+        self._limiter = RateLimiter(rate_limit, domain_rate_limit)
+        # No more proxies will come from the queue
+        self._exhausted = False
+        # Done when a proxy is returned to the pool or removed from it
+        self._changed = None
+        # The number of requests waiting for a proxy
+        self.waiting = 0
+        # Set while there are requests waiting for a proxy
+        self.demand = asyncio.Event()
+        # Set when a proxy is given out or removed, i.e. the supply is lower
+        self.drained = asyncio.Event()
+        # Called with a proxy removed from the pool for good
+        self.on_remove = None
+
+    def __len__(self):
+        return len(self._pool)
+
+    def __iter__(self):
+        return iter(list(self._pool.values()))
 
-        if strategy != 'best':
-            raise ValueError('`strategy` only support `best` for now.')
+    @property
+    def sticky(self):
+        """Whether the requests of a session are given the same proxy."""
+        return self._sessions is not None
 
-    async def get(self, scheme):
+    @property
+    def available(self):
+        """The number of proxies that can be given out right now."""
+        return len(self._newcomers) + len(self._ranked)
+
+    @property
+    def supply(self):
+        """The number of proxies available now and waiting in the queue."""
+        return self.available + self._proxies.qsize()
+
+    @property
+    def quarantined(self):
+        """The number of proxies waiting for a probe to return to the pool."""
+        return len(self._quarantine)
+
+    @property
+    def by_scheme(self):
+        """The numbers of proxies in the pool by scheme."""
+        return self._schemes
+
+    @property
+    def groups(self):
+        """The numbers of newcomers, ranked proxies and proxies in use."""
+        return {
+            'newcomers': len(self._newcomers),
+            'ranked': len(self._ranked),
+            'in_use': len(self._inflight),
+        }
+
+    async def get(self, scheme, session=None, domain=None, timeout=None):
+        """Return a proxy supporting the scheme, waiting for one if needed.
+
+        :param float timeout: (optional) Seconds to wait for a proxy
+        :raises asyncio.TimeoutError: If no proxy is available in time
+        :raises NoProxyError: If no more proxies of the scheme will come
+        """
+        chosen = None
+        if session is not None and self._sessions is not None:
+            chosen = self._get_sticky(scheme.upper(), session, domain)
+            if chosen is not None:
+                self._take(chosen, domain)
+                return chosen
+        if self.available >= self._min_queue or self._exhausted:
+            chosen = self.get_nowait(scheme, domain)
+        if chosen is None:
+            self.waiting += 1
+            self.demand.set()
+            try:
+                chosen = await asyncio.wait_for(
+                    self._wait(scheme.upper(), domain), timeout
+                )
+            except asyncio.TimeoutError:
+                # The pool may have fewer than min_queue proxies available
+                chosen = self.get_nowait(scheme, domain)
+                if chosen is None:
+                    raise
+            finally:
+                self.waiting -= 1
+                if not self.waiting:
+                    self.demand.clear()
+        return chosen
+
+    def get_nowait(self, scheme, domain=None, max_skips=10):
+        """Return an available proxy without importing new ones, or None.
+
+        Up to ``max_skips`` proxies failing for the domain or exceeding
+        the rate limits are passed over. If the next one is passed over too,
+        or there are no others, the best one failing for the domain is
+        still given, but none exceeding the rate limits.
+        """
         scheme = scheme.upper()
-        if len(self._pool) + len(self._newcomers) < self._min_queue:
+        skipped = []
+        while True:
+            chosen = self._newcomers.pick(scheme) or self._ranked.pick(scheme)
+            if chosen is None or not self._is_skipped(chosen, domain):
+                break
+            skipped.append(chosen)
+            self._newcomers.discard(chosen)
+            self._ranked.discard(chosen)
+            if len(skipped) > max_skips:
+                chosen = None
+                break
+        for proxy in skipped:
+            self._add(proxy)
+        if chosen is None and skipped:
+            chosen = next((p for p in skipped if not self._is_limited(p, domain)), None)
+        if chosen is not None:
+            self._take(chosen, domain)
+        return chosen
+
+    def count(self, proxy, domain, failed):
+        """Count the result of a request through the proxy to the domain."""
+        key = (proxy.host, proxy.port, domain)
+        stat = self._domains.get(key)
+        if stat is None:
+            stat = self._domains[key] = [0, 0]
+        stat[0] += 1
+        stat[1] += failed
+
+    def stick(self, session, proxy):
+        """Give the proxy for the next requests of the session."""
+        if self._sessions is not None:
+            self._sessions[session] = (proxy.host, proxy.port)
+
+    def _is_skipped(self, proxy, domain):
+        if domain is not None and self._is_failing(proxy, domain):
+            return True
+        return self._is_limited(proxy, domain)
+
+    def _is_limited(self, proxy, domain):
+        return self._limiter.enabled and not self._limiter.ready(proxy, domain)
+
+    def _is_failing(self, proxy, domain):
+        requests, errors = self._domains.get((proxy.host, proxy.port, domain), (0, 0))
+        return (
+            requests >= self._min_req_proxy and errors / requests > self._max_error_rate
+        )
+
+    def _get_sticky(self, scheme, session, domain=None, max_skips=10):
+        """Return the proxy of the session, or the next one on the ring.
+
+        Up to ``max_skips`` proxies busy with ``max_concurrency`` requests,
+        exceeding the rate limits or failing for the domain are passed over;
+        None if all of them are. A session whose proxy fails for the domain
+        is moved to the proxy given instead.
+        """
+        key = self._sessions.get(session)
+        proxy = self._pool.get(key) if key else None
+        if proxy is not None and self._can_stick(proxy, scheme, domain):
+            return proxy
+        failing = proxy is not None and self._is_failing(proxy, domain)
+        walked = set()
+        for proxy in self._ring.walk(session):
+            if proxy in walked:
+                continue
+            if self._can_stick(proxy, scheme, domain):
+                if failing:
+                    self.stick(session, proxy)
+                return proxy
+            walked.add(proxy)
+            if len(walked) >= max_skips:
+                break
+        return None
+
+    def _can_stick(self, proxy, scheme, domain):
+        return (
+            scheme in proxy.schemes
+            and self._inflight[(proxy.host, proxy.port)] < self._max_concurrency
+            and not self._is_skipped(proxy, domain)
+        )
+
+    async def _wait(self, scheme, domain):
+        if not self._exhausted:
             chosen = await self._import(scheme)
-        elif len(self._newcomers) > 0:
-            chosen = self._newcomers.pop(0)
-        elif self._strategy == 'best':
-            for priority, proxy in self._pool:
-                if scheme in proxy.schemes:
-                    chosen = proxy
-                    self._pool.remove((proxy.priority, proxy))
-                    break
-            else:
-                chosen = await self._import(scheme)
+            if chosen is not None:
+                self._take(chosen, domain)
+                return chosen
+        # Wait for a proxy in use or in quarantine to be returned
+        while True:
+            chosen = self.get_nowait(scheme, domain)
+            if chosen is not None:
+                return chosen
+            if not self._schemes[scheme] and not any(
+                scheme in proxy.schemes for proxy, _ in self._quarantine.values()
+            ):
+                raise NoProxyError('No more available proxies')
+            if self._changed is None or self._changed.done():
+                self._changed = asyncio.get_event_loop().create_future()
+            # Shielded, it's shared by the waiting requests. The proxies
+            # exceeding the rate limits are available again with new tokens
+            try:
+                await asyncio.wait_for(
+                    asyncio.shield(self._changed), self._limiter.interval
+                )
+            except asyncio.TimeoutError:
+                pass
 
-        return chosen
+    def _notify(self):
+        if self._changed is not None and not self._changed.done():
+            self._changed.set_result(None)
 
     async def _import(self, expected_scheme):
+        """Return a new proxy from the queue, or None if it's over."""
         while True:
             proxy = await self._proxies.get()
             self._proxies.task_done()
             if not proxy:
-                raise NoProxyError('No more available proxies')
+                self._exhausted = True
+                return None
+            elif (proxy.host, proxy.port) in self._pool or (
+                (proxy.host, proxy.port) in self._quarantine
+            ):
+                # Restored from a snapshot, keep its stats
+                continue
             elif expected_scheme not in proxy.schemes:
                 self.put(proxy)
             else:
                 return proxy
 
     def put(self, proxy):
+        key = (proxy.host, proxy.port)
+        if key in self._inflight:
+            self._inflight[key] -= 1
+            if not self._inflight[key]:
+                del self._inflight[key]
+            if key not in self._pool:
+                # removed while it was in use
+                return
+        self._check(proxy)
+
+    def refresh(self):
+        """Re-evaluate the proxies that are not in use.
+
+        Their stats may have been changed elsewhere, e.g. by other workers.
+        """
+        for key, proxy in list(self._pool.items()):
+            if key not in self._inflight:
+                self._check(proxy)
+
+    def remove(self, host, port):
+        self._strikes.pop((host, port), None)
+        self._probation.pop((host, port), None)
+        entry = self._quarantine.pop((host, port), None)
+        self._notify()
+        proxy = self._discard(host, port) or (entry and entry[0])
+        if proxy and self.on_remove:
+            self.on_remove(proxy)
+        return proxy
+
+    async def reprobe(self):
+        """Probe the quarantined proxies whose backoff has expired."""
+        now = time.time()
+        due = [proxy for proxy, until in self._quarantine.values() if until <= now]
+        if not due:
+            return
+        results = await asyncio.gather(*[self._probe(proxy) for proxy in due])
+        for proxy, passed in zip(due, results):
+            key = (proxy.host, proxy.port)
+            if key not in self._quarantine:
+                # removed while it was probed
+                continue
+            if passed:
+                del self._quarantine[key]
+                requests = proxy.stat['requests']
+                if requests >= self._min_req_proxy:
+                    proxy.decay(max(self._min_req_proxy - 1, 0) / requests)
+                self._probation[key] = proxy.stat['requests']
+                self._add(proxy)
+                log.debug('%s:%d returned to proxy pool', *key)
+            else:
+                self._isolate(proxy)
+
+    def get_state(self):
+        """Return the states of the proxies in the pool.
+
+        See :meth:`~proxybroker.proxy.Proxy.get_state`.
+        """
+        proxies = list(self._pool.values())
+        proxies.extend(proxy for proxy, _ in self._quarantine.values())
+        return [proxy.get_state() for proxy in proxies]
+
+    def load_state(self, states, **kwargs):
+        """Add the proxies with the states returned by :meth:`get_state`.
+
+        :param kwargs: Keyword arguments that :class:`~proxybroker.proxy.Proxy` takes
+        """
+        for state in states:
+            try:
+                proxy = Proxy.from_state(state, **kwargs)
+            except (KeyError, TypeError, ValueError) as e:
+                log.warning('Skip the proxy state %r: %r' % (state, e))
+                continue
+            self.put(proxy)
+
+    def top(self, scheme, n):
+        """Return up to n ranked proxies supporting the scheme, the best first."""
+        return self._ranked.top(scheme.upper(), n)
+
+    def _check(self, proxy):
         is_exceed_time = (proxy.error_rate > self._max_error_rate) or (
             proxy.avg_resp_time > self._max_resp_time
         )
+        if proxy.stat['requests'] >= self._min_req_proxy and is_exceed_time:
+            self._discard(proxy.host, proxy.port)
+            self._isolate(proxy)
+        else:
+            self._add(proxy)
+            self._pardon(proxy)
+
+        log.debug('%s:%d stat: %s', proxy.host, proxy.port, proxy.stat)
+
+    def _pardon(self, proxy):
+        """Forget the failures of a returned proxy that serves requests again."""
+        key = (proxy.host, proxy.port)
+        returned = self._probation.get(key)
+        if returned is None:
+            return
+        if proxy.stat['requests'] - returned >= self._min_req_proxy:
+            del self._probation[key]
+            self._strikes.pop(key, None)
+            log.debug('%s:%d failures are forgotten', *key)
+
+    def _isolate(self, proxy):
+        key = (proxy.host, proxy.port)
+        self._probation.pop(key, None)
+        self._strikes[key] += 1
+        backoff = self._quarantine_time * 2 ** (self._strikes[key] - 1)
+        if not backoff or backoff > self._max_quarantine_time:
+            self._quarantine.pop(key, None)
+            del self._strikes[key]
+            self._notify()
+            if self.on_remove:
+                self.on_remove(proxy)
+            log.debug('%s:%d removed from proxy pool', *key)
+        else:
+            self._quarantine[key] = [proxy, time.time() + backoff]
+            log.debug('%s:%d quarantined for %ds', proxy.host, proxy.port, backoff)
+
+    async def _probe(self, proxy):
+        """Pass a request to the probe URL through the proxy.
+
+        :return: Whether the proxy has relayed the response
+        """
+        url = self._probe_url
+        if url is None and Judge.available['HTTP']:
+            url = Judge.get_random('HTTP').url
+        conn = ProxyConn(proxy)
+        try:
+            await conn.connect()
+            if url is not None:
+                await self._request(conn, urlparse(url))
+        except (
+            ProxyTimeoutError,
+            ProxyConnError,
+            ProxyRecvError,
+            ProxySendError,
+            ProxyEmptyRecvError,
+            BadStatusError,
+            BadResponseError,
+            ResolveError,
+        ):
+            return False
+        finally:
+            conn.close()
+        return True
+
+    async def _request(self, conn, url):
+        if 'HTTP' in conn.proxy.types:
+            target = url.geturl()
+        else:
+            proto = next((p for p in PROBE_PROTOS if p in conn.proxy.types), None)
+            if proto is None:
+                # The proxy can't relay HTTP, the connection is enough
+                return
+            if self._resolver is None:
+                self._resolver = Resolver()
+            ip = await self._resolver.resolve(url.hostname)
+            conn.ngtr = proto
+            await conn.ngtr.negotiate(host=url.hostname, port=url.port or 80, ip=ip)
+            target = url.path or '/'
+            if url.query:
+                target += '?' + url.query
+        await conn.send(
+            'GET %s HTTP/1.1\r\nHost: %s\r\nConnection: close\r\n\r\n'
+            % (target, url.netloc)
+        )
+        code = get_status_code(await conn.recv(head_only=True))
+        if not 200 <= code < 400:
+            raise BadStatusError('Status: %s' % code)
+
+    def _take(self, proxy, domain=None):
+        self._inflight[(proxy.host, proxy.port)] += 1
+        if self._limiter.enabled:
+            self._limiter.take(proxy, domain)
+        self._add(proxy)
+        self.drained.set()
+
+    def _add(self, proxy):
+        if (proxy.host, proxy.port) not in self._pool:
+            self._schemes.update(proxy.schemes)
+            if self._ring is not None:
+                self._ring.add(proxy)
+        self._pool[(proxy.host, proxy.port)] = proxy
         if proxy.stat['requests'] < self._min_req_proxy:
-            self._newcomers.append(proxy)
-        elif proxy.stat['requests'] >= self._min_req_proxy and is_exceed_time:
-            log.debug('%s:%d removed from proxy pool' % (proxy.host, proxy.port))
+            strategy, other = self._newcomers, self._ranked
         else:
-            heapq.heappush(self._pool, (proxy.priority, proxy))
+            strategy, other = self._ranked, self._newcomers
+        other.discard(proxy)
+        if self._inflight[(proxy.host, proxy.port)] < self._max_concurrency:
+            strategy.add(proxy)
+            self._notify()
+        else:
+            strategy.discard(proxy)
 
-        log.debug('%s:%d stat: %s' % (proxy.host, proxy.port, proxy.stat))
+    def _discard(self, host, port):
+        proxy = self._pool.pop((host, port), None)
+        if proxy is not None:
+            self._schemes.subtract(proxy.schemes)
+            self._newcomers.discard(proxy)
+            self._ranked.discard(proxy)
+            if self._ring is not None:
+                self._ring.discard(proxy)
+            self._notify()
+            self.drained.set()
+        return proxy
 
-    def remove(self, host, port):
-        for proxy in self._newcomers:
-            if proxy.host == host and proxy.port == port:
-                chosen = proxy
-                self._newcomers.remove(proxy)
-                break
+
+class Traffic:
+    """Bytes relayed for a request, and the time the response started."""
+
+    def __init__(self):
+        self.bytes = Counter()
+        self.started = None
+
+    def add(self, direction, size):
+        self.bytes[direction] += size
+        if direction == 'downstream' and self.started is None:
+            self.started = time.time()
+
+
+class ConnPool:
+    """Keeps idle keep-alive connections through the proxies for reuse.
+
+    :param int max_idle:
+        (optional) The maximum number of idle connections per proxy.
+        Zero disables the pool
+    :param int idle_timeout:
+        (optional) Seconds after which an idle connection is closed
+    """
+
+    def __init__(self, max_idle=0, idle_timeout=30):
+        self._max_idle = max_idle
+        self._idle_timeout = idle_timeout
+        # (host, port) -> deque of [conn, idle since, used before]
+        self._idle = {}
+
+    def __len__(self):
+        return sum(map(len, self._idle.values()))
+
+    @property
+    def enabled(self):
+        return self._max_idle > 0
+
+    def idle(self, proxy):
+        """Return the number of idle connections through the proxy."""
+        return len(self._idle.get((proxy.host, proxy.port), ()))
+
+    def acquire(self, proxy):
+        """Return an idle connection through the proxy or None."""
+        conns = self._idle.get((proxy.host, proxy.port))
+        now = time.time()
+        while conns:
+            conn, since, used = conns.pop()
+            if self._is_alive(conn, now - since):
+                if used:
+                    # Initial connection is counted by ProxyConn.connect()
+                    proxy.stat['requests'] += 1
+                return conn
+            conn.close()
+        return None
+
+    def release(self, conn, used=True):
+        """Keep the connection for reuse or close it."""
+        key = (conn.host, conn.port)
+        conns = self._idle.setdefault(key, deque())
+        if len(conns) >= self._max_idle or not self._is_alive(conn, 0):
+            conn.close()
         else:
-            for priority, proxy in self._pool:
-                if proxy.host == host and proxy.port == port:
-                    chosen = proxy
-                    self._pool.remove((proxy.priority, proxy))
-                    break
+            conns.append([conn, time.time(), used])
+        if not conns:
+            del self._idle[key]
 
-        return chosen
+    async def prewarm(self, proxy):
+        """Establish a connection through the proxy ahead of demand."""
+        conn = ProxyConn(proxy)
+        try:
+            await conn.connect()
+        except (ProxyTimeoutError, ProxyConnError):
+            return
+        self.release(conn, used=False)
+
+    def expire(self):
+        """Close the connections that are idle for too long or closed."""
+        now = time.time()
+        for key, conns in list(self._idle.items()):
+            alive = deque()
+            for conn, since, used in conns:
+                if self._is_alive(conn, now - since):
+                    alive.append([conn, since, used])
+                else:
+                    conn.close()
+            if alive:
+                self._idle[key] = alive
+            else:
+                del self._idle[key]
+
+    def close(self):
+        for conns in self._idle.values():
+            for conn, *_ in conns:
+                conn.close()
+        self._idle.clear()
+
+    def _is_alive(self, conn, idle):
+        reader, writer = conn.reader, conn.writer
+        return (
+            idle < self._idle_timeout
+            and reader is not None
+            # the proxy has closed the connection or sent unexpected data
+            and not reader.at_eof()
+            and not reader._buffer
+            and not writer.transport.is_closing()
+        )
 
 
 class Server:
-    """Server distributes incoming requests to a pool of found proxies."""
+    """Server distributes incoming requests to a pool of found proxies.
+
+    The clients are answered by ``503 Service Unavailable`` right away when
+    there are ``max_clients`` connections already or ``max_waiting`` requests
+    are waiting for a proxy, and after waiting for ``wait_timeout`` seconds.
+    """
 
     def __init__(
         self,
@@ -123,9 +767,32 @@ class Server:
         min_req_proxy=5,
         max_error_rate=0.5,
         max_resp_time=8,
+        quarantine_time=30,
+        max_quarantine_time=1800,
+        probe_url=None,
+        rate_limit=0,
+        domain_rate_limit=0,
+        strategy='best',
+        payload_size=1048576,
+        max_concurrency=1,
+        max_idle_conns=0,
+        idle_timeout=30,
+        prewarm=0,
+        keepalive_timeout=0,
+        max_keepalive_requests=100,
+        max_header_size=65536,
+        hedge_percentile=0,
+        session_ttl=0,
         prefer_connect=False,
         http_allowed_codes=None,
         backlog=100,
+        max_clients=0,
+        max_waiting=0,
+        wait_timeout=30,
+        reuse_port=False,
+        cache_size=0,
+        snapshot_path=None,
+        snapshot_interval=60,
         loop=None,
         **kwargs,
     ):
@@ -135,37 +802,144 @@ class Server:
         self._timeout = timeout
         self._max_tries = max_tries
         self._backlog = backlog
+        self._max_clients = max_clients
+        self._max_waiting = max_waiting
+        self._wait_timeout = wait_timeout
+        self._reuse_port = reuse_port
         self._prefer_connect = prefer_connect
+        self._keepalive_timeout = keepalive_timeout
+        self._max_keepalive_requests = max(max_keepalive_requests, 1)
+        self._max_header_size = max_header_size
+        self._hedge_percentile = hedge_percentile
+        self._connect_times = deque(maxlen=100)
+        # client IP -> bytes relayed for it by direction
+        self.client_bytes = TTLCache(maxsize=10000, ttl=3600)
 
         self._server = None
         self._connections = {}
         self._proxy_pool = ProxyPool(
-            proxies, min_req_proxy, max_error_rate, max_resp_time, min_queue
+            proxies,
+            min_req_proxy,
+            max_error_rate,
+            max_resp_time,
+            min_queue,
+            strategy,
+            max_concurrency,
+            session_ttl,
+            quarantine_time=quarantine_time,
+            max_quarantine_time=max_quarantine_time,
+            rate_limit=rate_limit,
+            domain_rate_limit=domain_rate_limit,
+            payload_size=payload_size,
+            probe_url=probe_url,
         )
+        self._conn_pool = ConnPool(max_idle_conns, idle_timeout)
+        self._cache = ResponseCache(cache_size) if cache_size else None
+        self._prewarm = prewarm
+        self._maintainer = None
+        self._prober = None
+        self._lag_monitor = None
+        self._snapshot_path = snapshot_path
+        self._snapshot_interval = snapshot_interval
+        self._snapshotter = None
         self._resolver = Resolver(loop=self._loop)
         self._http_allowed_codes = http_allowed_codes or []
 
+        self.metrics = Metrics()
+        self.metrics.gauge(
+            'proxybroker_pool_proxies',
+            'Proxies in the pool',
+            lambda: self._proxy_pool.by_scheme,
+            label='scheme',
+        )
+        self.metrics.gauge(
+            'proxybroker_pool_groups',
+            'Proxies in the pool by group',
+            lambda: self._proxy_pool.groups,
+            label='group',
+        )
+        self.metrics.gauge(
+            'proxybroker_pool_queue',
+            'Checked proxies waiting to be imported to the pool',
+            proxies.qsize,
+        )
+        self.metrics.gauge(
+            'proxybroker_waiting_requests',
+            'Requests waiting for a proxy',
+            lambda: self._proxy_pool.waiting,
+        )
+        self.metrics.gauge(
+            'proxybroker_pool_quarantined',
+            'Proxies waiting for a probe to return to the pool',
+            lambda: self._proxy_pool.quarantined,
+        )
+        if self._cache is not None:
+            self.metrics.gauge(
+                'proxybroker_cache_bytes',
+                'Size of the cached responses',
+                lambda: self._cache.size,
+            )
+
     def start(self):
+        if self._snapshot_path:
+            self._load_snapshot()
 
         srv = asyncio.start_server(
             self._accept,
             host=self.host,
             port=self.port,
             backlog=self._backlog,
+            limit=self._max_header_size,
+            reuse_port=self._reuse_port,
             loop=self._loop,
         )
         self._server = self._loop.run_until_complete(srv)
+        if self._conn_pool.enabled:
+            self._maintainer = asyncio.ensure_future(self._maintain_conns())
+        self._prober = asyncio.ensure_future(self._reprobe())
+        self._lag_monitor = asyncio.ensure_future(self._monitor_lag())
+        if self._snapshot_path:
+            self._snapshotter = asyncio.ensure_future(self._save_snapshots())
 
         log.info(
             'Listening established on {0}'.format(self._server.sockets[0].getsockname())
         )
 
+    @property
+    def demand(self):
+        """Event set while there are requests waiting for a proxy."""
+        return self._proxy_pool.demand
+
+    @property
+    def supply(self):
+        """The number of proxies available to the pool."""
+        return self._proxy_pool.supply
+
+    @property
+    def drained(self):
+        """Event set when the pool gives out or removes a proxy."""
+        return self._proxy_pool.drained
+
     def stop(self):
         if not self._server:
             return
         for conn in self._connections:
             if not conn.done():
                 conn.cancel()
+        if self._maintainer:
+            self._maintainer.cancel()
+            self._maintainer = None
+        if self._prober:
+            self._prober.cancel()
+            self._prober = None
+        if self._lag_monitor:
+            self._lag_monitor.cancel()
+            self._lag_monitor = None
+        if self._snapshotter:
+            self._snapshotter.cancel()
+            self._snapshotter = None
+            self._save_snapshot()
+        self._conn_pool.close()
         self._server.close()
         if not self._loop.is_running():
             self._loop.run_until_complete(self._server.wait_closed())
@@ -191,6 +965,12 @@ class Server:
                 else:
                     raise exc
 
+        if self._max_clients and len(self._connections) >= self._max_clients:
+            self.metrics.rejected['clients'] += 1
+            client_writer.write(SERVICE_UNAVAILABLE)
+            client_writer.close()
+            return
+
         f = asyncio.ensure_future(self._handle(client_reader, client_writer))
         f.add_done_callback(_on_completion)
         self._connections[f] = (client_reader, client_writer)
@@ -200,7 +980,46 @@ class Server:
             'Accepted connection from %s' % (client_writer.get_extra_info('peername'),)
         )
 
-        request, headers = await self._parse_request(client_reader)
+        for num in range(self._max_keepalive_requests):
+            try:
+                request, headers = await self._parse_request(
+                    client_reader, timeout=self._keepalive_timeout if num else None
+                )
+            except (
+                asyncio.IncompleteReadError,
+                asyncio.TimeoutError,
+                ConnectionResetError,
+            ):
+                # the client has closed the connection or it is idle for too long
+                return
+            except asyncio.LimitOverrunError:
+                client_writer.write(
+                    b'HTTP/1.1 431 Request Header Fields Too Large\r\n\r\n'
+                )
+                await client_writer.drain()
+                return
+            except (BadStatusLine, ValueError) as e:
+                log.debug('client: %d; bad request: %r' % (id(client_reader), e))
+                client_writer.write(b'HTTP/1.1 400 Bad Request\r\n\r\n')
+                await client_writer.drain()
+                return
+            keep_client = (
+                self._keepalive_timeout > 0
+                and num + 1 < self._max_keepalive_requests
+                and _is_keep_alive(headers)
+            )
+            if not await self._handle_request(
+                client_reader, client_writer, request, headers, keep_client
+            ):
+                return
+
+    async def _handle_request(
+        self, client_reader, client_writer, request, headers, keep_client
+    ):
+        """Pass the request to a proxy.
+
+        :return: True if the client connection is kept alive for the next request
+        """
         scheme = self._identify_scheme(headers)
         client = id(client_reader)
         log.debug(
@@ -210,7 +1029,8 @@ class Server:
 
         # API for controlling proxybroker2
         if headers['Host'] == 'proxycontrol':
-            _api, _operation, _params = headers['Path'].split('/', 5)[3:]
+            parts = headers['Path'].split('/', 5)[3:] + ['', '']
+            _api, _operation, _params = parts[:3]
             if _api == 'api':
                 if _operation == 'remove':
                     proxy_host, proxy_port = _params.split(':', 1)
@@ -249,35 +1069,145 @@ class Server:
                             client_writer.write(previous_proxy_bytestring + b'\r\n')
                             await client_writer.drain()
                             return
+                elif _operation == 'clients':
+                    body = json.dumps(
+                        {ip: dict(counts) for ip, counts in self.client_bytes.items()}
+                    ).encode()
+                    client_writer.write(b'HTTP/1.1 200 OK\r\n')
+                    client_writer.write(b'Content-Type: application/json\r\n')
+                    client_writer.write(b'Content-Length: %d\r\n\r\n' % len(body))
+                    client_writer.write(body)
+                    await client_writer.drain()
+                    return
+                elif _operation == 'metrics':
+                    body = self.metrics.render().encode()
+                    client_writer.write(b'HTTP/1.1 200 OK\r\n')
+                    client_writer.write(
+                        b'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                    )
+                    client_writer.write(b'Content-Length: %d\r\n\r\n' % len(body))
+                    client_writer.write(body)
+                    await client_writer.drain()
+                    return
+
+        session = None
+        if self._proxy_pool.sticky:
+            session = headers.get('X-Proxy-Session')
+            if session is not None:
+                request = _remove_header(request, b'X-Proxy-Session')
+            else:
+                session = client_writer.get_extra_info('peername')[0]
+
+        self.metrics.requests[scheme] += 1
+        started = time.time()
+        cache_key = None
+        if self._cache is not None and scheme == 'HTTP':
+            cache_key = ResponseCache.key(headers)
+        if cache_key is not None:
+            entry = await self._cache.get(cache_key, headers, self._timeout)
+            if entry is not None:
+                self.metrics.cache['hit'] += 1
+                try:
+                    client_keep = await self._send_cached(
+                        entry, client_writer, keep_client
+                    )
+                except ErrorOnStream:
+                    client_keep = False
+                self.metrics.request_time.observe(time.time() - started)
+                return client_keep
+            self.metrics.cache['miss'] += 1
+
+        # The next requests of the URL wait for the response to this one
+        locked = cache_key is not None and self._cache.lock(cache_key)
+        try:
+            succeeded, client_keep = await self._pass_request(
+                client_reader,
+                client_writer,
+                request,
+                headers,
+                scheme,
+                session,
+                keep_client,
+                cache_key,
+            )
+        finally:
+            if locked:
+                self._cache.unlock(cache_key)
+        if not succeeded:
+            self.metrics.failures[scheme] += 1
+        self.metrics.request_time.observe(time.time() - started)
+        return client_keep
+
+    async def _pass_request(
+        self,
+        client_reader,
+        client_writer,
+        request,
+        headers,
+        scheme,
+        session,
+        keep_client,
+        cache_key=None,
+    ):
+        """Pass the request through the proxies until one of them succeeds.
 
+        :return:
+            Whether the request succeeded, and whether the client connection
+            is kept alive for the next request
+        """
+        client = id(client_reader)
+        client_keep = succeeded = False
+        whole = self._is_whole(request, headers)
+        domain = headers.get('Host')
         for attempt in range(self._max_tries):
-            stime, err = 0, None
-            proxy = await self._proxy_pool.get(scheme)
+            stime, err, stream = 0, None, []
+            responded = keep_alive = False
+            traffic = Traffic()
+            failed = None
+            # Retries are not routed to the proxy of the session
+            proxy = await self._get_proxy(
+                client_writer, scheme, None if attempt else session, domain
+            )
+            if proxy is None:
+                return False, False
             proto = self._choice_proto(proxy, scheme)
+            # The request and the response are relayed by their length,
+            # so the connections with the client and with the proxy
+            # can be kept alive
+            framed = (
+                scheme == 'HTTP'
+                and (keep_client or self._conn_pool.enabled or cache_key is not None)
+                and self._is_framed(headers)
+            )
+            pooled = framed and proto == 'HTTP' and self._conn_pool.enabled
+            # A body that is not read yet can't be sent again through
+            # a connection that turns out to be closed
+            conn = (
+                pooled and whole and self._conn_pool.acquire(proxy) or ProxyConn(proxy)
+            )
+            reused = conn.reader is not None
             log.debug(
-                'client: %d; attempt: %d; proxy: %s; proto: %s'
-                % (client, attempt, proxy, proto)
+                'client: %d; attempt: %d; proxy: %s; proto: %s; reused: %s'
+                % (client, attempt, proxy, proto, reused)
             )
 
             try:
-                await proxy.connect()
-
-                if proto in ('CONNECT:80', 'SOCKS4', 'SOCKS5'):
-                    host = headers.get('Host')
-                    port = headers.get('Port', 80)
+                if not reused:
                     try:
-                        ip = await self._resolver.resolve(host)
+                        conn, proto = await self._connect(conn, proto, scheme, headers)
                     except ResolveError:
-                        return
-                    proxy.ngtr = proto
-                    await proxy.ngtr.negotiate(host=host, port=port, ip=ip)
-                    if scheme == 'HTTPS' and proto in ('SOCKS4', 'SOCKS5'):
-                        client_writer.write(CONNECTED)
-                        await client_writer.drain()
-                    else:  # HTTP
-                        await proxy.send(request)
-                else:  # proto: HTTP & HTTPS
-                    await proxy.send(request)
+                        return False, False
+                    # The connection through another proxy may have won the race
+                    proxy = conn.proxy
+                    pooled = framed and proto == 'HTTP' and self._conn_pool.enabled
+
+                if scheme == 'HTTPS' and proto in ('SOCKS4', 'SOCKS5'):
+                    client_writer.write(CONNECTED)
+                    self._count(traffic, 'downstream', len(CONNECTED))
+                    await client_writer.drain()
+                else:
+                    await conn.send(request)
+                    self._count(traffic, 'upstream', len(request))
 
                 history[
                     f"{client_reader._transport.get_extra_info('peername')[0]}-{headers['Path']}"
@@ -287,20 +1217,99 @@ class Server:
                 }
 
                 stime = time.time()
-                stream = [
-                    asyncio.ensure_future(
-                        self._stream(reader=client_reader, writer=proxy.writer)
-                    ),
-                    asyncio.ensure_future(
-                        self._stream(
-                            reader=proxy.reader,
-                            writer=client_writer,
-                            scheme=scheme,
-                            inject=inject_resp_header,
+                if framed:
+                    if not whole:
+                        # Stream the body while waiting for the response,
+                        # the client may wait for "100 Continue" to send it
+                        stream = [
+                            asyncio.ensure_future(
+                                self._send_body(
+                                    client_reader, conn.writer, headers, traffic
+                                )
+                            )
+                        ]
+                    head = await self._read_head(conn.reader)
+                    if not head and reused:
+                        # The proxy has closed the idle connection in the meantime
+                        conn.close()
+                        conn = ProxyConn(proxy)
+                        await conn.connect()
+                        await conn.send(request)
+                        head = await self._read_head(conn.reader)
+                    while True:
+                        resp_headers, keep = self._relay_head(
+                            head,
+                            client_writer,
+                            scheme,
+                            inject_resp_header,
+                            headers['Method'],
+                            keep_client,
+                            traffic,
+                        )
+                        responded = True
+                        if not 100 <= resp_headers['Status'] < 200:
+                            break
+                        # Interim response, the final one follows
+                        head = await self._read_head(conn.reader)
+                    if cache_key is not None and not ResponseCache.cacheable(
+                        resp_headers
+                    ):
+                        # The requests waiting for it are passed to proxies
+                        self._cache.release(cache_key)
+                        cache_key = None
+                    writer = client_writer
+                    if cache_key is not None:
+                        writer = Recorder(client_writer, self._cache.max_item_size)
+                    keep_alive = await self._relay_body(
+                        conn.reader, writer, resp_headers, headers['Method'], traffic
+                    )
+                    if cache_key is not None and writer.data is not None:
+                        self._cache.store(
+                            cache_key,
+                            headers,
+                            _remove_header(head, b'Age'),
+                            resp_headers,
+                            bytes(writer.data),
+                            inject_resp_header['headers']['X-Proxy-Info'],
                         )
-                    ),
-                ]
-                await asyncio.gather(*stream, loop=self._loop)
+                    if stream and not (stream[0].done() and not stream[0].exception()):
+                        # The response is sent before the whole request body
+                        stream[0].cancel()
+                        keep_alive = keep = False
+                    client_keep = keep
+                elif scheme == 'HTTPS':
+                    if proto == 'HTTPS':
+                        # The response of the proxy to CONNECT
+                        head = await self._read_head(conn.reader)
+                        if not head:
+                            raise ErrorOnStream(ProxyEmptyRecvError())
+                        head = self._inject_headers(
+                            head, scheme, inject_resp_header['headers']
+                        )
+                        client_writer.write(head)
+                        self._count(traffic, 'downstream', len(head))
+                    await self._tunnel(client_reader, client_writer, conn, traffic)
+                else:
+                    stream = [
+                        asyncio.ensure_future(
+                            self._stream(
+                                reader=client_reader,
+                                writer=conn.writer,
+                                direction='upstream',
+                                traffic=traffic,
+                            )
+                        ),
+                        asyncio.ensure_future(
+                            self._stream(
+                                reader=conn.reader,
+                                writer=client_writer,
+                                scheme=scheme,
+                                inject=inject_resp_header,
+                                traffic=traffic,
+                            )
+                        ),
+                    ]
+                    await asyncio.gather(*stream, loop=self._loop)
             except asyncio.CancelledError:
                 log.debug('Cancelled in server._handle')
                 break
@@ -314,36 +1323,181 @@ class Server:
                 BadResponseError,
             ) as e:
                 log.debug('client: %d; error: %r' % (client, e))
+                self.metrics.errors[e.errmsg] += 1
+                failed = True
                 continue
             except ErrorOnStream as e:
                 log.debug(
                     'client: %d; error: %r; EOF: %s'
                     % (client, e, client_reader.at_eof())
                 )
-                for task in stream:
-                    if not task.done():
-                        task.cancel()
                 if client_reader.at_eof() and 'Timeout' in repr(e):
                     # Proxy may not be able to receive EOF and weel be raised a
                     # TimeoutError, but all the data has already successfully
                     # returned, so do not consider this error of proxy
+                    succeeded, failed = True, False
                     break
                 err = e
-                if scheme == 'HTTPS':  # SSL Handshake probably failed
+                self.metrics.errors[e.errmsg] += 1
+                failed = True
+                if scheme == 'HTTPS' or responded or not whole:
+                    # SSL Handshake probably failed, the client has already
+                    # received a part of the response or sent a part of the body
                     break
             else:
+                if session is not None:
+                    self._proxy_pool.stick(session, proxy)
+                succeeded, failed = True, False
                 break
             finally:
-                proxy.log(request.decode(), stime, err=err)
-                proxy.close()
+                for task in stream:
+                    if not task.done():
+                        task.cancel()
+                # The body may be binary, only the head is logged
+                head_len = request.find(b'\r\n\r\n')
+                conn.log(request[:head_len].decode('latin-1'), stime, err=err)
+                if failed is not None:
+                    self._proxy_pool.count(proxy, domain, failed)
+                self._account(proxy, client_writer, scheme, traffic, failed)
+                if pooled and keep_alive:
+                    self._conn_pool.release(conn)
+                else:
+                    conn.close()
                 self._proxy_pool.put(proxy)
+        return succeeded, client_keep
+
+    def _count(self, traffic, direction, size):
+        self.metrics.bytes[direction] += size
+        if traffic is not None:
+            traffic.add(direction, size)
+
+    def _account(self, proxy, client_writer, scheme, traffic, failed):
+        """Add the bytes relayed for a request to the proxy and the client.
+
+        The throughput of the proxy is measured on the large HTTP responses;
+        the data of tunnels is counted only when they are closed.
+        """
+        if not traffic.bytes:
+            return
+        proxy.stat['bytes'].update(traffic.bytes)
+        peername = client_writer.get_extra_info('peername')
+        if peername:
+            counts = self.client_bytes.get(peername[0])
+            if counts is None:
+                counts = self.client_bytes[peername[0]] = Counter()
+            counts.update(traffic.bytes)
+        size = traffic.bytes['downstream']
+        if (
+            scheme == 'HTTP'
+            and failed is False
+            and size >= MIN_TRANSFER_SIZE
+            and traffic.started
+        ):
+            proxy.add_transfer(size, time.time() - traffic.started)
+
+    async def _get_proxy(self, client_writer, scheme, session, domain):
+        """Return a proxy, or None if the client is answered by 503."""
+        if self._max_waiting and self._proxy_pool.waiting >= self._max_waiting:
+            reason = 'waiting'
+        else:
+            try:
+                return await self._proxy_pool.get(
+                    scheme, session, domain, timeout=self._wait_timeout or None
+                )
+            except asyncio.TimeoutError:
+                reason = 'timeout'
+        log.debug('No proxy for the request: %s', reason)
+        self.metrics.rejected[reason] += 1
+        client_writer.write(SERVICE_UNAVAILABLE)
+        await client_writer.drain()
+        return None
+
+    async def _connect(self, conn, proto, scheme, headers):
+        """Connect to the proxy and negotiate with it.
+
+        In the hedging mode, if it takes longer than ``hedge_percentile``
+        of the previous connections, another proxy is tried in parallel.
+        The connection established first is used, the other one is canceled
+        and counted as an error of its proxy.
+
+        :return: The established connection and its protocol
+        """
+        first = asyncio.ensure_future(self._establish(conn, proto, headers))
+        attempts = {first: (conn, proto)}
+        started = {first: time.time()}
+        if self._hedge_percentile:
+            await asyncio.wait([first], timeout=self._hedge_delay())
+            hedge = None
+            if not first.done():
+                hedge = self._proxy_pool.get_nowait(scheme, headers.get('Host'))
+            if hedge is conn.proxy:
+                self._proxy_pool.put(hedge)
+            elif hedge is not None:
+                log.debug('%s is hedged by %s' % (conn.proxy, hedge))
+                hedge_conn = ProxyConn(hedge)
+                hedge_proto = self._choice_proto(hedge, scheme)
+                second = asyncio.ensure_future(
+                    self._establish(hedge_conn, hedge_proto, headers)
+                )
+                attempts[second] = (hedge_conn, hedge_proto)
+                started[second] = time.time()
+
+        winner = None
+        try:
+            pending = set(attempts)
+            while pending and winner is None:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                winner = next((t for t in done if not t.exception()), None)
+        finally:
+            for task, (loser, _) in attempts.items():
+                if task is winner:
+                    continue
+                if not task.done():
+                    task.cancel()
+                    if winner is not None:
+                        loser.log(
+                            'Connection: canceled by hedging', err=ProxyTimeoutError
+                        )
+                        self.metrics.errors[ProxyTimeoutError.errmsg] += 1
+                if loser is not conn or winner is not None:
+                    # Otherwise the first connection is closed by the caller
+                    loser.close()
+                    self._proxy_pool.put(loser.proxy)
+        if winner is None:
+            raise first.exception()
+        self._connect_times.append(time.time() - started[winner])
+        self.metrics.connect_time.observe(self._connect_times[-1])
+        return attempts[winner]
+
+    async def _establish(self, conn, proto, headers):
+        await conn.connect()
+        if proto in ('CONNECT:80', 'SOCKS4', 'SOCKS5'):
+            host = headers.get('Host')
+            port = headers.get('Port', 80)
+            ip = await self._resolver.resolve(host)
+            conn.ngtr = proto
+            await conn.ngtr.negotiate(host=host, port=port, ip=ip)
+
+    def _hedge_delay(self):
+        """Return the percentile of the recent connection times."""
+        times = sorted(self._connect_times)
+        if len(times) < 10:
+            return self._timeout / 2
+        idx = int(len(times) * self._hedge_percentile / 100)
+        return times[min(idx, len(times) - 1)]
 
-    async def _parse_request(self, reader, length=65536):
-        request = await reader.read(length)
+    async def _parse_request(self, reader, timeout=None, length=65536):
+        """Read the head of a request and its body, if it's not larger than length.
+
+        A larger body is left in the reader.
+        """
+        request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout)
         headers = parse_headers(request)
-        if headers['Method'] == 'POST' and request.endswith(b'\r\n\r\n'):
-            # For aiohttp. POST data returns on second reading
-            request += await reader.read(length)
+        size = 0 if _is_chunked(headers) else int(headers.get('Content-Length', 0))
+        if 0 < size <= length:
+            request += await asyncio.wait_for(reader.readexactly(size), self._timeout)
         return request, headers
 
     def _identify_scheme(self, headers):
@@ -356,6 +1510,9 @@ class Server:
         if scheme == 'HTTP':
             if self._prefer_connect and ('CONNECT:80' in proxy.types):
                 proto = 'CONNECT:80'
+            elif self._conn_pool.enabled and ('HTTP' in proxy.types):
+                # only these connections can be reused
+                proto = 'HTTP'
             else:
                 relevant = {
                     'HTTP',
@@ -369,7 +1526,231 @@ class Server:
             proto = relevant.pop()
         return proto
 
-    async def _stream(self, reader, writer, length=65536, scheme=None, inject=None):
+    def _is_framed(self, headers):
+        """Whether the request has a body of known length and keeps the protocol."""
+        if headers['Method'] == 'CONNECT' or 'Upgrade' in headers:
+            return False
+        if _is_chunked(headers):
+            return True
+        try:
+            return int(headers.get('Content-Length', 0)) >= 0
+        except ValueError:
+            return False
+
+    def _is_whole(self, request, headers):
+        """Whether the request is entirely read."""
+        if not self._is_framed(headers) or _is_chunked(headers):
+            return False
+        length = int(headers.get('Content-Length', 0))
+        return len(request.partition(b'\r\n\r\n')[2]) == length
+
+    async def _maintain_conns(self, interval=5):
+        while True:
+            await asyncio.sleep(interval)
+            self._conn_pool.expire()
+            proxies = [
+                p
+                for p in self._proxy_pool.top('HTTP', self._prewarm)
+                if 'HTTP' in p.types and not self._conn_pool.idle(p)
+            ]
+            if proxies:
+                await asyncio.gather(*[self._conn_pool.prewarm(p) for p in proxies])
+
+    async def _reprobe(self, interval=1):
+        while True:
+            await asyncio.sleep(interval)
+            await self._proxy_pool.reprobe()
+
+    async def _monitor_lag(self, interval=0.25):
+        """Observe how late the loop wakes up after a sleep.
+
+        The delay is the time the loop is blocked by a callback, e.g. by
+        parsing a page, which delays all the requests and checks too.
+        """
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(interval)
+            lag = time.monotonic() - started - interval
+            self.metrics.loop_lag.observe(max(lag, 0))
+
+    async def _save_snapshots(self):
+        while True:
+            await asyncio.sleep(self._snapshot_interval)
+            self._save_snapshot()
+
+    def _save_snapshot(self):
+        """Write the proxies of the pool and their stats to the snapshot file."""
+        snapshot = {'time': time.time(), 'proxies': self._proxy_pool.get_state()}
+        try:
+            write_atomic(self._snapshot_path, json.dumps(snapshot))
+        except OSError as e:
+            log.warning('Failed to save the snapshot: %r' % e)
+        else:
+            log.debug('Snapshot of %d proxies is saved' % len(snapshot['proxies']))
+
+    def _load_snapshot(self):
+        try:
+            with open(self._snapshot_path) as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            log.warning('Failed to load the snapshot: %r' % e)
+            return
+        self._proxy_pool.load_state(snapshot.get('proxies', []), timeout=self._timeout)
+        log.info(
+            '%d proxies are restored from %s'
+            % (len(self._proxy_pool), self._snapshot_path)
+        )
+
+    async def _io(self, aw):
+        try:
+            return await asyncio.wait_for(aw, self._timeout)
+        except (
+            asyncio.TimeoutError,
+            asyncio.IncompleteReadError,
+            asyncio.LimitOverrunError,
+            ConnectionResetError,
+            OSError,
+            ValueError,
+        ) as e:
+            raise ErrorOnStream(e)
+
+    async def _read_head(self, reader):
+        """Read the head of a message; return empty bytes if EOF is received."""
+        try:
+            return await self._io(reader.readuntil(b'\r\n\r\n'))
+        except ErrorOnStream as e:
+            exc = e.args[0]
+            if isinstance(exc, asyncio.IncompleteReadError) and not exc.partial:
+                return b''
+            raise
+
+    async def _send_cached(self, entry, writer, keep_alive):
+        """Send a cached response to the client.
+
+        :return: Whether the connection with the client is kept alive
+        """
+        head = self._inject_headers(
+            entry.head, 'HTTP', {'Age': ResponseCache.age(entry)}
+        )
+        inject = {'headers': {'X-Proxy-Info': entry.proxy}}
+        _, keep_alive = self._relay_head(
+            head, writer, 'HTTP', inject, 'GET', keep_alive
+        )
+        writer.write(entry.body)
+        self.metrics.bytes['downstream'] += len(entry.body)
+        await self._io(writer.drain())
+        return keep_alive
+
+    def _relay_head(
+        self, head, writer, scheme, inject, method, keep_alive, traffic=None
+    ):
+        """Check and relay the head of a response.
+
+        :return:
+            The parsed headers and whether the connection with the client
+            is kept alive after the response
+        """
+        try:
+            self._check_response(head, scheme)
+            headers = parse_headers(head)
+        except (BadStatusLine, BadStatusError, BadResponseError, ValueError) as e:
+            raise ErrorOnStream(e)
+        if inject.get('headers'):
+            head = self._inject_headers(head, scheme, inject['headers'])
+        keep_alive = keep_alive and _has_length(headers, method)
+        head = _set_connection(head, b'keep-alive' if keep_alive else b'close')
+        writer.write(head)
+        self._count(traffic, 'downstream', len(head))
+        return headers, keep_alive
+
+    async def _relay_body(self, reader, writer, headers, method, traffic=None):
+        """Relay the body of a response.
+
+        :return: True if the connection can be reused for the next request
+        """
+        if _has_no_body(headers, method):
+            pass
+        elif _is_chunked(headers):
+            await self._relay_chunked(reader, writer, 'downstream', traffic)
+        elif 'Content-Length' in headers:
+            length = int(headers['Content-Length'])
+            await self._relay_length(reader, writer, length, 'downstream', traffic)
+        else:
+            # The body is delimited by closing the connection
+            await self._stream(reader, writer, direction='downstream', traffic=traffic)
+            return False
+        await self._io(writer.drain())
+        return _is_keep_alive(headers)
+
+    async def _send_body(self, reader, writer, headers, traffic=None):
+        """Stream the body of a request to the proxy as it arrives."""
+        if _is_chunked(headers):
+            await self._relay_chunked(reader, writer, 'upstream', traffic)
+        else:
+            length = int(headers['Content-Length'])
+            await self._relay_length(reader, writer, length, 'upstream', traffic)
+        await self._io(writer.drain())
+
+    async def _tunnel(self, client_reader, client_writer, conn, traffic=None):
+        received = [0, 0]
+        try:
+            await relay(
+                (client_reader, client_writer),
+                (conn.reader, conn.writer),
+                timeout=self._timeout,
+                received=received,
+                loop=self._loop,
+            )
+        except (asyncio.TimeoutError, ConnectionResetError, OSError) as e:
+            raise ErrorOnStream(e)
+        finally:
+            self._count(traffic, 'upstream', received[0])
+            self._count(traffic, 'downstream', received[1])
+
+    async def _relay_length(
+        self, reader, writer, length, direction, traffic=None, chunk_size=65536
+    ):
+        while length > 0:
+            data = await self._io(reader.read(min(length, chunk_size)))
+            if not data:
+                raise ErrorOnStream(asyncio.IncompleteReadError(b'', length))
+            writer.write(data)
+            self._count(traffic, direction, len(data))
+            await self._io(writer.drain())
+            length -= len(data)
+
+    async def _relay_chunked(self, reader, writer, direction, traffic=None):
+        while True:
+            line = await self._io(reader.readuntil(b'\r\n'))
+            try:
+                size = int(line.split(b';', 1)[0], 16)
+            except ValueError:
+                raise ErrorOnStream(BadResponseError(line))
+            writer.write(line)
+            self._count(traffic, direction, len(line))
+            if not size:
+                break
+            await self._relay_length(reader, writer, size + 2, direction, traffic)
+        # trailer
+        while True:
+            line = await self._io(reader.readuntil(b'\r\n'))
+            writer.write(line)
+            self._count(traffic, direction, len(line))
+            if line == b'\r\n':
+                break
+
+    async def _stream(
+        self,
+        reader,
+        writer,
+        length=65536,
+        scheme=None,
+        inject=None,
+        direction='downstream',
+        traffic=None,
+    ):
         checked = False
 
         try:
@@ -387,6 +1768,7 @@ class Server:
                     checked = True
 
                 writer.write(data)
+                self._count(traffic, direction, len(data))
                 await writer.drain()
 
         except (
@@ -0,0 +1,382 @@
+"""Strategies of picking a proxy from the pool."""
+
+import hashlib
+import heapq
+import random
+from abc import ABC, abstractmethod
+from bisect import bisect, insort
+from collections import Counter, deque
+from itertools import count
+
+__all__ = [
+    'BestStrategy',
+    'RoundRobinStrategy',
+    'RandomStrategy',
+    'LeastConnStrategy',
+    'P2CStrategy',
+    'EWMAStrategy',
+    'TransferStrategy',
+    'HashRing',
+    'STRATEGIES',
+]
+
+SCHEMES = ('HTTP', 'HTTPS')
+
+
+def _priority(proxy):
+    return proxy.priority
+
+
+class BaseStrategy(ABC):
+    """Base Strategy.
+
+    Keeps the proxies available for picking, separately for every scheme.
+
+    :param inflight:
+        (optional) Counter of requests being processed by each proxy,
+        by ``(host, port)``. Shared with :class:`~proxybroker.server.ProxyPool`
+    """
+
+    name = None
+
+    def __init__(self, inflight=None):
+        self._inflight = Counter() if inflight is None else inflight
+
+    def load(self, proxy):
+        return self._inflight[(proxy.host, proxy.port)]
+
+    @abstractmethod
+    def __len__(self):
+        """Return the number of proxies available for picking."""
+
+    @abstractmethod
+    def add(self, proxy):
+        """Add a proxy or update its rank if it's already added."""
+
+    @abstractmethod
+    def discard(self, proxy):
+        """Remove a proxy if it's added."""
+
+    @abstractmethod
+    def pick(self, scheme):
+        """Return a proxy supporting the scheme or None, without removing it."""
+
+    @abstractmethod
+    def top(self, scheme, n):
+        """Return up to n proxies supporting the scheme, the best first."""
+
+
+class _LazyStrategy(BaseStrategy):
+    """Strategy over per-scheme queues with lazily invalidated entries.
+
+    An entry is shared between the queues of all schemes of a proxy; the last
+    item of an entry is the proxy, or None once it is discarded. Discarded
+    entries are skipped on picking and dropped when they outnumber live ones.
+    """
+
+    def __init__(self, inflight=None):
+        super().__init__(inflight)
+        self._queues = {scheme: self._new_queue() for scheme in SCHEMES}
+        self._entries = {}
+        self._live = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def discard(self, proxy):
+        entry = self._entries.pop((proxy.host, proxy.port), None)
+        if entry is None:
+            return
+        self._live -= len(entry[-1].schemes)
+        entry[-1] = None
+
+    def top(self, scheme, n):
+        proxies = (e[-1] for e in self._queues[scheme] if e[-1] is not None)
+        return heapq.nsmallest(n, proxies, key=_priority)
+
+    def _push(self, proxy, entry):
+        self._entries[(proxy.host, proxy.port)] = entry
+        for scheme in proxy.schemes:
+            self._push_to(self._queues[scheme], entry)
+            self._live += 1
+        self._compact()
+
+    def _compact(self):
+        total = sum(map(len, self._queues.values()))
+        if total <= 2 * self._live + 64:
+            return
+        for scheme, queue in self._queues.items():
+            self._queues[scheme] = self._new_queue(
+                e for e in queue if e[-1] is not None
+            )
+
+    @abstractmethod
+    def _new_queue(self, entries=()):
+        """Return a new queue filled with the entries."""
+
+    @abstractmethod
+    def _push_to(self, queue, entry):
+        """Put the entry to the queue."""
+
+
+class BestStrategy(_LazyStrategy):
+    """Picks the proxy with the lowest ``(error_rate, avg_resp_time)``."""
+
+    name = 'best'
+
+    def __init__(self, inflight=None):
+        super().__init__(inflight)
+        self._counter = count()
+
+    def add(self, proxy):
+        self.discard(proxy)
+        # The rank is fixed at insertion time, so the heap invariant holds
+        # even if the stats of the proxy are changed afterwards
+        self._push(proxy, [self._rank(proxy), next(self._counter), proxy])
+
+    def pick(self, scheme):
+        heap = self._queues[scheme]
+        while heap:
+            proxy = heap[0][-1]
+            if proxy is not None:
+                return proxy
+            heapq.heappop(heap)
+        return None
+
+    def top(self, scheme, n):
+        entries = (e for e in self._queues[scheme] if e[-1] is not None)
+        return [e[-1] for e in heapq.nsmallest(n, entries)]
+
+    def _rank(self, proxy):
+        return proxy.priority
+
+    def _new_queue(self, entries=()):
+        heap = list(entries)
+        heapq.heapify(heap)
+        return heap
+
+    def _push_to(self, queue, entry):
+        heapq.heappush(queue, entry)
+
+
+class LeastConnStrategy(BestStrategy):
+    """Picks the proxy with the fewest requests in flight.
+
+    Ties are broken by ``(error_rate, avg_resp_time)``.
+    """
+
+    name = 'least-conn'
+
+    def _rank(self, proxy):
+        return (self.load(proxy), proxy.priority)
+
+
+class RoundRobinStrategy(_LazyStrategy):
+    """Picks the proxies in turn."""
+
+    name = 'round-robin'
+
+    def add(self, proxy):
+        if (proxy.host, proxy.port) not in self._entries:
+            self._push(proxy, [proxy])
+
+    def pick(self, scheme):
+        queue = self._queues[scheme]
+        while queue:
+            entry = queue.popleft()
+            if entry[-1] is not None:
+                queue.append(entry)
+                return entry[-1]
+        return None
+
+    def _new_queue(self, entries=()):
+        return deque(entries)
+
+    def _push_to(self, queue, entry):
+        queue.append(entry)
+
+
+class _ArrayStrategy(BaseStrategy):
+    """Strategy that samples from per-scheme arrays of proxies.
+
+    Proxies are removed by swapping with the last one, so adding
+    and discarding are O(1).
+    """
+
+    def __init__(self, inflight=None):
+        super().__init__(inflight)
+        self._arrays = {scheme: [] for scheme in SCHEMES}
+        self._positions = {scheme: {} for scheme in SCHEMES}
+        self._proxies = {}
+
+    def __len__(self):
+        return len(self._proxies)
+
+    def add(self, proxy):
+        key = (proxy.host, proxy.port)
+        if key in self._proxies:
+            return
+        self._proxies[key] = proxy
+        for scheme in proxy.schemes:
+            self._positions[scheme][key] = len(self._arrays[scheme])
+            self._arrays[scheme].append(proxy)
+
+    def discard(self, proxy):
+        proxy = self._proxies.pop((proxy.host, proxy.port), None)
+        if proxy is None:
+            return
+        for scheme in proxy.schemes:
+            array, positions = self._arrays[scheme], self._positions[scheme]
+            idx = positions.pop((proxy.host, proxy.port))
+            last = array.pop()
+            if idx < len(array):
+                array[idx] = last
+                positions[(last.host, last.port)] = idx
+
+    def pick(self, scheme):
+        array = self._arrays[scheme]
+        if not array:
+            return None
+        return self._choose(array)
+
+    def top(self, scheme, n):
+        return heapq.nsmallest(n, self._arrays[scheme], key=_priority)
+
+    @abstractmethod
+    def _choose(self, proxies):
+        """Return one of the proxies."""
+
+
+class RandomStrategy(_ArrayStrategy):
+    """Picks a random proxy, weighted by its error rate and response time.
+
+    Uses rejection sampling: a uniformly chosen proxy is accepted with
+    probability ``(1 - error_rate) / (1 + avg_resp_time)``.
+    """
+
+    name = 'random'
+    max_tries = 8
+
+    def _choose(self, proxies):
+        for _ in range(self.max_tries):
+            proxy = random.choice(proxies)
+            if random.random() < self._weight(proxy):
+                break
+        return proxy
+
+    def _weight(self, proxy):
+        return (1 - proxy.error_rate) / (1 + proxy.avg_resp_time)
+
+
+class P2CStrategy(_ArrayStrategy):
+    """Power of two choices.
+
+    Picks two random proxies and takes the one with the lower cost:
+    the number of requests in flight, then ``(error_rate, avg_resp_time)``.
+    """
+
+    name = 'p2c'
+
+    def _choose(self, proxies):
+        if len(proxies) == 1:
+            return proxies[0]
+        first, second = random.sample(proxies, 2)
+        return min(first, second, key=self._cost)
+
+    def _cost(self, proxy):
+        return (self.load(proxy), proxy.priority)
+
+
+class EWMAStrategy(P2CStrategy):
+    """Power of two choices by the expected latency.
+
+    The cost of a proxy is its exponentially weighted moving average
+    response time multiplied by the number of requests in flight (plus
+    the new one), and scaled up by its error rate.
+    """
+
+    name = 'ewma'
+
+    def _cost(self, proxy):
+        error_rate = min(proxy.error_rate, 0.9)
+        return proxy.ewma_resp_time * (self.load(proxy) + 1) / (1 - error_rate)
+
+
+class TransferStrategy(P2CStrategy):
+    """Power of two choices by the expected time of a transfer.
+
+    The time of a transfer of ``payload_size`` bytes is the moving average
+    response time plus the size divided by the measured throughput of the
+    proxy. It's scaled like the cost of :class:`EWMAStrategy`. The proxies
+    whose throughput is not measured yet are costed by the response time.
+    """
+
+    name = 'transfer'
+
+    def __init__(self, inflight=None, payload_size=1048576):
+        super().__init__(inflight)
+        self.payload_size = payload_size
+
+    def _cost(self, proxy):
+        error_rate = min(proxy.error_rate, 0.9)
+        expected = proxy.ewma_resp_time
+        if proxy.throughput:
+            expected += self.payload_size / proxy.throughput
+        return expected * (self.load(proxy) + 1) / (1 - error_rate)
+
+
+def _hash(key):
+    # Stable between processes, unlike hash()
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    """Consistent hashing of keys to proxies.
+
+    Every proxy has ``replicas`` points on the ring, and a key belongs to
+    the proxy of the nearest point clockwise. When a proxy is added or
+    discarded, only the keys of its points are remapped.
+    """
+
+    def __init__(self, replicas=16):
+        self._replicas = replicas
+        self._points = []
+        self._proxies = {}
+
+    def __len__(self):
+        return len(self._proxies) // self._replicas
+
+    def add(self, proxy):
+        for point in self._proxy_points(proxy):
+            if point not in self._proxies:
+                insort(self._points, point)
+            self._proxies[point] = proxy
+
+    def discard(self, proxy):
+        for point in self._proxy_points(proxy):
+            if self._proxies.pop(point, None) is not None:
+                del self._points[bisect(self._points, point) - 1]
+
+    def walk(self, key):
+        """Yield the proxies clockwise from the key, starting with its owner."""
+        points = self._points
+        start = bisect(points, _hash(key))
+        for i in range(len(points)):
+            yield self._proxies[points[(start + i) % len(points)]]
+
+    def _proxy_points(self, proxy):
+        return [
+            _hash('%s:%d#%d' % (proxy.host, proxy.port, i))
+            for i in range(self._replicas)
+        ]
+
+
+STRATEGIES = {
+    'best': BestStrategy,
+    'round-robin': RoundRobinStrategy,
+    'random': RandomStrategy,
+    'least-conn': LeastConnStrategy,
+    'p2c': P2CStrategy,
+    'ewma': EWMAStrategy,
+    'transfer': TransferStrategy,
+}
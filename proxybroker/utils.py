@@ -1,6 +1,8 @@
 """Utils."""
 
+import hashlib
 import logging
+import math
 import os
 import os.path
 import random
@@ -8,6 +10,7 @@ import re
 import shutil
 import tarfile
 import tempfile
+import time
 import urllib.request
 
 from . import __version__ as version
@@ -32,6 +35,78 @@ IPPortPatternGlobal = re.compile(
     flags=re.DOTALL,
 )
 
+PortPattern = re.compile(r'\d{2,5}')
+
+
+class IPPortTokenizer:
+    """Finds the IP addresses of proxies and their ports in a page.
+
+    Gives the same pairs as ``IPPortPatternGlobal.findall``, in one pass
+    over the page instead of a lookahead from each address: the port of an
+    address is the first run of 2-5 digits starting before the next
+    address, or ``''`` if there is none.
+
+    :param ip_pattern:
+        (optional) The pattern of the addresses, e.g. with word boundaries.
+        Any ``IPPattern`` match still ends the search for a port, as the
+        lookahead of the regex does
+    :param port_pattern:
+        (optional) The pattern of the ports, e.g. of the quoted hex ones
+    """
+
+    def __init__(self, ip_pattern=IPPattern, port_pattern=PortPattern):
+        self._ip = ip_pattern
+        self._port = port_pattern
+
+    def findall(self, page):
+        pairs = []
+        size = len(page)
+        # The first run of digits, or address, found after an address is
+        # the first one after the next addresses too, until they end past
+        # its start
+        port, start = None, -1
+        stop = -1
+        ips = self._ip.finditer(page)
+        ip = next(ips, None)
+        while ip is not None:
+            following = next(ips, None)
+            end = ip.end()
+            if start < end:
+                port = self._port.search(page, end)
+                start = port.start() if port else size
+            if self._ip is IPPattern:
+                stop = following.start() if following else size
+            elif stop < end:
+                after = IPPattern.search(page, end)
+                stop = after.start() if after else size
+            if start < stop:
+                pairs.append((ip.group(), port.group()))
+            elif stop < size:
+                pairs.append((ip.group(), ''))
+            else:
+                pair = self._shortened(page, ip)
+                if pair:
+                    pairs.append(pair)
+            ip = following
+        return pairs
+
+    def _shortened(self, page, ip):
+        # Nothing follows the last address, then the regex backtracks to
+        # take a port, or the next address, from the end of its last octet,
+        # e.g. 1.2.3.456 or 1.2.3.41.2.3.4
+        start, end = ip.span()
+        for cut in (end - 1, end - 2):
+            if not self._ip.fullmatch(page, start, cut):
+                continue
+            following = IPPattern.search(page, cut)
+            port = self._port.search(page, cut)
+            if following and (not port or following.start() <= port.start()):
+                return page[start:cut], ''
+            if port:
+                return page[start:cut], port.group()
+        return None
+
+
 # IsIpPattern = re.compile(
 #     r'^(?:(?:25[0-5]|2[0-4]\d|[01]?\d\d?)\.){3}(?:25[0-5]|2[0-4]\d|[01]?\d\d?)$')
 
@@ -108,6 +183,96 @@ def parse_headers(headers):
     return _headers
 
 
+def write_atomic(path, data):
+    """Write the text to a file, so that the file has the old or the new text."""
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)), prefix='.proxybroker-'
+    )
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+class BloomFilter:
+    """Set of strings in a fixed memory, with false positives.
+
+    :param int capacity: The number of items kept with the error rate
+    :param float error_rate: Probability of a false positive at capacity
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = capacity
+        self.count = 0
+        self.size = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.hashes = max(round(self.size / capacity * math.log(2)), 1)
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def __contains__(self, item):
+        bits = self._bits
+        return all(bits[i >> 3] & 1 << (i & 7) for i in self._indexes(item))
+
+    def add(self, item):
+        for i in self._indexes(item):
+            self._bits[i >> 3] |= 1 << (i & 7)
+        self.count += 1
+
+    def _indexes(self, item):
+        # Double hashing: k indexes from the two halves of one digest
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        a = int.from_bytes(digest[:8], 'little')
+        b = int.from_bytes(digest[8:], 'little') | 1
+        return [(a + i * b) % self.size for i in range(self.hashes)]
+
+
+class ScalableBloomFilter:
+    """Bloom filter growing with the items added and forgetting them by time.
+
+    A full filter is followed by one of twice the capacity and half the
+    error rate, so the total error rate stays under ``error_rate``. Every
+    ``ttl`` seconds the filters become the previous generation and the older
+    one is dropped: an item is kept for ``ttl`` to ``2 * ttl`` seconds, and
+    the memory is bounded by the items added in that time.
+    """
+
+    def __init__(self, capacity=10000, error_rate=0.001, ttl=None):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.ttl = ttl
+        self._filters = []
+        self._previous = []
+        self._rotated = time.monotonic()
+
+    def __contains__(self, item):
+        self._rotate()
+        return any(item in f for f in self._filters + self._previous)
+
+    def __len__(self):
+        return sum(f.count for f in self._filters + self._previous)
+
+    def add(self, item):
+        """Add the item and return True, or False if it's already added."""
+        if item in self:
+            return False
+        if not self._filters or self._filters[-1].count >= self._filters[-1].capacity:
+            n = len(self._filters)
+            self._filters.append(
+                BloomFilter(self.capacity << n, self.error_rate / 2 ** (n + 1))
+            )
+        self._filters[-1].add(item)
+        return True
+
+    def _rotate(self):
+        if self.ttl and time.monotonic() - self._rotated >= self.ttl:
+            self._previous, self._filters = self._filters, []
+            self._rotated = time.monotonic()
+
+
 def update_geoip_db():
     print('The update in progress, please waite for a while...')
     filename = 'GeoLite2-City.tar.gz'
@@ -0,0 +1,375 @@
+"""Serving through several worker processes that share the proxy stats."""
+
+import asyncio
+import inspect
+import multiprocessing
+import signal
+import socket
+import threading
+
+from .proxy import Proxy
+from .server import Server
+from .utils import log
+
+__all__ = ['SharedStats', 'SharedProxy', 'Workers']
+
+# requests, errors, sum of the runtimes, number of the runtimes
+_FIELDS = 4
+# supply, waiting requests, received proxies
+_POOL_FIELDS = 3
+
+
+class SharedStats:
+    """Stats of the proxies in the memory shared by the worker processes.
+
+    Each worker writes to its own row of the table only, so no lock is
+    needed. A proxy is given a slot in the main process; its stats are
+    the sums of the slot over the rows. The slot is assigned again once
+    all the workers holding the proxy have released it.
+
+    The workers also publish the supply and the demand of their pools,
+    which the main process reads.
+    """
+
+    def __init__(self, workers, capacity=65536):
+        self.workers = workers
+        self.capacity = capacity
+        self._table = multiprocessing.RawArray('d', workers * capacity * _FIELDS)
+        # 1 where the worker has released the slot
+        self._released = multiprocessing.RawArray('b', workers * capacity)
+        self._pools = multiprocessing.RawArray('d', workers * _POOL_FIELDS)
+        self._slots = 0
+        # The rest is used in the main process only
+        # slot -> workers holding it
+        self._holders = {}
+        self._free = []
+
+    def assign(self, holders=None):
+        """Return the slot for a new proxy, or None if the table is full.
+
+        :param holders:
+            (optional) The workers the proxy is passed to, all by default
+        """
+        if not self._free and self._slots >= self.capacity:
+            self._reclaim()
+        if self._free:
+            slot = self._free.pop()
+        elif self._slots < self.capacity:
+            slot = self._slots
+            self._slots += 1
+        else:
+            return None
+        self._holders[slot] = tuple(range(self.workers) if holders is None else holders)
+        return slot
+
+    def release(self, worker, slot):
+        """Mark that the worker doesn't use the slot anymore."""
+        self._released[worker * self.capacity + slot] = 1
+
+    def publish(self, worker, slot, values):
+        start = (worker * self.capacity + slot) * _FIELDS
+        self._table[start : start + _FIELDS] = values
+
+    def others(self, worker, slot):
+        """Return the sums of the stats published by the other workers."""
+        totals = [0.0] * _FIELDS
+        for row in range(self.workers):
+            if row == worker:
+                continue
+            start = (row * self.capacity + slot) * _FIELDS
+            for i, value in enumerate(self._table[start : start + _FIELDS]):
+                totals[i] += value
+        return totals
+
+    def report(self, worker, supply, waiting, received):
+        """Publish the state of the pool of the worker."""
+        start = worker * _POOL_FIELDS
+        self._pools[start : start + _POOL_FIELDS] = [supply, waiting, received]
+
+    def pool(self, worker):
+        """Return the supply, waiting requests and received proxies of the worker."""
+        start = worker * _POOL_FIELDS
+        return [int(value) for value in self._pools[start : start + _POOL_FIELDS]]
+
+    def _reclaim(self):
+        for slot, holders in list(self._holders.items()):
+            if not all(self._released[row * self.capacity + slot] for row in holders):
+                continue
+            del self._holders[slot]
+            for row in range(self.workers):
+                self._released[row * self.capacity + slot] = 0
+                self.publish(row, slot, [0] * _FIELDS)
+            self._free.append(slot)
+
+
+class SharedProxy(Proxy):
+    """Proxy whose stats include the requests of the other worker processes.
+
+    The stats of this worker are published to :class:`SharedStats` on each
+    logged event, when those of the others are added to ``stat['requests']``,
+    :attr:`error_rate` and :attr:`avg_resp_time`.
+    """
+
+    def __init__(self, *args, stats=None, worker=0, slot=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats = stats
+        self._worker = worker
+        self._slot = slot
+        # The requests made before sharing (checks), known to all workers
+        self._base = 0
+        self._own = [0, 0, 0.0, 0]
+        self._others = [0, 0, 0.0, 0]
+        self._runtimes_sum = 0.0
+
+    @classmethod
+    def from_state(cls, state, **kwargs):
+        proxy = super().from_state(state, **kwargs)
+        proxy._base = proxy.stat['requests']
+        proxy._runtimes_sum = sum(proxy._runtimes)
+        return proxy
+
+    @property
+    def error_rate(self):
+        if not self.stat['requests']:
+            return 0
+        errors = sum(self.stat['errors'].values()) + self._others[1]
+        return round(errors / self.stat['requests'], 2)
+
+    @property
+    def avg_resp_time(self):
+        count = len(self._runtimes) + self._others[3]
+        if not count:
+            return 0
+        return round((self._runtimes_sum + self._others[2]) / count, 2)
+
+    def _update_stat(self, msg, runtime, err):
+        super()._update_stat(msg, runtime, err)
+        if err:
+            self._own[1] += 1
+        self.sync()
+
+    def _add_runtime(self, runtime):
+        super()._add_runtime(runtime)
+        self._runtimes_sum += runtime
+        self._own[2] += runtime
+        self._own[3] += 1
+
+    def decay(self, factor=0.5):
+        # Only the share of this worker can be scaled down
+        super().decay(factor)
+        self._runtimes_sum = sum(self._runtimes)
+        self._base = int(self._base * factor)
+        requests, errors, runtimes_sum, runtimes = self._own
+        self._own = [
+            int(requests * factor),
+            int(errors * factor),
+            runtimes_sum * factor,
+            int(runtimes * factor),
+        ]
+        self.stat['requests'] = int(self._base + self._own[0] + self._others[0])
+        self.sync()
+
+    def release(self):
+        """Give up the slot, the proxy is removed from the pool of this worker."""
+        if self._slot is None:
+            return
+        self._stats.release(self._worker, self._slot)
+        self._slot = None
+
+    def sync(self):
+        """Publish the stats of this worker and take those of the others."""
+        if self._slot is None:
+            return
+        self._own[0] = self.stat['requests'] - self._base - self._others[0]
+        self._stats.publish(self._worker, self._slot, self._own)
+        self._others = self._stats.others(self._worker, self._slot)
+        self.stat['requests'] = int(self._base + self._own[0] + self._others[0])
+
+
+class Workers:
+    """Runs :class:`~proxybroker.server.Server` in several processes.
+
+    The workers accept the connections on the same port (``SO_REUSEPORT``).
+    Each found proxy is passed to ``min(workers, max_concurrency)`` of them,
+    those with the lowest supply, which share its ``max_concurrency`` and
+    rate limits, so the limits hold across the processes. The stats of
+    the proxy are shared through :class:`SharedStats`, so a proxy failing
+    in one worker is ranked lower and removed from the pools of all of them.
+    """
+
+    def __init__(self, host, port, proxies, workers=2, loop=None, **kwargs):
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            raise ValueError('Several workers require SO_REUSEPORT support')
+        self.host = host
+        self.port = int(port)
+        self._proxies = proxies
+        self._loop = loop or asyncio.get_event_loop()
+        # Skip the parameters of Broker.find, they may be not picklable
+        params = inspect.signature(Server).parameters
+        self._kwargs = {
+            k: v
+            for k, v in kwargs.items()
+            if k in params and k not in ('host', 'port', 'proxies', 'loop')
+        }
+        if self._kwargs.pop('snapshot_path', None):
+            log.warning('Snapshots are not supported with several workers')
+        max_concurrency = self._kwargs.get(
+            'max_concurrency', params['max_concurrency'].default
+        )
+        if max_concurrency < 1:
+            raise ValueError('`max_concurrency` should be greater than zero')
+        # The number of workers each proxy is passed to
+        self._replicas = min(workers, max_concurrency)
+        self._kwargs['max_concurrency'] = max_concurrency // self._replicas
+        for name in ('rate_limit', 'domain_rate_limit'):
+            if self._kwargs.get(name):
+                self._kwargs[name] /= self._replicas
+        self._stats = SharedStats(workers)
+        self._queues = [multiprocessing.Queue() for _ in range(workers)]
+        # The numbers of proxies put to the queues
+        self._fed = [0] * workers
+        self._processes = []
+        self._feeder = None
+        self._watcher = None
+        # Set while there are requests waiting for a proxy in any worker
+        self.demand = asyncio.Event()
+        # Set when the supply of the workers is lower
+        self.drained = asyncio.Event()
+
+    @property
+    def supply(self):
+        """The number of proxies available to the workers and waiting for them."""
+        # A proxy is counted by each worker it's passed to
+        shared = sum(map(self._supply, range(len(self._queues))))
+        return shared // self._replicas + self._proxies.qsize()
+
+    def start(self):
+        for index, queue in enumerate(self._queues):
+            process = multiprocessing.Process(
+                target=_run_worker,
+                args=(index, self._stats, queue, self.host, self.port, self._kwargs),
+                daemon=True,
+            )
+            process.start()
+            self._processes.append(process)
+        self._feeder = asyncio.ensure_future(self._feed(), loop=self._loop)
+        self._watcher = asyncio.ensure_future(self._watch(), loop=self._loop)
+        log.info(
+            'Started {0} workers on {1}:{2}'.format(
+                len(self._processes), self.host, self.port
+            )
+        )
+
+    def stop(self):
+        if not self._processes:
+            return
+        if self._feeder:
+            self._feeder.cancel()
+            self._feeder = None
+        if self._watcher:
+            self._watcher.cancel()
+            self._watcher = None
+        for process in self._processes:
+            process.terminate()
+        for process in self._processes:
+            process.join(5)
+        self._processes = []
+        self._loop.stop()
+        log.info('Server is stopped')
+
+    def _supply(self, index):
+        """The proxies available to the worker and on their way to it."""
+        supply, _, received = self._stats.pool(index)
+        return supply + self._fed[index] - received
+
+    async def _watch(self, interval=0.5):
+        """Follow the supply and the demand reported by the workers."""
+        last = self.supply
+        while True:
+            await asyncio.sleep(interval)
+            workers = range(len(self._queues))
+            if any(self._stats.pool(index)[1] for index in workers):
+                self.demand.set()
+            else:
+                self.demand.clear()
+            supply = self.supply
+            if supply < last:
+                self.drained.set()
+            last = supply
+
+    async def _feed(self):
+        while True:
+            proxy = await self._proxies.get()
+            self._proxies.task_done()
+            if proxy is None:
+                for queue in self._queues:
+                    queue.put(None)
+                break
+            holders = sorted(range(len(self._queues)), key=self._supply)
+            holders = holders[: self._replicas]
+            item = (proxy.get_state(), self._stats.assign(holders))
+            for index in holders:
+                self._queues[index].put(item)
+                self._fed[index] += 1
+
+
+def _receive(index, stats, queue, proxies, loop, kwargs, received):
+    while True:
+        item = queue.get()
+        proxy = item and SharedProxy.from_state(
+            item[0],
+            stats=stats,
+            worker=index,
+            slot=item[1],
+            timeout=kwargs.get('timeout', 8),
+        )
+        loop.call_soon_threadsafe(proxies.put_nowait, proxy)
+        if proxy is None:
+            break
+        received[0] += 1
+
+
+async def _refresh(pool, interval=5):
+    """Re-rank the idle proxies of the pool by the shared stats."""
+    while True:
+        await asyncio.sleep(interval)
+        for proxy in pool:
+            proxy.sync()
+        pool.refresh()
+
+
+async def _report(index, stats, pool, received, interval=0.5):
+    """Publish the supply and the demand of the pool to the main process."""
+    while True:
+        stats.report(index, pool.supply, pool.waiting, received[0])
+        await asyncio.sleep(interval)
+
+
+def _run_worker(index, stats, queue, host, port, kwargs):
+    # The workers are stopped by the main process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    proxies = asyncio.Queue()
+    server = Server(host, port, proxies, loop=loop, reuse_port=True, **kwargs)
+    server.start()
+    loop.add_signal_handler(signal.SIGTERM, server.stop)
+    pool = server._proxy_pool
+    pool.on_remove = SharedProxy.release
+    # The number of proxies received from the main process
+    received = [0]
+    threading.Thread(
+        target=_receive,
+        args=(index, stats, queue, proxies, loop, kwargs, received),
+        daemon=True,
+    ).start()
+    tasks = [
+        loop.create_task(_refresh(pool)),
+        loop.create_task(_report(index, stats, pool, received)),
+    ]
+    try:
+        loop.run_forever()
+    finally:
+        for task in tasks:
+            task.cancel()
+        loop.close()
@@ -0,0 +1,61 @@
+import asyncio
+
+import pytest
+from cachetools import TTLCache
+
+from proxybroker.api import Broker
+from proxybroker.errors import ResolveError
+from proxybroker.server import Server
+from proxybroker.utils import ScalableBloomFilter
+
+from .test_server import make_proxy
+
+
+def make_broker(server, watermarks):
+    # Broker.__init__ starts the providers and the checker, not needed here
+    broker = Broker.__new__(Broker)
+    broker._server = server
+    broker._watermarks = watermarks
+    return broker
+
+
+@pytest.mark.asyncio
+async def test_replenish_on_demand():
+    server = Server(
+        '127.0.0.1', 0, asyncio.Queue(), min_queue=0, loop=asyncio.get_running_loop()
+    )
+    for port in range(8000, 8005):
+        server._proxy_pool.put(make_proxy(port, types=('HTTP',)))
+    broker = make_broker(server, (1, 3))
+
+    replenish = asyncio.ensure_future(broker._replenish())
+    await asyncio.sleep(0.01)
+    assert not replenish.done()
+
+    # A request waits for an HTTPS proxy, the HTTP ones don't help it
+    request = asyncio.ensure_future(server._proxy_pool.get('HTTPS', timeout=1))
+    await asyncio.wait_for(replenish, 0.5)
+    assert not request.done()
+    request.cancel()
+
+
+@pytest.mark.asyncio
+async def test_handle_retries_unresolved(mocker):
+    broker = make_broker(None, (0, 0))
+    broker._seen = ScalableBloomFilter()
+    broker.unique_proxies = TTLCache(maxsize=10, ttl=60)
+    broker._timeout = broker._resolver = broker._verify_ssl = broker._loop = None
+    broker._countries = None
+    results = []
+    broker._push_to_result = results.append
+    proxy = make_proxy(8080)
+    create = mocker.patch(
+        'proxybroker.api.Proxy.create', side_effect=[ResolveError, proxy]
+    )
+
+    # The host failed to resolve, the next find tries it again
+    await broker._handle(('proxy.example.com', 8080))
+    await broker._handle(('proxy.example.com', 8080))
+    assert results == [proxy]
+    await broker._handle(('proxy.example.com', 8080))
+    assert create.call_count == 2
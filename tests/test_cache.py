@@ -0,0 +1,144 @@
+import asyncio
+
+import pytest
+
+from proxybroker.cache import Recorder, ResponseCache
+from proxybroker.utils import parse_headers
+
+
+def request(url='http://a.com/', **extra):
+    lines = ['GET %s HTTP/1.1' % url, 'Host: a.com']
+    lines += ['%s: %s' % (k.replace('_', '-'), v) for k, v in extra.items()]
+    return parse_headers(('\r\n'.join(lines) + '\r\n\r\n').encode())
+
+
+def response(*lines, status='200 OK'):
+    head = '\r\n'.join(['HTTP/1.1 ' + status] + list(lines)) + '\r\n\r\n'
+    return head.encode(), parse_headers(head.encode())
+
+
+def store(cache, req, resp, body=b'body'):
+    head, headers = resp
+    return cache.store(req['Path'], req, head, headers, body, '127.0.0.1:80')
+
+
+def test_key():
+    assert ResponseCache.key(request()) == 'http://a.com/'
+    assert ResponseCache.key(request(Cache_Control='no-cache')) is None
+    assert ResponseCache.key(request(Authorization='Basic x')) is None
+    assert ResponseCache.key(request(Range='bytes=0-1')) is None
+    head = b'POST http://a.com/ HTTP/1.1\r\nHost: a.com\r\n\r\n'
+    assert ResponseCache.key(parse_headers(head)) is None
+    # Origin-form, the same path of other hosts is another URL
+    assert ResponseCache.key(request('/x')) == 'http://a.com/x'
+    head = b'GET /x HTTP/1.1\r\nHost: b.com:8080\r\n\r\n'
+    assert ResponseCache.key(parse_headers(head)) == 'http://b.com:8080/x'
+    head = b'GET /x HTTP/1.1\r\n\r\n'
+    assert ResponseCache.key(parse_headers(head)) is None
+
+
+@pytest.mark.asyncio
+async def test_store():
+    cache = ResponseCache(1000, max_item_size=1000)
+    req = request()
+    assert not store(cache, req, response('Content-Length: 4'))
+    assert not store(
+        cache, req, response('Cache-Control: private, max-age=60', 'Content-Length: 4')
+    )
+    assert not store(
+        cache, req, response('Cache-Control: max-age=60', status='500 Error')
+    )
+    assert not store(cache, req, response('Cache-Control: max-age=60'))
+    assert store(cache, req, response('Cache-Control: max-age=60', 'Content-Length: 4'))
+    entry = await cache.get(req['Path'], req, 1)
+    assert entry.body == b'body'
+    assert ResponseCache.age(entry) == 0
+
+    expires = (
+        'Date: Mon, 01 Jan 2024 00:00:00 GMT',
+        'Expires: Mon, 01 Jan 2024 00:01:00 GMT',
+    )
+    assert store(
+        cache, request('http://b.com/'), response(*expires, 'Content-Length: 4')
+    )
+    expired = 'Cache-Control: max-age=60', 'Age: 60', 'Content-Length: 4'
+    assert not store(cache, request('http://c.com/'), response(*expired))
+
+
+@pytest.mark.asyncio
+async def test_vary():
+    cache = ResponseCache(1000, max_item_size=1000)
+    gzip = request(Accept_Encoding='gzip')
+    resp = response(
+        'Cache-Control: max-age=60', 'Vary: Accept-Encoding', 'Content-Length: 4'
+    )
+    assert store(cache, gzip, resp)
+    assert await cache.get(gzip['Path'], request(Accept_Encoding='gzip'), 1)
+    assert await cache.get(gzip['Path'], request(), 1) is None
+    assert store(cache, request(), resp, b'bod2')
+    assert (await cache.get(gzip['Path'], request(), 1)).body == b'bod2'
+    assert (await cache.get(gzip['Path'], gzip, 1)).body == b'body'
+    assert len(cache) == 1
+
+    star = response('Cache-Control: max-age=60', 'Vary: *', 'Content-Length: 4')
+    assert not store(cache, request('http://b.com/'), star)
+
+
+def test_eviction():
+    resp = response('Cache-Control: max-age=60', 'Content-Length: 100')
+    size = len(resp[0]) + 100
+    cache = ResponseCache(size * 2, max_item_size=size)
+    for url in ('http://a.com/', 'http://b.com/', 'http://c.com/'):
+        assert store(cache, request(url), resp, b'x' * 100)
+    assert len(cache) == 2 and cache.size == size * 2
+    assert cache._lookup('http://a.com/', request()) is None
+    assert not store(cache, request(), resp, b'x' * 101)
+
+
+@pytest.mark.asyncio
+async def test_coalescing():
+    cache = ResponseCache(1000, max_item_size=1000)
+    req = request()
+    assert cache.lock(req['Path'])
+    assert not cache.lock(req['Path'])
+    waiter = asyncio.ensure_future(cache.get(req['Path'], req, 1))
+    await asyncio.sleep(0)
+    assert not waiter.done()
+    store(cache, req, response('Cache-Control: max-age=60', 'Content-Length: 4'))
+    cache.unlock(req['Path'])
+    assert (await waiter).body == b'body'
+
+
+@pytest.mark.asyncio
+async def test_coalescing_release():
+    cache = ResponseCache(1000, max_item_size=1000)
+    req = request()
+    assert cache.lock(req['Path'])
+    waiter = asyncio.ensure_future(cache.get(req['Path'], req, 1))
+    await asyncio.sleep(0)
+    assert not ResponseCache.cacheable(response('Cache-Control: no-store')[1])
+    cache.release(req['Path'])
+    assert await waiter is None
+    # Not stored, the next requests don't wait until it's unlocked
+    assert await asyncio.wait_for(cache.get(req['Path'], req, 1), 0.1) is None
+    assert not cache.lock(req['Path'])
+    cache.unlock(req['Path'])
+    assert cache.lock(req['Path'])
+
+
+class BufferWriter:
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+
+
+def test_recorder():
+    writer = BufferWriter()
+    recorder = Recorder(writer, 5)
+    recorder.write(b'abc')
+    assert recorder.data == b'abc'
+    recorder.write(b'def')
+    assert recorder.data is None
+    assert writer.buffer == b'abcdef'
@@ -0,0 +1,33 @@
+from proxybroker.metrics import Histogram, Metrics
+
+
+def test_histogram():
+    histogram = Histogram(buckets=(0.1, 1))
+    for value in (0.05, 0.1, 0.5, 3):
+        histogram.observe(value)
+    assert histogram.render('time') == [
+        'time_bucket{le="0.1"} 2',
+        'time_bucket{le="1"} 3',
+        'time_bucket{le="+Inf"} 4',
+        'time_sum 3.65',
+        'time_count 4',
+    ]
+
+
+def test_metrics_render():
+    metrics = Metrics()
+    metrics.requests['HTTP'] += 2
+    metrics.errors['connection_timeout'] += 1
+    metrics.bytes['downstream'] += 100
+    metrics.gauge('proxybroker_pool_queue', 'Queued proxies', lambda: 3)
+    metrics.gauge('proxybroker_pool_proxies', 'Proxies', lambda: {'HTTP': 5}, 'scheme')
+    lines = metrics.render().splitlines()
+    assert '# TYPE proxybroker_requests_total counter' in lines
+    assert 'proxybroker_requests_total{scheme="HTTP"} 2' in lines
+    assert 'proxybroker_proxy_errors_total{error="connection_timeout"} 1' in lines
+    assert 'proxybroker_relayed_bytes_total{direction="downstream"} 100' in lines
+    assert 'proxybroker_request_duration_seconds_count 0' in lines
+    assert '# TYPE proxybroker_loop_lag_seconds histogram' in lines
+    assert '# TYPE proxybroker_pool_queue gauge' in lines
+    assert 'proxybroker_pool_queue 3' in lines
+    assert 'proxybroker_pool_proxies{scheme="HTTP"} 5' in lines
@@ -0,0 +1,37 @@
+import os
+import time
+
+from proxybroker.pagecache import PageCache
+
+
+def test_page_cache(tmp_path):
+    cache = PageCache(str(tmp_path), ttl=60)
+    assert cache.get('http://a.com/') is None
+    cache.put('http://a.com/', '127.0.0.1:80')
+    cache.put('http://b.com/', '127.0.0.1:80')
+    cache.put('http://a.com/', '127.0.0.2:80', data={'page': 2}, method='POST')
+    assert cache.get('http://a.com/') == '127.0.0.1:80'
+    assert cache.get('http://a.com/', data={'page': 2}, method='POST') == (
+        '127.0.0.2:80'
+    )
+    assert cache.get('http://a.com/', data={'page': 3}, method='POST') is None
+    # The same page is stored once
+    assert len(os.listdir(str(tmp_path / 'pages'))) == 2
+    assert len(os.listdir(str(tmp_path / 'requests'))) == 3
+
+
+def test_page_cache_ttl(tmp_path, mocker):
+    cache = PageCache(str(tmp_path), ttl=60)
+    cache.put('http://a.com/', '127.0.0.1:80')
+    mocker.patch('time.time', return_value=time.time() + 61)
+    assert cache.get('http://a.com/') is None
+    assert PageCache(str(tmp_path), replay=True).get('http://a.com/') == (
+        '127.0.0.1:80'
+    )
+
+
+def test_page_cache_volatile_params(tmp_path):
+    cache = PageCache(str(tmp_path), replay=True)
+    cache.put('http://a.com/list?skip=0&ts=1600000000000', '127.0.0.1:80')
+    assert cache.get('http://a.com/list?skip=0&ts=1700000000000') == ('127.0.0.1:80')
+    assert cache.get('http://a.com/list?skip=1&ts=1600000000000') is None
@@ -0,0 +1,174 @@
+import asyncio
+import threading
+
+import aiohttp
+import pytest
+
+from proxybroker.pagecache import PageCache
+from proxybroker import providers
+from proxybroker.providers import PARSE_IN_THREAD_SIZE, Nntime_com, Provider
+
+PAGE = b'127.0.0.1:80\n127.0.0.2:8080\n'
+
+
+async def start_site():
+    requests, connections = [], []
+
+    async def handle(reader, writer):
+        connections.append(writer)
+        while True:
+            head = await reader.readuntil(b'\r\n\r\n')
+            if not head:
+                break
+            requests.append(head.decode())
+            writer.write(
+                b'HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\n'
+                b'Content-Length: %d\r\n\r\n%s' % (len(PAGE), PAGE)
+            )
+            await writer.drain()
+
+    server = await asyncio.start_server(handle, '127.0.0.1', 0)
+    url = 'http://127.0.0.1:%d/' % server.sockets[0].getsockname()[1]
+    return server, url, requests, connections
+
+
+@pytest.mark.asyncio
+async def test_get_proxies_shared_session():
+    server, url, requests, connections = await start_site()
+    providers = [Provider(url + 'a'), Provider(url + 'b')]
+    providers[1]._cookies = {'NCR': '1'}
+    async with aiohttp.ClientSession() as session:
+        for provider in providers:
+            await provider.get_proxies(session)
+    server.close()
+
+    expected = {('127.0.0.1', '80', ()), ('127.0.0.2', '8080', ())}
+    assert all(provider.proxies == expected for provider in providers)
+    # The second provider reuses the connection to the host
+    assert len(requests) == 2 and len(connections) == 1
+    assert 'User-Agent: PxBroker' in requests[0]
+    assert 'NCR=1' not in requests[0] and 'NCR=1' in requests[1]
+
+
+@pytest.mark.asyncio
+async def test_get_proxies_shared_session_max_conn():
+    active, peak = [0], [0]
+
+    async def handle(reader, writer):
+        await reader.readuntil(b'\r\n\r\n')
+        active[0] += 1
+        peak[0] = max(peak[0], active[0])
+        await asyncio.sleep(0.05)
+        active[0] -= 1
+        writer.write(
+            b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n%s' % (len(PAGE), PAGE)
+        )
+        await writer.drain()
+        writer.close()
+
+    class Pages(Provider):
+        async def _pipe(self):
+            await self._find_on_pages([self.url + str(i) for i in range(3)])
+
+    server = await asyncio.start_server(handle, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    provider = Pages('http://127.0.0.1:%d/' % port, max_conn=1)
+    async with aiohttp.ClientSession() as session:
+        await provider.get_proxies(session)
+    server.close()
+    assert len(provider.proxies) == 2
+    assert peak[0] == 1
+
+
+@pytest.mark.asyncio
+async def test_get_proxies_own_session():
+    server, url, requests, _ = await start_site()
+    provider = Provider(url)
+    assert await provider.get_proxies() == {
+        ('127.0.0.1', '80', ()),
+        ('127.0.0.2', '8080', ()),
+    }
+    assert provider._session.closed
+    server.close()
+
+
+@pytest.mark.asyncio
+async def test_parse_in_thread():
+    threads = []
+
+    class Recording(Provider):
+        def find_proxies(self, page):
+            threads.append(threading.get_ident())
+            return super().find_proxies(page)
+
+    provider = Recording()
+    small = '127.0.0.1:80\n'
+    large = small + ' ' * PARSE_IN_THREAD_SIZE + '127.0.0.2:8080\n'
+    assert await provider._parse(small) == [('127.0.0.1', '80')]
+    assert await provider._parse(large) == [('127.0.0.1', '80'), ('127.0.0.2', '8080')]
+    assert threads[0] == threading.get_ident() != threads[1]
+
+
+@pytest.mark.asyncio
+async def test_parse_in_process(mocker):
+    processes = mocker.spy(providers, '_get_processes')
+    provider = Nntime_com()
+    small = '<script>a=8;b=0;</script>127.0.0.1<script>(":"+a+b+b+b)</script>\n'
+    large = small + ' ' * PARSE_IN_THREAD_SIZE + '127.0.0.2 8080\n'
+    assert await provider._parse(small) == [('127.0.0.1', '8000')]
+    assert not processes.called
+    assert await provider._parse(large) == [
+        ('127.0.0.1', '8000'),
+        ('127.0.0.2', '8080'),
+    ]
+    assert processes.called
+
+
+@pytest.mark.asyncio
+async def test_get_proxies_stream():
+    found = []
+    first_found = asyncio.Event()
+
+    async def handle(reader, writer):
+        await reader.readuntil(b'\r\n\r\n')
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: 43\r\n\r\n')
+        writer.write(b'127.0.0.1:80\n127.0.0.2:80')
+        await writer.drain()
+        # The rest is sent once the first proxy is found
+        await first_found.wait()
+        writer.write(b'80\n127.0.0.3:3128\n')
+        await writer.drain()
+        writer.close()
+
+    def on_found(proxy):
+        found.append(proxy)
+        first_found.set()
+
+    server = await asyncio.start_server(handle, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    provider = Provider('http://127.0.0.1:%d/' % port, stream=True)
+    async with aiohttp.ClientSession() as session:
+        proxies = await asyncio.wait_for(provider.get_proxies(session, on_found), 5)
+    server.close()
+    assert found == [
+        ('127.0.0.1', '80', ()),
+        ('127.0.0.2', '8080', ()),
+        ('127.0.0.3', '3128', ()),
+    ]
+    assert proxies == set(found)
+
+
+@pytest.mark.asyncio
+async def test_get_proxies_replay(tmp_path):
+    server, url, requests, _ = await start_site()
+    pages = PageCache(str(tmp_path))
+    provider = Provider(url, stream=True)
+    assert len(await provider.get_proxies(pages=pages)) == 2
+    server.close()
+    await server.wait_closed()
+
+    provider = Provider(url)
+    replay = PageCache(str(tmp_path), replay=True)
+    assert len(await provider.get_proxies(pages=replay)) == 2
+    assert await Provider(url + 'missing').get_proxies(pages=replay) == set()
+    assert len(requests) == 1
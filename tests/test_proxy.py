@@ -6,6 +6,7 @@ import pytest
 from proxybroker import Proxy
 from proxybroker.errors import ProxyConnError, ProxyTimeoutError, ResolveError
 from proxybroker.negotiators import HttpsNgtr
+from proxybroker.proxy import ProxyConn
 from proxybroker.utils import log as logger
 
 from .utils import ResolveResult, future_iter
@@ -124,6 +125,38 @@ def test_error_rate():
     assert p.error_rate == 0.5
 
 
+def test_state():
+    p = Proxy('127.0.0.1', '80')
+    p.types.update({'HTTP': 'High', 'SOCKS5': None})
+    p.stat['requests'] = 4
+    p.log('Error', time.time() - 1, ProxyConnError)
+    restored = Proxy.from_state(p.get_state(), timeout=3)
+    assert restored.get_state() == p.get_state()
+    assert restored.types == p.types
+    assert restored.priority == p.priority
+    assert restored.ewma_resp_time == p.ewma_resp_time
+
+
+def test_decay():
+    p = Proxy('127.0.0.1', '80')
+    p.stat['requests'] = 10
+    p.stat['errors'].update({'connection_failed': 6, 'connection_timeout': 1})
+    p._runtimes = [1, 2, 3, 4]
+    p.decay(0.5)
+    assert p.stat['requests'] == 5
+    assert p.stat['errors'] == {'connection_failed': 3}
+    assert p._runtimes == [3, 4]
+
+
+def test_add_transfer():
+    p = Proxy('127.0.0.1', '80')
+    assert p.throughput == 0
+    p.add_transfer(1000000, 2)
+    assert p.throughput == 500000
+    p.add_transfer(1000000, 1)
+    assert p.throughput == 650000
+
+
 def test_geo():
     p = Proxy('127.0.0.1', '80')
     assert p.geo.code == '--'
@@ -141,6 +174,23 @@ def test_ngtr():
     assert p.ngtr._proxy is p
 
 
+def test_conn():
+    p = Proxy('127.0.0.1', '80')
+    first, second = ProxyConn(p), ProxyConn(p)
+    first.ngtr = 'HTTPS'
+    assert isinstance(first.ngtr, HttpsNgtr)
+    assert first.ngtr._proxy is first
+    assert second.ngtr is None and p.ngtr is None
+    assert first.host == p.host and first.port == p.port
+
+    first.log('Error', time.time() - 1, ProxyConnError)
+    second.log('Request', time.time() - 3)
+    assert p.stat['errors'][ProxyConnError.errmsg] == 1
+    assert p.get_log()[0][0] == 'HTTPS'
+    assert len(p._runtimes) == 2
+    assert p.ewma_resp_time > 1
+
+
 def test_log(log):
     p = Proxy('127.0.0.1', '80')
     msg = 'MSG'
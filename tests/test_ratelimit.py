@@ -0,0 +1,35 @@
+from proxybroker.ratelimit import RateLimiter, TokenBucket
+
+from .test_server import make_proxy
+
+
+def test_token_bucket(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr('proxybroker.ratelimit.time.monotonic', lambda: now[0])
+    bucket = TokenBucket(2, burst=3)
+    for _ in range(3):
+        assert bucket.ready()
+        bucket.take()
+    assert not bucket.ready()
+    now[0] += 0.5
+    assert bucket.ready()
+    bucket.take()
+    bucket.take()
+    now[0] += 0.5
+    assert not bucket.ready()
+    now[0] += 10
+    assert bucket.tokens == 3
+
+
+def test_rate_limiter():
+    first, second = make_proxy(8001), make_proxy(8002)
+    limiter = RateLimiter(domain_rate=0.01)
+    assert limiter.enabled
+    assert limiter.ready(first, 'a.com')
+    limiter.take(first, 'a.com')
+    assert not limiter.ready(first, 'a.com')
+    assert limiter.ready(first, 'b.com')
+    assert limiter.ready(second, 'a.com')
+    # Only the requests to domains are limited
+    assert limiter.ready(first)
+    assert not RateLimiter().enabled
@@ -0,0 +1,65 @@
+import asyncio
+import os
+
+import pytest
+
+from proxybroker.relay import relay
+
+
+async def echo(reader, writer):
+    while True:
+        data = await reader.read(65536)
+        if not data:
+            break
+        writer.write(data)
+        await writer.drain()
+    writer.close()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('splice', [False, True])
+async def test_relay(splice):
+    upstream = await asyncio.start_server(echo, '127.0.0.1', 0)
+    relayed = asyncio.get_running_loop().create_future()
+    received = [0, 0]
+
+    async def handle(reader, writer):
+        conn = await asyncio.open_connection(*upstream.sockets[0].getsockname())
+        try:
+            await relay(
+                (reader, writer), conn, timeout=2, splice=splice, received=received
+            )
+        finally:
+            relayed.set_result(True)
+
+    server = await asyncio.start_server(handle, '127.0.0.1', 0)
+    reader, writer = await asyncio.open_connection(*server.sockets[0].getsockname())
+    payload = os.urandom(1 << 20)
+    writer.write(payload)
+    writer.write_eof()
+    assert await asyncio.wait_for(reader.read(), 5) == payload
+    assert await asyncio.wait_for(relayed, 5)
+    assert received == [len(payload), len(payload)]
+    writer.close()
+    server.close()
+    upstream.close()
+
+
+@pytest.mark.asyncio
+async def test_relay_timeout():
+    upstream = await asyncio.start_server(lambda r, w: None, '127.0.0.1', 0)
+    relayed = asyncio.get_running_loop().create_future()
+
+    async def handle(reader, writer):
+        conn = await asyncio.open_connection(*upstream.sockets[0].getsockname())
+        try:
+            await relay((reader, writer), conn, timeout=0.1)
+        except asyncio.TimeoutError as e:
+            relayed.set_result(e)
+
+    server = await asyncio.start_server(handle, '127.0.0.1', 0)
+    reader, writer = await asyncio.open_connection(*server.sockets[0].getsockname())
+    assert isinstance(await asyncio.wait_for(relayed, 5), asyncio.TimeoutError)
+    writer.close()
+    server.close()
+    upstream.close()
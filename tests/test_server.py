@@ -0,0 +1,1028 @@
+import asyncio
+import time
+from urllib.parse import urlparse
+
+import pytest
+
+from proxybroker import Proxy
+from proxybroker.errors import NoProxyError
+from proxybroker.proxy import ProxyConn
+from proxybroker.server import (
+    ConnPool,
+    ProxyPool,
+    Server,
+    _has_length,
+    _is_keep_alive,
+    _remove_header,
+    _set_connection,
+)
+
+
+def make_proxy(port, types=('HTTP',), requests=0, errors=0, runtimes=()):
+    proxy = Proxy('127.0.0.1', port)
+    proxy.types.update({tp: None for tp in types})
+    proxy.stat['requests'] = requests
+    if errors:
+        proxy.stat['errors']['connection_failed'] = errors
+    proxy._runtimes = list(runtimes)
+    return proxy
+
+
+@pytest.fixture
+def pool():
+    return ProxyPool(asyncio.Queue(), min_req_proxy=5, min_queue=0)
+
+
+@pytest.mark.asyncio
+async def test_pool_get_best(pool):
+    slow = make_proxy(8001, requests=10, runtimes=[3])
+    fast = make_proxy(8002, requests=10, runtimes=[1])
+    bad = make_proxy(8003, requests=10, errors=4, runtimes=[0.5])
+    for proxy in (slow, bad, fast):
+        pool.put(proxy)
+    assert await pool.get('http') is fast
+    assert await pool.get('http') is slow
+    assert await pool.get('http') is bad
+    assert pool.available == 0
+    assert len(pool) == 3
+
+
+@pytest.mark.asyncio
+async def test_pool_get_by_scheme(pool):
+    http = make_proxy(8001, types=('HTTP',), requests=10, runtimes=[1])
+    https = make_proxy(8002, types=('HTTPS',), requests=10, runtimes=[2])
+    newcomer = make_proxy(8003, types=('HTTP',))
+    for proxy in (http, https, newcomer):
+        pool.put(proxy)
+    assert await pool.get('HTTPS') is https
+    assert await pool.get('HTTP') is newcomer
+    assert await pool.get('HTTP') is http
+
+
+@pytest.mark.asyncio
+async def test_pool_shared_entry(pool):
+    both = make_proxy(8001, types=('HTTP', 'HTTPS'), requests=10, runtimes=[1])
+    other = make_proxy(8002, types=('HTTP', 'HTTPS'), requests=10, runtimes=[2])
+    pool.put(both)
+    pool.put(other)
+    assert await pool.get('HTTP') is both
+    # the stale copy in the HTTPS queue is skipped
+    assert await pool.get('HTTPS') is other
+
+
+@pytest.mark.asyncio
+async def test_pool_stale_priority(pool):
+    first = make_proxy(8001, requests=10, runtimes=[1])
+    second = make_proxy(8002, requests=10, runtimes=[2])
+    pool.put(first)
+    pool.put(second)
+    first._runtimes = [5]
+    pool.put(first)
+    assert await pool.get('HTTP') is second
+    assert await pool.get('HTTP') is first
+
+
+@pytest.mark.asyncio
+async def test_pool_remove(pool):
+    proxy = make_proxy(8001, requests=10, runtimes=[1])
+    pool.put(proxy)
+    assert pool.remove('127.0.0.1', 8001) is proxy
+    assert pool.remove('127.0.0.1', 8001) is None
+    assert len(pool) == 0
+
+
+def test_pool_evicts_bad_proxy(pool):
+    proxy = make_proxy(8001, requests=10, errors=8, runtimes=[1])
+    pool.put(proxy)
+    assert len(pool) == 0
+
+
+@pytest.mark.asyncio
+async def test_pool_quarantine():
+    pool = ProxyPool(asyncio.Queue(), min_req_proxy=5, min_queue=0, quarantine_time=1)
+    server = await asyncio.start_server(lambda r, w: w.close(), '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    proxy = make_proxy(port, requests=10, errors=8, runtimes=[1])
+    pool.put(proxy)
+    assert len(pool) == 0 and pool.quarantined == 1
+    await pool.reprobe()
+    assert pool.quarantined == 1
+
+    pool._quarantine[('127.0.0.1', port)][1] = 0
+    await pool.reprobe()
+    assert pool.quarantined == 0 and list(pool) == [proxy]
+    assert proxy.stat['requests'] == 4
+    assert pool.groups['newcomers'] == 1
+
+    # Fails again, so the backoff is doubled
+    proxy.stat['requests'] += 2
+    proxy.stat['errors']['connection_failed'] += 2
+    pool.put(await pool.get('HTTP'))
+    until = pool._quarantine[('127.0.0.1', port)][1]
+    assert 1 < until - time.time() <= 2
+
+    server.close()
+    await server.wait_closed()
+    pool._quarantine[('127.0.0.1', port)][1] = 0
+    await pool.reprobe()
+    assert pool.quarantined == 1
+    pool._quarantine[('127.0.0.1', port)][1] = 0
+    pool._max_quarantine_time = 4
+    await pool.reprobe()
+    assert pool.quarantined == 0 and len(pool) == 0
+    assert pool.remove('127.0.0.1', port) is None
+
+
+@pytest.mark.asyncio
+async def test_pool_probe_request():
+    requests = []
+
+    async def handle(reader, writer):
+        head = await reader.readuntil(b'\r\n\r\n')
+        requests.append(head)
+        status = b'200 OK' if b'/ok ' in head else b'502 Bad Gateway'
+        writer.write(b'HTTP/1.1 %s\r\nContent-Length: 0\r\n\r\n' % status)
+        await writer.drain()
+        writer.close()
+
+    server = await asyncio.start_server(handle, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    proxy = make_proxy(port)
+    pool = ProxyPool(asyncio.Queue(), probe_url='http://example.com/ok')
+    assert await pool._probe(proxy)
+    assert requests[-1].startswith(b'GET http://example.com/ok HTTP/1.1\r\n')
+    assert b'Host: example.com\r\n' in requests[-1]
+    pool = ProxyPool(asyncio.Queue(), probe_url='http://example.com/fail')
+    assert not await pool._probe(proxy)
+    server.close()
+    await server.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_pool_quarantine_pardon(mocker):
+    pool = ProxyPool(asyncio.Queue(), min_req_proxy=5, min_queue=0, quarantine_time=1)
+    mocker.patch.object(pool, '_probe', mocker.AsyncMock(return_value=True))
+    proxy = make_proxy(8001, requests=10, errors=8, runtimes=[1])
+    pool.put(proxy)
+    pool._quarantine[('127.0.0.1', 8001)][1] = 0
+    await pool.reprobe()
+    assert pool._strikes[('127.0.0.1', 8001)] == 1
+
+    # Not forgotten until it serves min_req_proxy requests
+    proxy.stat['errors'].clear()
+    for _ in range(5):
+        proxy.stat['requests'] += 1
+        pool.put(await pool.get('HTTP'))
+        assert (('127.0.0.1', 8001) in pool._strikes) == (_ < 4)
+    assert len(pool) == 1
+
+
+@pytest.mark.asyncio
+async def test_pool_import():
+    queue = asyncio.Queue()
+    pool = ProxyPool(queue, min_queue=5)
+    https = make_proxy(8001, types=('HTTPS',))
+    http = make_proxy(8002, types=('HTTP',))
+    for proxy in (https, http, None):
+        queue.put_nowait(proxy)
+    assert await pool.get('HTTP') is http
+    assert pool.available == 1
+    # No more proxies will come, so it waits for the one in use
+    with pytest.raises(asyncio.TimeoutError):
+        await pool.get('HTTP', timeout=0.01)
+    pool.remove(http.host, http.port)
+    with pytest.raises(NoProxyError):
+        await pool.get('HTTP')
+
+
+@pytest.mark.asyncio
+async def test_pool_wait():
+    queue = asyncio.Queue()
+    pool = ProxyPool(queue, min_queue=0)
+    proxy = make_proxy(8001)
+    queue.put_nowait(proxy)
+    assert await pool.get('HTTP') is proxy
+    waiter = asyncio.ensure_future(pool.get('HTTP'))
+    await asyncio.sleep(0)
+    assert pool.waiting == 1 and pool.demand.is_set()
+
+    queue.put_nowait(None)
+    await asyncio.sleep(0)
+    assert not waiter.done()
+    pool.put(proxy)
+    assert await waiter is proxy
+    assert pool.waiting == 0 and not pool.demand.is_set()
+
+
+@pytest.mark.asyncio
+async def test_pool_strategy():
+    pool = ProxyPool(asyncio.Queue(), min_queue=0, strategy='round-robin')
+    first = make_proxy(8001, requests=10, runtimes=[3])
+    second = make_proxy(8002, requests=10, runtimes=[1])
+    pool.put(first)
+    pool.put(second)
+    assert await pool.get('HTTP') is first
+    with pytest.raises(ValueError):
+        ProxyPool(asyncio.Queue(), strategy='unknown')
+
+
+@pytest.mark.asyncio
+async def test_pool_max_concurrency():
+    pool = ProxyPool(asyncio.Queue(), min_queue=0, max_concurrency=2)
+    best = make_proxy(8001, requests=10, runtimes=[1])
+    other = make_proxy(8002, requests=10, runtimes=[2])
+    pool.put(best)
+    pool.put(other)
+    assert await pool.get('HTTP') is best
+    assert await pool.get('HTTP') is best
+    assert await pool.get('HTTP') is other
+    pool.put(best)
+    assert await pool.get('HTTP') is best
+
+
+@pytest.mark.asyncio
+async def test_pool_remove_in_use(pool):
+    proxy = make_proxy(8001, requests=10, runtimes=[1])
+    pool.put(proxy)
+    assert await pool.get('HTTP') is proxy
+    assert pool.remove(proxy.host, proxy.port) is proxy
+    pool.put(proxy)
+    assert len(pool) == 0
+
+
+class FakeWriter:
+    def __init__(self):
+        self.transport = self
+        self.closed = False
+
+    def is_closing(self):
+        return self.closed
+
+    def close(self):
+        self.closed = True
+
+
+def make_conn(proxy):
+    conn = ProxyConn(proxy)
+    conn._reader['conn'] = asyncio.StreamReader()
+    conn._writer['conn'] = FakeWriter()
+    conn._closed = False
+    return conn
+
+
+@pytest.mark.asyncio
+async def test_conn_pool():
+    conn_pool = ConnPool(max_idle=1, idle_timeout=30)
+    proxy = make_proxy(8001)
+    conn, extra = make_conn(proxy), make_conn(proxy)
+    conn_pool.release(conn, used=False)
+    conn_pool.release(extra)
+    assert conn_pool.idle(proxy) == 1
+    assert extra.reader is None
+
+    assert conn_pool.acquire(proxy) is conn
+    assert proxy.stat['requests'] == 0
+    assert conn_pool.acquire(proxy) is None
+
+    conn_pool.release(conn)
+    conn.reader.feed_eof()
+    assert conn_pool.acquire(proxy) is None
+    assert conn.reader is None
+
+
+@pytest.mark.asyncio
+async def test_conn_pool_expire():
+    conn_pool = ConnPool(max_idle=2, idle_timeout=0)
+    proxy = make_proxy(8001)
+    conn_pool.release(make_conn(proxy))
+    conn_pool.expire()
+    assert len(conn_pool) == 0
+
+
+def test_keep_alive():
+    assert _is_keep_alive({'Version': 'HTTP/1.1'})
+    assert not _is_keep_alive({'Version': 'HTTP/1.1', 'Connection': 'Close'})
+    assert not _is_keep_alive({'Version': 'HTTP/1.1', 'Proxy-Connection': 'close'})
+    assert not _is_keep_alive({'Version': 'HTTP/1.0'})
+    assert _is_keep_alive({'Version': 'HTTP/1.0', 'Connection': 'keep-alive'})
+
+
+def test_set_connection():
+    head = b'HTTP/1.1 200 OK\r\nConnection: keep-alive\r\nContent-Length: 0\r\n\r\n'
+    assert _set_connection(head, b'close') == (
+        b'HTTP/1.1 200 OK\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+    )
+
+
+def test_has_length():
+    assert _has_length({'Status': 200, 'Content-Length': '5'}, 'GET')
+    assert _has_length({'Status': 200, 'Transfer-Encoding': 'chunked'}, 'GET')
+    assert _has_length({'Status': 204}, 'GET')
+    assert _has_length({'Status': 200}, 'HEAD')
+    assert not _has_length({'Status': 200}, 'GET')
+
+
+@pytest.mark.asyncio
+async def test_parse_pipelined_requests():
+    server = Server('127.0.0.1', 0, asyncio.Queue(), loop=asyncio.get_running_loop())
+    reader = asyncio.StreamReader()
+    reader.feed_data(
+        b'POST http://example.com/ HTTP/1.1\r\nContent-Length: 3\r\n\r\nabc'
+        b'GET http://example.com/ HTTP/1.1\r\n\r\n'
+    )
+    reader.feed_eof()
+    request, headers = await server._parse_request(reader)
+    assert request.endswith(b'\r\n\r\nabc')
+    assert headers['Method'] == 'POST'
+    request, headers = await server._parse_request(reader)
+    assert headers['Method'] == 'GET'
+    with pytest.raises(asyncio.IncompleteReadError):
+        await server._parse_request(reader)
+
+
+class BufferWriter:
+    def __init__(self):
+        self.data = b''
+
+    def write(self, data):
+        self.data += data
+
+    async def drain(self):
+        pass
+
+
+@pytest.mark.asyncio
+async def test_send_chunked_body():
+    server = Server('127.0.0.1', 0, asyncio.Queue(), loop=asyncio.get_running_loop())
+    reader, writer = asyncio.StreamReader(), BufferWriter()
+    body = b'3\r\nabc\r\n0\r\nX-Trailer: 1\r\n\r\n'
+    reader.feed_data(body + b'GET http://example.com/ HTTP/1.1\r\n\r\n')
+    await server._send_body(reader, writer, {'Transfer-Encoding': 'chunked'})
+    assert writer.data == body
+    request, headers = await server._parse_request(reader)
+    assert headers['Method'] == 'GET'
+
+
+@pytest.mark.asyncio
+async def test_is_whole():
+    server = Server('127.0.0.1', 0, asyncio.Queue(), loop=asyncio.get_running_loop())
+    head = b'POST / HTTP/1.1\r\nContent-Length: 3\r\n\r\n'
+    headers = {'Method': 'POST', 'Content-Length': '3'}
+    assert server._is_whole(head + b'abc', headers)
+    assert not server._is_whole(head, headers)
+    assert server._is_framed(headers)
+    headers = {'Method': 'POST', 'Transfer-Encoding': 'chunked'}
+    assert not server._is_whole(head, headers)
+    assert server._is_framed(headers)
+    assert not server._is_framed({'Method': 'CONNECT'})
+
+
+@pytest.mark.asyncio
+async def test_pool_get_nowait():
+    pool = ProxyPool(asyncio.Queue(), min_queue=5)
+    proxy = make_proxy(8001, requests=10, runtimes=[1])
+    pool.put(proxy)
+    assert pool.get_nowait('HTTP') is proxy
+    assert pool.get_nowait('HTTP') is None
+
+
+@pytest.mark.asyncio
+async def test_hedged_connect():
+    server = Server(
+        '127.0.0.1',
+        0,
+        asyncio.Queue(),
+        timeout=0.2,
+        min_queue=0,
+        hedge_percentile=95,
+        loop=asyncio.get_running_loop(),
+    )
+    slow = make_proxy(8001, requests=10, runtimes=[1])
+    fast = make_proxy(8002, requests=10, runtimes=[2])
+    server._proxy_pool.put(slow)
+    server._proxy_pool.put(fast)
+
+    async def establish(conn, proto, headers):
+        if conn.proxy is slow:
+            await asyncio.sleep(10)
+
+    server._establish = establish
+    assert await server._proxy_pool.get('HTTP') is slow
+    conn, proto = await server._connect(ProxyConn(slow), 'HTTP', 'HTTP', {})
+    assert conn.proxy is fast
+    assert slow.stat['errors']['connection_timeout'] == 1
+    assert server._proxy_pool.get_nowait('HTTP') is slow
+
+
+@pytest.mark.asyncio
+async def test_hedge_delay():
+    server = Server(
+        '127.0.0.1',
+        0,
+        asyncio.Queue(),
+        timeout=8,
+        hedge_percentile=90,
+        loop=asyncio.get_running_loop(),
+    )
+    assert server._hedge_delay() == 4
+    server._connect_times.extend(i / 10 for i in range(1, 21))
+    assert server._hedge_delay() == 1.9
+
+
+@pytest.mark.asyncio
+async def test_pool_sticky_session():
+    pool = ProxyPool(asyncio.Queue(), min_queue=0, session_ttl=60)
+    proxies = [make_proxy(8000 + i, requests=10, runtimes=[1]) for i in range(5)]
+    for proxy in proxies:
+        pool.put(proxy)
+    first = await pool.get('HTTP', 'session')
+    pool.put(first)
+    assert await pool.get('HTTP', 'session') is first
+    pool.put(first)
+
+    other = next(p for p in proxies if p is not first)
+    pool.stick('session', other)
+    assert await pool.get('HTTP', 'session') is other
+    pool.put(other)
+    pool.remove(other.host, other.port)
+    assert await pool.get('HTTP', 'session') is not other
+
+
+@pytest.mark.asyncio
+async def test_pool_sticky_session_concurrency():
+    pool = ProxyPool(asyncio.Queue(), min_queue=0, session_ttl=60, max_concurrency=1)
+    proxies = [make_proxy(8000 + i, requests=10, runtimes=[1]) for i in range(3)]
+    for proxy in proxies:
+        pool.put(proxy)
+    chosen = [await pool.get('HTTP', 'session') for _ in range(3)]
+    assert set(chosen) == set(proxies)
+    assert all(n == 1 for n in pool._inflight.values())
+    with pytest.raises(asyncio.TimeoutError):
+        await pool.get('HTTP', 'session', timeout=0.01)
+    pool.put(chosen[0])
+    assert await pool.get('HTTP', 'session') is chosen[0]
+
+
+def test_remove_header():
+    request = b'GET / HTTP/1.1\r\nX-Proxy-Session: 1\r\nHost: a\r\n\r\nbody'
+    assert _remove_header(request, b'X-Proxy-Session') == (
+        b'GET / HTTP/1.1\r\nHost: a\r\n\r\nbody'
+    )
+
+
+def test_pool_counts(pool):
+    proxies = [
+        make_proxy(8001, types=('HTTP', 'HTTPS'), requests=10),
+        make_proxy(8002, types=('HTTPS',)),
+    ]
+    for proxy in proxies:
+        pool.put(proxy)
+    assert pool.by_scheme == {'HTTP': 1, 'HTTPS': 2}
+    assert pool.groups == {'newcomers': 1, 'ranked': 1, 'in_use': 0}
+    pool.remove(proxies[0].host, proxies[0].port)
+    assert +pool.by_scheme == {'HTTPS': 1}
+
+
+@pytest.mark.asyncio
+async def test_snapshot(tmp_path):
+    path = str(tmp_path / 'snapshot.json')
+    server = Server('127.0.0.1', 0, asyncio.Queue(), snapshot_path=path)
+    proxies = [make_proxy(8001, requests=10, runtimes=[1]), make_proxy(8002)]
+    for proxy in proxies:
+        server._proxy_pool.put(proxy)
+    server._save_snapshot()
+
+    restored = Server('127.0.0.1', 0, asyncio.Queue(), snapshot_path=path)
+    restored._load_snapshot()
+    pool = restored._proxy_pool
+    assert sorted(p.get_state()['port'] for p in pool) == [8001, 8002]
+    assert pool.groups == {'newcomers': 1, 'ranked': 1, 'in_use': 0}
+    assert pool.top('HTTP', 1)[0].avg_resp_time == 1
+
+
+@pytest.mark.asyncio
+async def test_pool_domain_failures(pool):
+    fast = make_proxy(8001, requests=10, runtimes=[1])
+    slow = make_proxy(8002, requests=10, runtimes=[2])
+    for proxy in (fast, slow):
+        pool.put(proxy)
+    for _ in range(5):
+        pool.count(fast, 'a.com', failed=True)
+        pool.count(slow, 'a.com', failed=False)
+    assert await pool.get('HTTP', domain='a.com') is slow
+    pool.put(slow)
+    assert await pool.get('HTTP', domain='b.com') is fast
+    pool.put(fast)
+
+    for _ in range(6):
+        pool.count(slow, 'a.com', failed=True)
+    # All of them fail for the domain, so the best one is given
+    assert await pool.get('HTTP', domain='a.com') is fast
+    assert pool.available == 1
+
+
+@pytest.mark.asyncio
+async def test_pool_domain_failures_max_skips():
+    pool = ProxyPool(asyncio.Queue(), min_queue=0)
+    proxies = [
+        make_proxy(8000 + i, requests=10, runtimes=[i / 10 + 1]) for i in range(12)
+    ]
+    for proxy in proxies:
+        pool.put(proxy)
+        if proxy is not proxies[10]:
+            for _ in range(5):
+                pool.count(proxy, 'a.com', failed=True)
+    # Ten failing ones are passed over, the next one is checked too
+    assert pool.get_nowait('HTTP', 'a.com') is proxies[10]
+    pool.put(proxies[10])
+
+    for _ in range(5):
+        pool.count(proxies[10], 'a.com', failed=True)
+    # More of them fail for the domain than are passed over, the best one
+    # is given rather than the one after the skipped ones
+    assert pool.get_nowait('HTTP', 'a.com') is proxies[0]
+
+
+@pytest.mark.asyncio
+async def test_pool_sticky_domain_failures():
+    pool = ProxyPool(asyncio.Queue(), min_queue=0, session_ttl=60)
+    proxies = [make_proxy(8000 + i, requests=10, runtimes=[1]) for i in range(3)]
+    for proxy in proxies:
+        pool.put(proxy)
+    pinned = proxies[0]
+    pool.stick('session', pinned)
+    for _ in range(5):
+        pool.count(pinned, 'a.com', failed=True)
+    # A new session isn't given a failing proxy either
+    for session in range(10):
+        proxy = await pool.get('HTTP', str(session), 'a.com')
+        assert proxy is not pinned
+        pool.put(proxy)
+
+    other = await pool.get('HTTP', 'session', 'a.com')
+    assert other is not pinned
+    pool.put(other)
+    assert await pool.get('HTTP', 'session', 'b.com') is other
+
+
+@pytest.mark.asyncio
+async def test_pool_rate_limit():
+    pool = ProxyPool(asyncio.Queue(), min_queue=0, rate_limit=0.01)
+    fast = make_proxy(8001, requests=10, runtimes=[1])
+    slow = make_proxy(8002, requests=10, runtimes=[2])
+    for proxy in (fast, slow):
+        pool.put(proxy)
+    assert await pool.get('HTTP') is fast
+    pool.put(fast)
+    # The bucket of the best proxy is empty
+    assert await pool.get('HTTP') is slow
+    pool.put(slow)
+    # All of them are limited, none is given
+    assert pool.get_nowait('HTTP') is None
+    with pytest.raises(asyncio.TimeoutError):
+        await pool.get('HTTP', timeout=0.01)
+
+
+@pytest.mark.asyncio
+async def test_pool_rate_limit_max_skips():
+    pool = ProxyPool(asyncio.Queue(), min_queue=0, rate_limit=0.01)
+    proxies = [
+        make_proxy(8000 + i, requests=10, runtimes=[i / 10 + 1]) for i in range(12)
+    ]
+    for proxy in proxies:
+        pool.put(proxy)
+    for proxy in proxies:
+        pool._limiter.take(proxy)
+    # More limited proxies than are passed over, none of them is given
+    assert pool.get_nowait('HTTP') is None
+    assert all(b.tokens >= 0 for b in pool._limiter._proxies.values())
+
+
+@pytest.mark.asyncio
+async def test_pool_rate_limit_wait():
+    queue = asyncio.Queue()
+    queue.put_nowait(None)
+    pool = ProxyPool(queue, min_queue=0, rate_limit=20, session_ttl=60)
+    proxy = make_proxy(8001, requests=10, runtimes=[1])
+    pool.put(proxy)
+    for _ in range(20):
+        pool.put(await pool.get('HTTP'))
+    assert pool._get_sticky('HTTP', 'session') is None
+    started = time.monotonic()
+    assert await pool.get('HTTP', 'session', timeout=1) is proxy
+    assert 0.02 < time.monotonic() - started < 0.5
+
+
+@pytest.mark.asyncio
+async def test_get_proxy_rejects():
+    server = Server(
+        '127.0.0.1',
+        0,
+        asyncio.Queue(),
+        max_waiting=1,
+        wait_timeout=0.01,
+        loop=asyncio.get_running_loop(),
+    )
+    writer = BufferWriter()
+    assert await server._get_proxy(writer, 'HTTP', None, 'a.com') is None
+    assert writer.data.startswith(b'HTTP/1.1 503 ')
+    server._proxy_pool.waiting = 1
+    assert await server._get_proxy(BufferWriter(), 'HTTP', None, 'a.com') is None
+    assert server.metrics.rejected == {'timeout': 1, 'waiting': 1}
+
+
+@pytest.mark.asyncio
+async def test_pool_supply():
+    queue = asyncio.Queue()
+    pool = ProxyPool(queue, min_queue=0)
+    proxies = [make_proxy(8000 + i) for i in range(3)]
+    pool.put(proxies[0])
+    for proxy in proxies[1:]:
+        queue.put_nowait(proxy)
+    assert pool.supply == 3
+    assert not pool.drained.is_set()
+    proxy = await pool.get('HTTP')
+    assert pool.supply == 2 and pool.drained.is_set()
+    pool.drained.clear()
+    pool.put(proxy)
+    assert pool.supply == 3 and not pool.drained.is_set()
+    pool.remove(proxy.host, proxy.port)
+    assert pool.supply == 2 and pool.drained.is_set()
+
+
+@pytest.mark.asyncio
+async def test_monitor_lag():
+    server = Server('127.0.0.1', 0, asyncio.Queue(), loop=asyncio.get_running_loop())
+    monitor = asyncio.ensure_future(server._monitor_lag(interval=0.01))
+    await asyncio.sleep(0.05)
+    time.sleep(0.1)  # blocks the loop
+    await asyncio.sleep(0.02)
+    monitor.cancel()
+    lag = server.metrics.loop_lag
+    assert lag.count >= 2 and 0.09 < lag.sum < 0.5
+
+
+async def read_message(reader):
+    """Return the head and the decoded body of an HTTP message."""
+    head = await reader.readuntil(b'\r\n\r\n')
+    headers = {}
+    for line in head.split(b'\r\n')[1:]:
+        if b':' in line:
+            name, value = line.split(b':', 1)
+            headers[name.strip().lower()] = value.strip()
+    body = b''
+    if headers.get(b'transfer-encoding') == b'chunked':
+        while True:
+            size = int(await reader.readuntil(b'\r\n'), 16)
+            body += (await reader.readexactly(size + 2))[:-2]
+            if not size:
+                break
+    elif b'content-length' in headers:
+        body = await reader.readexactly(int(headers[b'content-length']))
+    return head, body
+
+
+class Origin:
+    """HTTP server answering each request with its method, path and body."""
+
+    def __init__(self, headers=b'', chunked=False, delay=0, body_delay=0):
+        self.requests = []
+        self._headers = headers
+        self._chunked = chunked
+        self._delay = delay
+        self._body_delay = body_delay
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                head, body = await read_message(reader)
+                method, path, _ = head.split(b'\r\n', 1)[0].split(b' ')
+                self.requests.append((method, path, body))
+                await asyncio.sleep(self._delay)
+                payload = b'%s %s %s' % (method, path, body)
+                writer.write(b'HTTP/1.1 200 OK\r\n' + self._headers)
+                if self._chunked:
+                    writer.write(b'Transfer-Encoding: chunked\r\n\r\n')
+                    half = len(payload) // 2
+                    for chunk in (payload[:half], payload[half:]):
+                        writer.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+                    writer.write(b'0\r\n\r\n')
+                else:
+                    writer.write(b'Content-Length: %d\r\n\r\n' % len(payload))
+                    if self._body_delay:
+                        await writer.drain()
+                        await asyncio.sleep(self._body_delay)
+                    writer.write(payload)
+                await writer.drain()
+                if b'\r\nconnection: close\r\n' in head.lower():
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        writer.close()
+
+
+class FakeProxy:
+    """HTTP proxy passing each request to the origin on a new connection.
+
+    It closes a connection ``linger`` seconds after ``max_requests`` requests.
+    """
+
+    def __init__(self, max_requests=100, linger=0):
+        self.connections = 0
+        self.requests = []
+        self._max_requests = max_requests
+        self._linger = linger
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        try:
+            for _ in range(self._max_requests):
+                head, body = await read_message(reader)
+                lines = head.split(b'\r\n')
+                method, target, version = lines[0].split(b' ')
+                self.requests.append(target)
+                url = urlparse(target)
+                lines = [b' '.join((method, url.path, version))] + [
+                    line
+                    for line in lines[1:]
+                    if line and not line.lower().startswith(b'transfer-encoding')
+                ]
+                lines.append(b'Content-Length: %d' % len(body))
+                lines.append(b'Connection: close')
+                origin_reader, origin_writer = await asyncio.open_connection(
+                    url.hostname, url.port
+                )
+                origin_writer.write(b'\r\n'.join(lines) + b'\r\n\r\n' + body)
+                data = await origin_reader.read(65536)
+                while data:
+                    writer.write(data)
+                    await writer.drain()
+                    data = await origin_reader.read(65536)
+                origin_writer.close()
+            await asyncio.sleep(self._linger)
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        writer.close()
+
+
+class SlowProxy:
+    """SOCKS5 proxy that doesn't answer the greeting in time."""
+
+    connections = 0
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        await asyncio.sleep(5)
+        writer.close()
+
+
+async def listen(handle):
+    server = await asyncio.start_server(handle, '127.0.0.1', 0)
+    return server, server.sockets[0].getsockname()[1]
+
+
+async def start_server(proxies, **kwargs):
+    server = Server(
+        '127.0.0.1',
+        0,
+        asyncio.Queue(),
+        timeout=2,
+        min_queue=0,
+        keepalive_timeout=1,
+        loop=asyncio.get_running_loop(),
+        **kwargs,
+    )
+    for proxy in proxies:
+        server._proxy_pool.put(proxy)
+    listener, port = await listen(server._accept)
+    return server, listener, port
+
+
+async def fetch(port, *requests):
+    """Send the requests on one connection and return the responses."""
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(b''.join(requests))
+    responses = [
+        await asyncio.wait_for(read_message(reader), 5) for _ in range(len(requests))
+    ]
+    writer.close()
+    return responses
+
+
+def get(origin_port, path='/', headers=b''):
+    return b'GET http://127.0.0.1:%d%s HTTP/1.1\r\nHost: 127.0.0.1\r\n%s\r\n' % (
+        origin_port,
+        path.encode(),
+        headers,
+    )
+
+
+def post(origin_port, body, chunked=False):
+    head = b'POST http://127.0.0.1:%d/ HTTP/1.1\r\nHost: 127.0.0.1\r\n' % origin_port
+    if chunked:
+        chunks = b''.join(b'%x\r\n%s\r\n' % (len(c), c) for c in (body[:3], body[3:]))
+        return head + b'Transfer-Encoding: chunked\r\n\r\n' + chunks + b'0\r\n\r\n'
+    return head + b'Content-Length: %d\r\n\r\n' % len(body) + body
+
+
+@pytest.mark.asyncio
+async def test_server_keep_alive():
+    origin = Origin()
+    origin_server, origin_port = await listen(origin.handle)
+    fake = FakeProxy()
+    proxy_server, proxy_port = await listen(fake.handle)
+    proxy = make_proxy(proxy_port, requests=10, runtimes=[0.1])
+    server, listener, port = await start_server([proxy], max_idle_conns=2)
+
+    paths = ['/a', '/b', '/c']
+    responses = await fetch(port, *[get(origin_port, path) for path in paths])
+    assert [body for _, body in responses] == [
+        b'GET %s ' % path.encode() for path in paths
+    ]
+    assert all(b'X-Proxy-Info: 127.0.0.1:%d' % proxy_port in h for h, _ in responses)
+    # One client connection and one connection to the proxy for all of them
+    assert fake.connections == 1 and len(fake.requests) == 3
+    # Released once the response is relayed
+    await asyncio.sleep(0.01)
+    assert server._conn_pool.idle(proxy) == 1
+
+    await fetch(port, get(origin_port))
+    assert fake.connections == 1
+    for server_ in (listener, proxy_server, origin_server):
+        server_.close()
+
+
+@pytest.mark.asyncio
+async def test_server_conn_pool_discard():
+    origin = Origin(headers=b'Connection: close\r\n')
+    origin_server, origin_port = await listen(origin.handle)
+    fake = FakeProxy()
+    proxy_server, proxy_port = await listen(fake.handle)
+    proxy = make_proxy(proxy_port, requests=10, runtimes=[0.1])
+    server, listener, port = await start_server([proxy], max_idle_conns=2)
+
+    # The proxy connection is closed by the response, so it isn't kept
+    responses = await fetch(port, get(origin_port, '/a'))
+    assert responses[0][1] == b'GET /a '
+    await asyncio.sleep(0.01)
+    assert server._conn_pool.idle(proxy) == 0
+    await fetch(port, get(origin_port, '/b'))
+    assert fake.connections == 2
+    for server_ in (listener, proxy_server, origin_server):
+        server_.close()
+
+
+@pytest.mark.asyncio
+async def test_server_conn_pool_stale():
+    origin = Origin()
+    origin_server, origin_port = await listen(origin.handle)
+    # The proxy closes the connection kept in the pool
+    fake = FakeProxy(max_requests=1, linger=0.05)
+    proxy_server, proxy_port = await listen(fake.handle)
+    proxy = make_proxy(proxy_port, requests=10, runtimes=[0.1])
+    server, listener, port = await start_server([proxy], max_idle_conns=2)
+
+    await fetch(port, get(origin_port, '/a'))
+    await asyncio.sleep(0.01)
+    assert server._conn_pool.idle(proxy) == 1
+    await asyncio.sleep(0.1)
+    responses = await fetch(port, get(origin_port, '/b'))
+    assert responses[0][1] == b'GET /b '
+    assert fake.connections == 2
+    assert sum(proxy.stat['errors'].values()) == 0
+    for server_ in (listener, proxy_server, origin_server):
+        server_.close()
+
+
+@pytest.mark.asyncio
+async def test_server_chunked_and_streamed_bodies():
+    origin = Origin(chunked=True)
+    origin_server, origin_port = await listen(origin.handle)
+    fake = FakeProxy()
+    proxy_server, proxy_port = await listen(fake.handle)
+    proxy = make_proxy(proxy_port, requests=10, runtimes=[0.1])
+    server, listener, port = await start_server([proxy])
+
+    # The chunked response is relayed as is
+    ((head, body),) = await fetch(port, get(origin_port, '/chunked'))
+    assert b'Transfer-Encoding: chunked' in head
+    assert body == b'GET /chunked '
+
+    # The chunked request body, and the one larger than read at once,
+    # are streamed to the proxy
+    large = b'x' * 100000
+    responses = await fetch(
+        port, post(origin_port, b'abcdef', chunked=True), post(origin_port, large)
+    )
+    assert [body for _, body in responses] == [b'POST / abcdef', b'POST / ' + large]
+    assert [body for _, _, body in origin.requests[1:]] == [b'abcdef', large]
+    for server_ in (listener, proxy_server, origin_server):
+        server_.close()
+
+
+@pytest.mark.asyncio
+async def test_server_binary_body():
+    origin = Origin()
+    origin_server, origin_port = await listen(origin.handle)
+    fake = FakeProxy()
+    proxy_server, proxy_port = await listen(fake.handle)
+    proxy = make_proxy(proxy_port, requests=10, runtimes=[0.1])
+    server, listener, port = await start_server([proxy], max_idle_conns=2)
+
+    body = bytes(range(256))
+    ((_, received),) = await fetch(port, post(origin_port, body))
+    assert received == b'POST / ' + body
+    await asyncio.sleep(0.01)
+    # Cleaned up after logging the request
+    assert server._conn_pool.idle(proxy) == 1
+    assert server._proxy_pool.get_nowait('HTTP') is proxy
+    for server_ in (listener, proxy_server, origin_server):
+        server_.close()
+
+
+@pytest.mark.asyncio
+async def test_server_cache():
+    origin = Origin(headers=b'Cache-Control: max-age=60\r\n', delay=0.1)
+    origin_server, origin_port = await listen(origin.handle)
+    fake = FakeProxy()
+    proxy_server, proxy_port = await listen(fake.handle)
+    proxy = make_proxy(proxy_port, requests=10, runtimes=[0.1])
+    server, listener, port = await start_server(
+        [proxy], cache_size=1 << 20, max_concurrency=10
+    )
+
+    # The concurrent requests of the URL are passed to the proxy once
+    responses = await asyncio.gather(
+        *[fetch(port, get(origin_port, '/cached')) for _ in range(5)]
+    )
+    assert all(body == b'GET /cached ' for (_, body), in responses)
+    assert len(origin.requests) == 1
+
+    ((head, body),) = await fetch(port, get(origin_port, '/cached'))
+    assert body == b'GET /cached ' and b'Age: ' in head
+    assert len(origin.requests) == 1
+    assert server.metrics.cache['hit'] == 5 and server.metrics.cache['miss'] == 1
+    for server_ in (listener, proxy_server, origin_server):
+        server_.close()
+
+
+@pytest.mark.asyncio
+async def test_server_cache_uncacheable():
+    origin = Origin(headers=b'Cache-Control: no-store\r\n', body_delay=0.3)
+    origin_server, origin_port = await listen(origin.handle)
+    fake = FakeProxy()
+    proxy_server, proxy_port = await listen(fake.handle)
+    proxy = make_proxy(proxy_port, requests=10, runtimes=[0.1])
+    server, listener, port = await start_server(
+        [proxy], cache_size=1 << 20, max_concurrency=10
+    )
+
+    # The waiting requests go to the proxy once the head shows it's not stored
+    started = time.time()
+    responses = await asyncio.gather(
+        *[fetch(port, get(origin_port, '/private')) for _ in range(5)]
+    )
+    assert time.time() - started < 0.5
+    assert all(body == b'GET /private ' for (_, body), in responses)
+    assert len(origin.requests) == 5
+    assert not server._cache._pending
+    for server_ in (listener, proxy_server, origin_server):
+        server_.close()
+
+
+@pytest.mark.asyncio
+async def test_server_no_proxy():
+    server, listener, port = await start_server([], wait_timeout=0.05)
+    ((head, body),) = await fetch(port, get(8000))
+    assert head.startswith(b'HTTP/1.1 503 Service Unavailable\r\n')
+    assert body == b''
+    assert server.metrics.rejected['timeout'] == 1
+    assert server.metrics.failures['HTTP'] == 1
+    listener.close()
+
+
+@pytest.mark.asyncio
+async def test_server_hedging():
+    origin = Origin()
+    origin_server, origin_port = await listen(origin.handle)
+    fake, slow = FakeProxy(), SlowProxy()
+    proxy_server, proxy_port = await listen(fake.handle)
+    slow_server, slow_port = await listen(slow.handle)
+    # The slow one is ranked first
+    slow_proxy = make_proxy(slow_port, types=('SOCKS5',), requests=10, runtimes=[0.1])
+    fast_proxy = make_proxy(proxy_port, requests=10, runtimes=[1])
+    server, listener, port = await start_server(
+        [slow_proxy, fast_proxy], hedge_percentile=95
+    )
+    server._timeout = 0.2
+
+    started = time.time()
+    ((head, body),) = await fetch(port, get(origin_port, '/hedged'))
+    assert time.time() - started < 1
+    assert body == b'GET /hedged '
+    assert b'X-Proxy-Info: 127.0.0.1:%d' % proxy_port in head
+    assert slow.connections == 1
+    assert slow_proxy.stat['errors']['connection_timeout'] == 1
+    assert len(server._connect_times) == 1
+    for server_ in (listener, proxy_server, slow_server, origin_server):
+        server_.close()
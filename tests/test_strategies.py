@@ -0,0 +1,125 @@
+import pytest
+
+from proxybroker import Proxy
+from proxybroker.strategies import (
+    STRATEGIES,
+    BestStrategy,
+    EWMAStrategy,
+    HashRing,
+    LeastConnStrategy,
+    P2CStrategy,
+    RoundRobinStrategy,
+    TransferStrategy,
+)
+
+
+def make_proxy(port, types=('HTTP',), requests=10, errors=0, runtimes=(1,)):
+    proxy = Proxy('127.0.0.1', port)
+    proxy.types.update({tp: None for tp in types})
+    proxy.stat['requests'] = requests
+    if errors:
+        proxy.stat['errors']['connection_failed'] = errors
+    proxy._runtimes = list(runtimes)
+    proxy._ewma_resp_time = runtimes[-1] if runtimes else 0
+    return proxy
+
+
+@pytest.mark.parametrize('name', list(STRATEGIES))
+def test_add_pick_discard(name):
+    strategy = STRATEGIES[name]()
+    http = make_proxy(8001, types=('HTTP',))
+    both = make_proxy(8002, types=('HTTP', 'HTTPS'))
+    strategy.add(http)
+    strategy.add(both)
+    strategy.add(both)
+    assert len(strategy) == 2
+    assert strategy.pick('HTTPS') is both
+    assert strategy.pick('HTTP') in (http, both)
+    strategy.discard(both)
+    strategy.discard(both)
+    assert len(strategy) == 1
+    assert strategy.pick('HTTPS') is None
+    assert strategy.pick('HTTP') is http
+
+
+def test_best():
+    strategy = BestStrategy()
+    proxies = [make_proxy(8000 + i, runtimes=[i + 1]) for i in range(5)]
+    for proxy in reversed(proxies):
+        strategy.add(proxy)
+    assert strategy.pick('HTTP') is proxies[0]
+    strategy.discard(proxies[0])
+    assert strategy.pick('HTTP') is proxies[1]
+    # re-ranking with the changed stats
+    proxies[1]._runtimes = [10]
+    strategy.add(proxies[1])
+    assert strategy.pick('HTTP') is proxies[2]
+
+
+def test_round_robin():
+    strategy = RoundRobinStrategy()
+    proxies = [make_proxy(8000 + i) for i in range(3)]
+    for proxy in proxies:
+        strategy.add(proxy)
+    assert [strategy.pick('HTTP') for _ in range(4)] == proxies + proxies[:1]
+
+
+def test_least_conn():
+    strategy = LeastConnStrategy()
+    busy, idle = make_proxy(8001, runtimes=[1]), make_proxy(8002, runtimes=[5])
+    strategy._inflight[(busy.host, busy.port)] = 3
+    strategy.add(busy)
+    strategy.add(idle)
+    assert strategy.pick('HTTP') is idle
+
+
+@pytest.mark.parametrize('cls', [P2CStrategy, EWMAStrategy, TransferStrategy])
+def test_two_choices(cls):
+    strategy = cls()
+    fast, slow = make_proxy(8001, runtimes=[1]), make_proxy(8002, runtimes=[5])
+    strategy.add(fast)
+    strategy.add(slow)
+    assert all(strategy.pick('HTTP') is fast for _ in range(10))
+
+
+def test_transfer():
+    strategy = TransferStrategy(payload_size=1000000)
+    # 200 ms latency, 50 KB/s against 600 ms latency, 5 MB/s
+    narrow = make_proxy(8001, runtimes=[0.2])
+    narrow._ewma_throughput = 50000
+    wide = make_proxy(8002, runtimes=[0.6])
+    wide._ewma_throughput = 5000000
+    strategy.add(narrow)
+    strategy.add(wide)
+    assert all(strategy.pick('HTTP') is wide for _ in range(10))
+    strategy.payload_size = 1000
+    assert all(strategy.pick('HTTP') is narrow for _ in range(10))
+
+
+def test_compaction():
+    strategy = BestStrategy()
+    proxies = [make_proxy(8000 + i, types=('HTTP', 'HTTPS')) for i in range(200)]
+    for _ in range(3):
+        for proxy in proxies:
+            strategy.add(proxy)
+    assert len(strategy) == 200
+    assert len(strategy._queues['HTTPS']) <= 2 * strategy._live + 64
+
+
+def test_hash_ring():
+    ring = HashRing()
+    proxies = [make_proxy(8000 + i) for i in range(10)]
+    for proxy in proxies:
+        ring.add(proxy)
+    assert len(ring) == 10
+    sessions = ['session-%d' % i for i in range(1000)]
+    owners = {s: next(ring.walk(s)) for s in sessions}
+    gone = proxies[0]
+    ring.discard(gone)
+    assert len(ring) == 9
+    for session in sessions:
+        owner = next(ring.walk(session))
+        assert owner is not gone
+        if owners[session] is not gone:
+            # only the sessions of the discarded proxy are remapped
+            assert owner is owners[session]
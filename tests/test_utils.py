@@ -1,11 +1,20 @@
+import re
+import time
+
 import pytest
 
 from proxybroker.errors import BadStatusLine
 from proxybroker.utils import (
+    BloomFilter,
+    IPPattern,
+    IPPortPatternGlobal,
+    IPPortTokenizer,
+    ScalableBloomFilter,
     get_all_ip,
     get_status_code,
     parse_headers,
     parse_status_line,
+    write_atomic,
 )
 
 
@@ -14,6 +23,51 @@ def test_get_all_ip():
     assert get_all_ip(page) == {'127.0.0.1', '127.0.0.2'}
 
 
+@pytest.mark.parametrize(
+    'page',
+    [
+        '<tr><td>127.0.0.1</td><td>80</td></tr><tr><td>127.0.0.2</td><td>8080</td>',
+        '127.0.0.1:80\n127.0.0.2:3128\n127.0.0.3',
+        '127.0.0.1 127.0.0.2:8080 x',
+        '127.0.0.1 port: 123456 127.0.0.2',
+        '127.0.0.1\n',
+        '127.0.0.256',
+        '127.0.0.1:8',
+        '1.2.3.4.5.6.7.8.9:80',
+        '1.2.3.41.2.3.4',
+        '11.2.3.41.2.3.4',
+        '1.2.3.41.2.3.4 80',
+        '',
+    ],
+)
+def test_ip_port_tokenizer(page):
+    expected = IPPortPatternGlobal.findall(page)
+    assert IPPortTokenizer().findall(page) == expected
+
+
+def test_ip_port_tokenizer_long_page():
+    page = ('1.2.3.4' + ' a' * 50) * 2000 + '5.6.7.8 ' * 2000 + '9.9.9.999'
+    started = time.perf_counter()
+    pairs = IPPortTokenizer().findall(page)
+    assert time.perf_counter() - started < 1
+    assert pairs == IPPortPatternGlobal.findall(page)
+    assert pairs[-1] == ('9.9.9.9', '99')
+
+
+def test_ip_port_tokenizer_variants():
+    bounded = IPPortTokenizer(re.compile(r'\b' + IPPattern.pattern))
+    # An address glued to the previous one still ends its search for a port
+    assert bounded.findall('10.0.0.17810.0.0.155 2 12') == [('10.0.0.178', '')]
+    assert bounded.findall('a10.0.0.1 b 10.0.0.2 c 81') == [('10.0.0.2', '81')]
+    hexed = IPPortTokenizer(port_pattern=re.compile(r"(?<=')\w+(?=')"))
+    page = "1.2.3.4 80 '1F90' 5.6.7.8 'a b' 9.9.9.9 'C38'"
+    assert hexed.findall(page) == [
+        ('1.2.3.4', '1F90'),
+        ('5.6.7.8', ''),
+        ('9.9.9.9', 'C38'),
+    ]
+
+
 def test_get_status_code():
     assert get_status_code('HTTP/1.1 200 OK\r\n') == 200
     assert get_status_code('<html>123</html>\r\n') == 400
@@ -69,3 +123,36 @@ def test_parse_headers():
         'Content-Type': 'text/html; charset=UTF-8',
     }
     assert parse_headers(resp) == hdrs
+
+
+def test_write_atomic(tmp_path):
+    path = tmp_path / 'snapshot.json'
+    write_atomic(str(path), 'old')
+    write_atomic(str(path), 'new')
+    assert path.read_text() == 'new'
+    assert [p.name for p in tmp_path.iterdir()] == ['snapshot.json']
+
+
+def test_bloom_filter():
+    bloom = BloomFilter(1000, error_rate=0.01)
+    for i in range(1000):
+        bloom.add('10.0.%d.%d:80' % (i >> 8, i & 255))
+    assert all('10.0.%d.%d:80' % (i >> 8, i & 255) in bloom for i in range(1000))
+    false = sum('10.1.%d.%d:80' % (i >> 8, i & 255) in bloom for i in range(10000))
+    assert false < 300
+
+
+def test_scalable_bloom_filter(mocker):
+    monotonic = mocker.patch('time.monotonic', return_value=0)
+    bloom = ScalableBloomFilter(capacity=100, ttl=60)
+    items = ['127.0.%d.%d:80' % (i >> 8, i & 255) for i in range(1000)]
+    # A few new items may be false positives
+    added = sum(bloom.add(item) for item in items)
+    assert added > 990 and len(bloom) == added and len(bloom._filters) == 4
+    assert not any(bloom.add(item) for item in items)
+
+    monotonic.return_value = 60
+    assert items[0] in bloom and not bloom._filters
+    bloom.add('127.1.0.1:80')
+    monotonic.return_value = 120
+    assert items[0] not in bloom and '127.1.0.1:80' in bloom
@@ -0,0 +1,140 @@
+import asyncio
+
+import pytest
+
+from proxybroker.errors import ProxyConnError
+from proxybroker.server import ProxyPool
+from proxybroker.workers import SharedProxy, SharedStats, Workers
+
+from .test_server import make_proxy
+
+
+def test_shared_stats():
+    stats = SharedStats(3, capacity=4)
+    assert [stats.assign() for _ in range(5)] == [0, 1, 2, 3, None]
+    stats.publish(0, 1, [2, 1, 3.0, 2])
+    stats.publish(2, 1, [4, 0, 1.0, 1])
+    assert stats.others(0, 1) == [4, 0, 1.0, 1]
+    assert stats.others(1, 1) == [6, 1, 4.0, 3]
+    assert stats.others(1, 0) == [0, 0, 0, 0]
+
+
+def test_shared_proxy():
+    stats = SharedStats(2, capacity=4)
+    state = make_proxy(8000, requests=2, runtimes=[1, 1]).get_state()
+    slot = stats.assign()
+    first, second = (
+        SharedProxy.from_state(state, stats=stats, worker=i, slot=slot)
+        for i in range(2)
+    )
+    assert first.stat['requests'] == 2 and first.avg_resp_time == 1
+
+    for _ in range(2):
+        first.stat['requests'] += 1
+        first.log('Connection: failed', err=ProxyConnError())
+    first.stat['requests'] += 1
+    first.log('Request: success', stime=1, err=None)
+    first._add_runtime(4)
+    first.sync()
+    assert first.stat['requests'] == 5
+    assert first.error_rate == 0.4
+
+    second.sync()
+    assert second.stat['requests'] == 5
+    assert second.error_rate == 0.4
+    assert second.avg_resp_time == first.avg_resp_time
+
+    second.stat['requests'] += 1
+    second.log('Request: success')
+    first.sync()
+    assert first.stat['requests'] == second.stat['requests'] == 6
+
+
+def test_pool_refresh():
+    stats = SharedStats(2, capacity=4)
+    state = make_proxy(8000, requests=5).get_state()
+    slot = stats.assign()
+    first, second = (
+        SharedProxy.from_state(state, stats=stats, worker=i, slot=slot)
+        for i in range(2)
+    )
+    pool = ProxyPool(asyncio.Queue(), min_req_proxy=5, min_queue=0)
+    pool.put(second)
+    for _ in range(6):
+        first.stat['requests'] += 1
+        first.log('Connection: failed', err=ProxyConnError())
+    assert list(pool) == [second]
+    for proxy in pool:
+        proxy.sync()
+    pool.refresh()
+    assert len(pool) == 0
+
+
+def test_shared_stats_release():
+    stats = SharedStats(2, capacity=2)
+    assert stats.assign() == 0
+    assert stats.assign(holders=[1]) == 1
+    stats.publish(0, 0, [1, 1, 1.0, 1])
+    assert stats.assign() is None
+    stats.release(1, 1)
+    stats.release(0, 0)
+    assert stats.assign() == 1
+    assert stats.assign() is None
+    stats.release(1, 0)
+    assert stats.assign() == 0
+    assert stats.others(1, 0) == [0, 0, 0, 0]
+
+
+def test_pool_remove_releases_slot():
+    stats = SharedStats(1, capacity=1)
+    state = make_proxy(8000).get_state()
+    proxy = SharedProxy.from_state(state, stats=stats, slot=stats.assign())
+    pool = ProxyPool(asyncio.Queue(), min_queue=0)
+    pool.on_remove = SharedProxy.release
+    pool.put(proxy)
+    pool.remove('127.0.0.1', 8000)
+    assert proxy._slot is None
+    assert stats.assign() == 0
+
+
+@pytest.mark.asyncio
+async def test_workers_feed():
+    queue = asyncio.Queue()
+    workers = Workers('127.0.0.1', 0, queue, workers=3, max_concurrency=2, rate_limit=3)
+    assert workers._kwargs['max_concurrency'] == 1
+    assert workers._kwargs['rate_limit'] == 1.5
+    workers._stats.report(0, 1, 0, 0)
+    for port in (8000, 8001):
+        queue.put_nowait(make_proxy(port))
+    queue.put_nowait(None)
+    await workers._feed()
+    assert workers._fed == [1, 2, 1]
+    ports = [[] for _ in workers._queues]
+    for index, q in enumerate(workers._queues):
+        while True:
+            item = q.get(timeout=1)
+            if item is None:
+                break
+            ports[index].append(item[0]['port'])
+    assert ports == [[8001], [8000, 8001], [8000]]
+
+
+@pytest.mark.asyncio
+async def test_workers_supply_and_demand():
+    queue = asyncio.Queue()
+    workers = Workers('127.0.0.1', 0, queue, workers=2, max_concurrency=2)
+    workers._fed = [3, 3]
+    workers._stats.report(0, 4, 0, 2)
+    workers._stats.report(1, 2, 0, 3)
+    queue.put_nowait(make_proxy(8000))
+    assert workers.supply == 4
+
+    watcher = asyncio.ensure_future(workers._watch(interval=0.01))
+    await asyncio.sleep(0.02)
+    workers._stats.report(1, 0, 2, 3)
+    await asyncio.wait_for(workers.drained.wait(), 1)
+    assert workers.demand.is_set()
+    workers._stats.report(1, 0, 0, 3)
+    await asyncio.sleep(0.05)
+    assert not workers.demand.is_set()
+    watcher.cancel()